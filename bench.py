@@ -0,0 +1,493 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import sqlite3
+import asyncio
+import logging
+import argparse
+import resource
+import datetime as dt
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import pymysql
+from aiohttp import web
+
+# Навантажувальні заміри бота без Telegram і без продакшн-БД:
+# локальна заглушка Bot API (через TELEGRAM_API_URL) + SQLite замість MySQL
+# (або справжній MySQL з DB_* при --db mysql). Синтетичні потоки оновлень
+# подаються прямо в dp.feed_update; результат — JSON.
+#
+#   python bench.py                              — усі сценарії, JSON у stdout
+#   python bench.py --only start,broadcast --out bench.json
+#   python bench.py --baseline bench.json        — код виходу 1 при регресії
+
+BENCH_TOKEN = "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENC"
+BENCH_ADMINS = (900000001, 900000002, 900000003)
+USER_BASE = 800000000  # синтетичні user_id, щоб не перетинатися з реальними в MySQL
+
+logger = logging.getLogger("zamorski-bot.bench")
+
+# ------------------------- Заглушка Bot API --------------------------------
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, blocked_ratio: float = 0.0):
+        self.latency = latency
+        self.blocked_ratio = blocked_ratio
+        self.calls: Dict[str, int] = {}
+        self._message_id = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    def _message(self, chat_id: Any, text: str = "") -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "text": text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = form.get("chat_id", "0")
+        if method.startswith("send") or method == "editMessageText":
+            # Частина «користувачів» заблокувала бота — як у реальній розсилці
+            if self.blocked_ratio and int(chat_id) >= USER_BASE and random.random() < self.blocked_ratio:
+                return web.json_response(
+                    {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"},
+                    status=403,
+                )
+            return web.json_response({"ok": True, "result": self._message(chat_id, str(form.get("text", "")))})
+        if method == "getMe":
+            return web.json_response(
+                {"ok": True, "result": {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}}
+            )
+        return web.json_response({"ok": True, "result": True})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))  # вільний порт від ОС
+        await web.SockSite(self._runner, sock).start()
+        self.url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+# ------------------------- SQLite замість MySQL -----------------------------
+# Перекладаємо лише ті конструкції MySQL, що трапляються на гарячому шляху бота
+# і в міграціях. Схема будується з тих самих migrations/*.sql.
+
+_DDL_RULES = [
+    (re.compile(r"\)\s*ENGINE=\w+[^;]*", re.I), ")"),
+    (re.compile(r"\bINT\s+AUTO_INCREMENT\s+PRIMARY\s+KEY", re.I), "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r",\s*(?:UNIQUE\s+)?KEY\s+\w+\s*\([^)]*\)", re.I), ""),
+    (re.compile(r"\bON\s+UPDATE\s+CURRENT_TIMESTAMP", re.I), ""),
+]
+
+_SQL_RULES = [
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\bNOW\(\)", re.I), "CURRENT_TIMESTAMP"),
+    (re.compile(r"\bIF\(", re.I), "IIF("),
+    (re.compile(r"\bINSERT\s+IGNORE\b", re.I), "INSERT OR IGNORE"),
+    (re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.I), "ON CONFLICT DO UPDATE SET"),
+    (re.compile(r"\bVALUES\((\w+)\)", re.I), r"excluded.\1"),
+]
+
+def to_sqlite(query: str, ddl: bool = False) -> str:
+    for rx, repl in (_DDL_RULES + _SQL_RULES) if ddl else _SQL_RULES:
+        query = rx.sub(repl, query)
+    return query
+
+def _sqlite_value(v: Any) -> Any:
+    if isinstance(v, dt.datetime):
+        return v.isoformat(" ")  # той самий формат, що й CURRENT_TIMESTAMP
+    return v.isoformat() if isinstance(v, dt.date) else v
+
+def _substring_index(s: Optional[str], delim: str, count: int) -> Optional[str]:
+    if s is None or not delim or not count:
+        return None if s is None else ""
+    parts = s.split(delim)
+    return delim.join(parts[:count] if count > 0 else parts[count:])
+
+def _unix_timestamp(v: Optional[str]) -> Optional[int]:
+    if v is None:
+        return None
+    return int(dt.datetime.fromisoformat(str(v)).replace(tzinfo=dt.timezone.utc).timestamp())
+
+class SQLiteCursor:
+    def __init__(self, conn: sqlite3.Connection):
+        self._cur = conn.cursor()
+
+    @property
+    def lastrowid(self) -> int:
+        return self._cur.lastrowid
+
+    @property
+    def rowcount(self) -> int:
+        return self._cur.rowcount
+
+    async def execute(self, query: str, args: Any = None) -> int:
+        params = tuple(_sqlite_value(a) for a in args) if isinstance(args, (list, tuple)) else ()
+        self._cur.execute(to_sqlite(query), params)
+        return max(0, self._cur.rowcount)
+
+    async def executemany(self, query: str, args: Any) -> int:
+        self._cur.executemany(to_sqlite(query), [tuple(_sqlite_value(a) for a in row) for row in args])
+        return max(0, self._cur.rowcount)
+
+    async def fetchone(self) -> Optional[dict]:
+        return self._cur.fetchone()
+
+    async def fetchmany(self, size: int) -> List[dict]:
+        return self._cur.fetchmany(size)
+
+    async def fetchall(self) -> List[dict]:
+        return self._cur.fetchall()
+
+class SQLiteDB:
+    # Той самий інтерфейс, що й bot.MySQL; запити виконуються в потоці loop —
+    # SQLite у пам'яті швидший за перемикання в пул потоків
+    def __init__(self, path: str = ":memory:"):
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = lambda cur, row: {d[0]: v for d, v in zip(cur.description, row)}
+        self.conn.create_function("SUBSTRING_INDEX", 3, _substring_index, deterministic=True)
+        self.conn.create_function("UNIX_TIMESTAMP", 1, _unix_timestamp, deterministic=True)
+        self.conn.create_function("CURDATE", 0, lambda: dt.datetime.utcnow().date().isoformat())
+        # Один процес — блокування обслуговування завжди «отримано»
+        self.conn.create_function("GET_LOCK", 2, lambda name, timeout: 1)
+        self.conn.create_function("RELEASE_LOCK", 1, lambda name: 1)
+        self.size = 1
+        self.idle = 1
+        self.down = False  # імітація аварії MySQL
+
+    def apply_migrations(self):
+        import migrate
+
+        for version, name, fpath in migrate.discover():
+            with open(fpath, encoding="utf-8") as f:
+                for st in migrate.split_statements(f.read()):
+                    try:
+                        self.conn.execute(to_sqlite(st, ddl=True))
+                    except sqlite3.OperationalError as e:
+                        if "duplicate column" not in str(e) and "already exists" not in str(e):
+                            raise
+        self.conn.execute("CREATE TABLE schema_migrations (version INT PRIMARY KEY, name TEXT)")
+        self.conn.execute("INSERT INTO schema_migrations VALUES (?, ?)", (migrate.latest_version(), "bench"))
+
+    async def run(self, fn, *args):
+        return fn(*args)
+
+    async def start(self):
+        pass
+
+    @asynccontextmanager
+    async def cursor(self, unbuffered: bool = False):
+        if self.down:
+            raise pymysql.err.OperationalError(2003, "Can't connect to MySQL server (bench outage)")
+        yield SQLiteCursor(self.conn)
+
+    async def close(self):
+        self.conn.close()
+
+# ------------------------------ Оновлення ----------------------------------
+
+def message_update(update_id: int, user_id: int, text: str, reply_to: Optional[Tuple[int, int]] = None) -> dict:
+    msg: Dict[str, Any] = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        cmd = text.split()[0]
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(cmd)}]
+    if reply_to is not None:
+        chat_id, message_id = reply_to
+        msg["reply_to_message"] = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": "service",
+        }
+    return {"update_id": update_id, "message": msg}
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024  # macOS — байти, Linux — КБ
+
+def summarize(name: str, latencies: List[float], seconds: float, ops: int, api: FakeBotAPI, calls_before: int) -> dict:
+    lat = sorted(latencies)
+    return {
+        "name": name,
+        "ops": ops,
+        "seconds": round(seconds, 4),
+        "throughput": round(ops / seconds, 2) if seconds > 0 else 0.0,
+        "p50_ms": round(percentile(lat, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(lat, 0.99) * 1000, 3),
+        "max_ms": round((lat[-1] if lat else 0.0) * 1000, 3),
+        "api_calls": sum(api.calls.values()) - calls_before,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+# ------------------------------ Сценарії ------------------------------------
+
+class Bench:
+    def __init__(self, b, api: FakeBotAPI, concurrency: int, blocked_ratio: float = 0.0):
+        self.b = b
+        self.api = api
+        self.concurrency = max(1, concurrency)
+        self.blocked_ratio = blocked_ratio
+        self._update_id = 0
+
+    def next_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    async def feed(self, waves: List[List[dict]]) -> Tuple[List[float], float, int]:
+        # Хвилі йдуть послідовно (крок діалогу залежить від попереднього),
+        # оновлення всередині хвилі — конкурентно, як у webhook-режимі
+        from aiogram.types import Update
+
+        b = self.b
+        latencies: List[float] = []
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def one(raw: dict):
+            async with sem:
+                upd = Update.model_validate(raw, context={"bot": b.bot})
+                t0 = time.perf_counter()
+                await b.dp.feed_update(b.bot, upd)
+                latencies.append(time.perf_counter() - t0)
+
+        ops = 0
+        t0 = time.perf_counter()
+        for wave in waves:
+            await asyncio.gather(*(one(raw) for raw in wave))
+            ops += len(wave)
+        return latencies, time.perf_counter() - t0, ops
+
+    async def start_storm(self, users: int) -> dict:
+        calls = sum(self.api.calls.values())
+        wave = [message_update(self.next_id(), USER_BASE + i, "/start") for i in range(users)]
+        latencies, seconds, ops = await self.feed([wave])
+        return summarize("start_storm", latencies, seconds, ops, self.api, calls)
+
+    async def stock_flow(self, users: int) -> dict:
+        calls = sum(self.api.calls.values())
+        ids = [USER_BASE + i for i in range(users)]
+        waves = [
+            [message_update(self.next_id(), uid, "Перевірити наявність товару") for uid in ids],
+            [message_update(self.next_id(), uid, f"SKU-{uid % 100000:05d}") for uid in ids],
+        ]
+        latencies, seconds, ops = await self.feed(waves)
+        return summarize("stock_flow", latencies, seconds, ops, self.api, calls)
+
+    async def admin_replies(self, limit: int) -> dict:
+        # Відповідаємо реплаєм на службові повідомлення, створені stock_flow
+        calls = sum(self.api.calls.values())
+        routes = list(self.b.reply_router._lru.items())[:limit]
+        wave = [
+            message_update(self.next_id(), chat_id, "Є в наявності, відправимо завтра", reply_to=(chat_id, msg_id))
+            for (chat_id, msg_id), _ in routes
+        ]
+        latencies, seconds, ops = await self.feed([wave])
+        return summarize("admin_replies", latencies, seconds, ops, self.api, calls)
+
+    async def outage(self, users: int) -> dict:
+        # База лежить: звернення мають дійти до оператора, записи — лягти в спул,
+        # а після відновлення — перенестися в БД пачками
+        b = self.b
+        async with b.db.cursor() as cur:
+            await cur.execute("SELECT COUNT(*) AS c FROM operator_threads")
+            threads_before = (await cur.fetchone())["c"]
+        calls = sum(self.api.calls.values())
+        ids = [USER_BASE + 10 ** 7 + i for i in range(users)]  # нові користувачі — /start теж іде в спул
+        waves = [
+            [message_update(self.next_id(), uid, "/start") for uid in ids],
+            [message_update(self.next_id(), uid, "Перевірити наявність товару") for uid in ids],
+            [message_update(self.next_id(), uid, f"SKU-{uid % 100000:05d}") for uid in ids],
+        ]
+        b.db.down = True
+        try:
+            latencies, seconds, ops = await self.feed(waves)
+        finally:
+            b.db.down = False
+        res = summarize("outage", latencies, seconds, ops, self.api, calls)
+        spooled = b.spool.depth
+        t0 = time.perf_counter()
+        replayed = await b.spool.replay()
+        async with b.db.cursor() as cur:
+            await cur.execute("SELECT COUNT(*) AS c FROM operator_threads")
+            threads = (await cur.fetchone())["c"] - threads_before
+        res.update(spooled=spooled, replayed=replayed, replay_ms=round((time.perf_counter() - t0) * 1000, 3), threads=threads)
+        return res
+
+    async def broadcast(self, recipients: int) -> dict:
+        b = self.b
+        async with b.db.cursor() as cur:
+            await cur.execute("DELETE FROM subscribers WHERE user_id >= %s", (USER_BASE,))
+            rows = [(USER_BASE + i,) for i in range(recipients)]
+            for i in range(0, len(rows), 10000):
+                await cur.executemany("INSERT INTO subscribers (user_id) VALUES (%s)", rows[i:i + 10000])
+        calls = sum(self.api.calls.values())
+        latencies: List[float] = []
+
+        class SendTiming(b.BaseRequestMiddleware):
+            async def __call__(self, make_request, bot, method):
+                t0 = time.perf_counter()
+                try:
+                    return await make_request(bot, method)
+                finally:
+                    latencies.append(time.perf_counter() - t0)
+
+        mw = SendTiming()
+        b.bot.session.middleware(mw)
+        self.api.blocked_ratio = self.blocked_ratio
+        try:
+            t0 = time.perf_counter()
+            job_id, total = await b.do_broadcast(text="bench", report_chat_id=BENCH_ADMINS[0])
+            await b.broadcast_tasks[job_id]
+            seconds = time.perf_counter() - t0
+        finally:
+            self.api.blocked_ratio = 0.0
+            b.bot.session.middleware.unregister(mw)
+        res = summarize("broadcast", latencies, seconds, total, self.api, calls)
+        async with b.db.cursor() as cur:
+            await cur.execute("SELECT ok, blocked, failed FROM broadcast_jobs WHERE id=%s", (job_id,))
+            res.update(await cur.fetchone())
+        return res
+
+# ------------------------------ Запуск -------------------------------------
+
+SCENARIOS = ("start", "stock", "replies", "outage", "broadcast")
+
+def configure_env(api_url: str):
+    os.environ.update(
+        API_TOKEN=BENCH_TOKEN,
+        ADMIN_IDS=",".join(str(a) for a in BENCH_ADMINS),
+        TELEGRAM_API_URL=api_url,
+        METRICS_PORT="0",
+        FSM_STORAGE="memory",
+    )
+    os.environ.setdefault("SPOOL_PATH", ":memory:")
+    # Розсилку міряємо без штучного ліміту Telegram, якщо його не задано явно
+    os.environ.setdefault("BROADCAST_RATE", "1000000")
+    os.environ.setdefault("BROADCAST_PROGRESS_EVERY", "3600")
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    base = {s["name"]: s for s in baseline.get("scenarios", [])}
+    problems = []
+    for s in results["scenarios"]:
+        ref = base.get(s["name"])
+        if not ref:
+            continue
+        if ref["throughput"] and s["throughput"] < ref["throughput"] * (1 - tolerance):
+            problems.append(f"{s['name']}: throughput {s['throughput']} < {ref['throughput']}")
+        if ref["p99_ms"] and s["p99_ms"] > ref["p99_ms"] * (1 + tolerance):
+            problems.append(f"{s['name']}: p99 {s['p99_ms']}ms > {ref['p99_ms']}ms")
+    return problems
+
+async def run(args) -> dict:
+    api = FakeBotAPI(latency=args.api_latency / 1000)
+    await api.start()
+    configure_env(api.url)
+    import bot as b  # імпорт після налаштування середовища
+
+    b.create_bot()
+    if args.db == "sqlite":
+        b.db = SQLiteDB()
+        b.db.apply_migrations()
+    else:
+        await b.db.start()
+        await b.check_schema()
+    # Один і той самий синтетичний користувач робить кілька кроків поспіль — антиспам
+    # лишається в ланцюжку, але без мінімального інтервалу між подіями
+    b.message_throttle.backend = b.MemoryThrottleBackend(0.0, 10 ** 6, 1.0)
+    b.write_behind.start()
+    await b.subscribers_cache.warm()
+
+    only = [s.strip() for s in args.only.split(",")] if args.only else list(SCENARIOS)
+    bench = Bench(b, api, args.concurrency, args.blocked)
+    scenarios = []
+    try:
+        if "start" in only:
+            scenarios.append(await bench.start_storm(args.users))
+        if "stock" in only or "replies" in only:
+            stock = await bench.stock_flow(args.users)
+            if "stock" in only:
+                scenarios.append(stock)
+        if "replies" in only:
+            scenarios.append(await bench.admin_replies(args.users))
+        if "outage" in only and args.db == "sqlite":  # аварію імітує лише SQLite-заглушка
+            scenarios.append(await bench.outage(args.users))
+        if "broadcast" in only:
+            scenarios.append(await bench.broadcast(args.recipients))
+    finally:
+        await b.write_behind.stop()
+        await b.bot.session.close()
+        await b.db.close()
+        await api.stop()
+    return {
+        "meta": {
+            "python": sys.version.split()[0],
+            "db": args.db,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency,
+            "time": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+        },
+        "scenarios": scenarios,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def main(argv: List[str]) -> int:
+    p = argparse.ArgumentParser(description="Zamorski bot benchmark")
+    p.add_argument("--only", default="", help="через кому: " + ",".join(SCENARIOS))
+    p.add_argument("--users", type=int, default=5000, help="синтетичних користувачів у потоках оновлень")
+    p.add_argument("--recipients", type=int, default=100000, help="одержувачів розсилки")
+    p.add_argument("--concurrency", type=int, default=100, help="одночасно оброблюваних оновлень")
+    p.add_argument("--api-latency", type=float, default=0.0, help="мс затримки заглушки Bot API")
+    p.add_argument("--blocked", type=float, default=0.02, help="частка одержувачів, що заблокували бота")
+    p.add_argument("--db", choices=("sqlite", "mysql"), default="sqlite")
+    p.add_argument("--out", default="", help="записати JSON у файл")
+    p.add_argument("--baseline", default="", help="JSON попереднього запуску для порівняння")
+    p.add_argument("--tolerance", type=float, default=0.2, help="допустиме погіршення, частка")
+    args = p.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
+    results = asyncio.run(run(args))
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for line in problems:
+            logger.error("Regression: %s", line)
+        return 1 if problems else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -2,11 +2,24 @@ import os
 import re
 import csv
 import io
+import gzip
+import hmac
 import html
+import json
 import asyncio
 import logging
+import signal
+import sqlite3
 import time
-from typing import Optional, List, Tuple, Dict
+import functools
+import heapq
+import datetime as dt
+from array import array
+from bisect import bisect_left
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from typing import Optional, List, Tuple, Dict, Any, Iterable, AsyncIterable, AsyncIterator
 
 import pymysql
 from aiogram import Bot, Dispatcher, F, types
@@ -21,16 +34,45 @@ from aiogram.types import (
     BotCommandScopeAllPrivateChats,
     BotCommandScopeChat,
     BufferedInputFile,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    Update,
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramBadRequest
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import (
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramServerError,
+)
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
 
 # ============================== КОНФІГ =====================================
 
+def env_int(name: str, default: int) -> int:
+    raw = os.getenv(name, "").strip()
+    try:
+        return int(raw) if raw else default
+    except ValueError:
+        return default
+
+def env_float(name: str, default: float) -> float:
+    raw = os.getenv(name, "").strip()
+    try:
+        return float(raw) if raw else default
+    except ValueError:
+        return default
+
 API_TOKEN = os.getenv("API_TOKEN", "").strip()
 ERROR_CHAT_ID_RAW = os.getenv("ERROR_CHAT_ID", "").strip()  # -100..., @channel або пусто
 
@@ -63,10 +105,11 @@ if _admin_single:
 if ADMIN_ID_PRIMARY is None and ADMIN_IDS:
     ADMIN_ID_PRIMARY = min(ADMIN_IDS)
 
-if not API_TOKEN:
-    raise RuntimeError("Не задано API_TOKEN у змінних середовища")
-if not ADMIN_IDS:
-    raise RuntimeError("Не задано ADMIN_ID або ADMIN_IDS у змінних середовища")
+def check_config():
+    if not API_TOKEN:
+        raise RuntimeError("Не задано API_TOKEN у змінних середовища")
+    if not ADMIN_IDS:
+        raise RuntimeError("Не задано ADMIN_ID або ADMIN_IDS у змінних середовища")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -89,19 +132,380 @@ def as_chat_id(raw: str) -> Optional[int | str]:
 
 ERROR_CHAT_ID = as_chat_id(ERROR_CHAT_ID_RAW)
 
-# ====================== MySQL (автоперепідключення) ========================
+# ============================== МЕТРИКИ ====================================
+# Реєстр у форматі Prometheus (text exposition 0.0.4) без зовнішніх залежностей.
+# Гістограми й лічильники оновлюються на гарячому шляху (O(кількість бакетів)),
+# «живі» показники (черги, кеші, розсилки) рахуються функціями лише під час scrape.
+# METRICS_PORT=0 — не піднімати окремий HTTP-порт.
 
-class MySQL:
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+METRICS_PORT = env_int("METRICS_PORT", 9464)
+LOOP_LAG_EVERY = 0.5  # с між замірами затримки event loop
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+def _label_value(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v: float) -> str:
+    return repr(float(v)) if v != float("inf") else "+Inf"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values: Dict[Tuple[Any, ...], float] = {}
+
+    def inc(self, *labels: Any, n: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + n
+
+    def samples(self) -> Iterable[str]:
+        for lv, v in self._values.items():
+            yield f"{self.name}{_labels(self.labels, lv)} {_num(v)}"
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [лічильники по бакетах (не кумулятивні)..., +Inf, сума]
+        self._values: Dict[Tuple[Any, ...], List[float]] = {}
+
+    def observe(self, seconds: float, *labels: Any):
+        row = self._values.get(labels)
+        if row is None:
+            row = self._values[labels] = [0.0] * (len(self.buckets) + 2)
+        row[bisect_left(self.buckets, seconds)] += 1
+        row[-1] += seconds
+
+    @asynccontextmanager
+    async def time(self, *labels: Any):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def samples(self) -> Iterable[str]:
+        for lv, row in self._values.items():
+            acc = 0.0
+            for bound, cnt in zip(self.buckets + (float("inf"),), row):
+                acc += cnt
+                le = 'le="' + _num(bound) + '"'
+                yield f"{self.name}_bucket{_labels(self.labels, lv, le)} {_num(acc)}"
+            yield f"{self.name}_sum{_labels(self.labels, lv)} {_num(row[-1])}"
+            yield f"{self.name}_count{_labels(self.labels, lv)} {_num(acc)}"
+
+class GaugeFunc:
+    # Значення рахуються під час scrape: fn() -> число або {(мітки,): число}
+    def __init__(self, name: str, doc: str, fn, labels: Tuple[str, ...] = (), kind: str = "gauge"):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.labels = labels
+        self.kind = kind
+
+    def samples(self) -> Iterable[str]:
+        value = self.fn()
+        if isinstance(value, dict):
+            for lv, v in value.items():
+                yield f"{self.name}{_labels(self.labels, lv)} {_num(v)}"
+        elif value is not None:
+            yield f"{self.name} {_num(value)}"
+
+class MetricsRegistry:
     def __init__(self):
+        self._metrics: List[Any] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, doc: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, doc, labels))
+
+    def histogram(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def gauge(self, name: str, doc: str, fn, labels: Tuple[str, ...] = (), kind: str = "gauge") -> GaugeFunc:
+        return self.register(GaugeFunc(name, doc, fn, labels, kind))
+
+    def render(self) -> str:
+        out: List[str] = []
+        for m in self._metrics:
+            try:
+                samples = list(m.samples())
+            except Exception as e:
+                logger.warning(f"metric {m.name} failed: {e}")
+                continue
+            out.append(f"# HELP {m.name} {m.doc}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(samples)
+        return "\n".join(out) + "\n"
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram(
+    "bot_handler_seconds", "Handler execution time", ("event", "handler", "status")
+)
+db_query_seconds = metrics.histogram(
+    "bot_db_query_seconds", "MySQL statement time by label", ("statement",), DB_BUCKETS
+)
+telegram_api_seconds = metrics.histogram(
+    "bot_telegram_api_seconds", "Bot API call time", ("method", "status")
+)
+loop_lag = {"last": 0.0, "max": 0.0}
+
+_SQL_TABLE_RE = {
+    "select": re.compile(r"\bFROM\s+`?(\w+)", re.IGNORECASE),
+    "delete": re.compile(r"\bFROM\s+`?(\w+)", re.IGNORECASE),
+    "insert": re.compile(r"\bINTO\s+`?(\w+)", re.IGNORECASE),
+    "replace": re.compile(r"\bINTO\s+`?(\w+)", re.IGNORECASE),
+    "update": re.compile(r"^\s*UPDATE\s+`?(\w+)", re.IGNORECASE),
+}
+
+@functools.lru_cache(maxsize=1024)
+def sql_label(query: str) -> str:
+    # "SELECT ... FROM subscribers ..." -> "select:subscribers"
+    words = query.split(None, 1)
+    if not words:
+        return "empty"
+    verb = words[0].lower()
+    rx = _SQL_TABLE_RE.get(verb)
+    m = rx.search(query) if rx else None
+    return f"{verb}:{m.group(1).lower()}" if m else verb
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    # inner-middleware: на цьому етапі aiogram уже знає, який хендлер спрацює
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(self, handler, event, data):
+        ho = data.get("handler")
+        name = getattr(getattr(ho, "callback", None), "__name__", "unknown")
+        t0 = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - t0, self.event, name, status)
+
+class APITimingMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        t0 = time.perf_counter()
+        status = "ok"
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            status = "retry_after"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            telegram_api_seconds.observe(
+                time.perf_counter() - t0, getattr(method, "__api_method__", type(method).__name__), status
+            )
+
+async def measure_loop_lag():
+    # Наскільки пізніше запланованого прокидається корутина — ознака блокування loop
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_EVERY)
+        lag = max(0.0, time.perf_counter() - t0 - LOOP_LAG_EVERY)
+        loop_lag["last"] = lag
+        loop_lag["max"] = max(loop_lag["max"], lag)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+metrics_runner: Optional[web.AppRunner] = None
+metrics_tasks: List[asyncio.Task] = []
+
+async def start_metrics():
+    global metrics_runner
+    metrics_tasks.append(asyncio.create_task(measure_loop_lag(), name="loop-lag"))
+    if METRICS_PORT <= 0:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info("✅ Metrics on http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
+
+async def stop_metrics():
+    global metrics_runner
+    for t in metrics_tasks:
+        t.cancel()
+    await asyncio.gather(*metrics_tasks, return_exceptions=True)
+    metrics_tasks.clear()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+# ====================== MySQL (асинхронний пул) ============================
+
+DB_POOL_MIN = env_int("DB_POOL_MIN", 1)
+DB_POOL_MAX = env_int("DB_POOL_MAX", 8)
+DB_POOL_ACQUIRE_TIMEOUT = env_float("DB_POOL_ACQUIRE_TIMEOUT", 10.0)  # с, очікування вільного з'єднання
+DB_POOL_IDLE_CHECK = env_float("DB_POOL_IDLE_CHECK", 30.0)            # с простою, після яких робимо ping
+DB_POOL_WARM = env_int("DB_POOL_WARM", 4)                             # з'єднань, відкритих у фоні після старту
+DB_BREAKER_FAILURES = env_int("DB_BREAKER_FAILURES", 3)               # збоїв з'єднання поспіль до розмикання
+DB_BREAKER_RESET = env_float("DB_BREAKER_RESET", 15.0)                # с до пробного запиту після розмикання
+
+# Коди MySQL/pymysql, що означають недоступність сервера, а не помилку запиту
+DB_CONNECTION_ERRORS = {1040, 1053, 2002, 2003, 2005, 2006, 2013, 2055}
+
+class DatabaseUnavailable(Exception):
+    pass
+
+def db_down(e: BaseException) -> bool:
+    if isinstance(e, (DatabaseUnavailable, pymysql.err.InterfaceError)):
+        return True
+    return isinstance(e, pymysql.err.OperationalError) and bool(e.args) and e.args[0] in DB_CONNECTION_ERRORS
+
+class CircuitBreaker:
+    # closed → (N збоїв поспіль) → open: запити одразу падають з DatabaseUnavailable,
+    # не чекаючи connect_timeout → (через reset_after с) один пробний запит:
+    # успіх замикає, збій знову розмикає.
+    def __init__(self, failures: int = DB_BREAKER_FAILURES, reset_after: float = DB_BREAKER_RESET):
+        self.threshold = max(1, failures)
+        self.reset_after = reset_after
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.reset_after else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record(self, error: Optional[BaseException] = None):
+        if error is None:
+            if self._opened_at is not None:
+                logger.info("✅ MySQL circuit closed")
+            self._failures = 0
+            self._opened_at = None
+        elif db_down(error):
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.threshold):
+                if self._opened_at is None:
+                    self.trips += 1
+                    logger.error(f"MySQL circuit opened after {self._failures} failures: {error}")
+                self._opened_at = time.monotonic()
+        # Інші помилки (скасування, таймаут пулу, помилка запиту) про зв'язок нічого
+        # не кажуть: лічильник не скидаємо, а пробний запит можна повторити
+        self._probing = False
+
+def conn_reusable(e: BaseException) -> bool:
+    # Сервер відповів помилкою запиту — з'єднання ціле. Обрив, а також скасування
+    # чи таймаут, коли потік пулу ще може читати відповідь, — лише закрити:
+    # з'єднання pymysql не потокобезпечне
+    if isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError, TimeoutError, asyncio.TimeoutError)):
+        return False
+    return isinstance(e, Exception)
+
+class AsyncCursor:
+    # Обгортка над курсором pymysql: мережеві виклики йдуть у потоки пулу,
+    # тож повільний запит не блокує event loop.
+    def __init__(self, pool: "MySQL", cur):
+        self._pool = pool
+        self._cur = cur
+        self._buffered = not isinstance(cur, pymysql.cursors.SSCursor)
+
+    @property
+    def lastrowid(self) -> int:
+        return self._cur.lastrowid
+
+    @property
+    def rowcount(self) -> int:
+        return self._cur.rowcount
+
+    async def execute(self, query: str, args: Any = None) -> int:
+        async with db_query_seconds.time(sql_label(query)):
+            return await self._pool.run(self._cur.execute, query, args)
+
+    async def executemany(self, query: str, args: Any) -> int:
+        async with db_query_seconds.time(sql_label(query)):
+            return await self._pool.run(self._cur.executemany, query, args)
+
+    # Буферизований курсор уже має всі рядки в пам'яті — читаємо без потоку
+    async def fetchone(self) -> Optional[dict]:
+        if self._buffered:
+            return self._cur.fetchone()
+        return await self._pool.run(self._cur.fetchone)
+
+    async def fetchmany(self, size: int) -> List[dict]:
+        if self._buffered:
+            return self._cur.fetchmany(size)
+        return await self._pool.run(self._cur.fetchmany, size)
+
+    async def fetchall(self) -> List[dict]:
+        if self._buffered:
+            return self._cur.fetchall()
+        return await self._pool.run(self._cur.fetchall)
+
+class MySQL:
+    def __init__(
+        self,
+        minsize: int = DB_POOL_MIN,
+        maxsize: int = DB_POOL_MAX,
+        acquire_timeout: float = DB_POOL_ACQUIRE_TIMEOUT,
+        idle_check: float = DB_POOL_IDLE_CHECK,
+    ):
         self.host = os.getenv("DB_HOST")
         self.user = os.getenv("DB_USER")
         self.password = os.getenv("DB_PASSWORD")
         self.database = os.getenv("DB_NAME")
-        self.conn: Optional[pymysql.connections.Connection] = None
-        self.connect()
+        self.maxsize = max(1, maxsize)
+        self.minsize = min(max(0, minsize), self.maxsize)
+        self.acquire_timeout = acquire_timeout
+        self.idle_check = idle_check
+        self._idle: deque[Tuple[pymysql.connections.Connection, float]] = deque()
+        self._size = 0  # відкриті з'єднання (вільні + видані)
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._closed = False
+        self.breaker = CircuitBreaker()
+
+    @property
+    def size(self) -> int:
+        return self._size
 
-    def connect(self):
-        self.conn = pymysql.connect(
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def connect(self) -> pymysql.connections.Connection:
+        return pymysql.connect(
             host=self.host,
             user=self.user,
             password=self.password,
@@ -113,131 +517,907 @@ class MySQL:
             read_timeout=20,
             write_timeout=20,
         )
-        logger.info("✅ MySQL connected")
 
-    def cursor(self):
-        if self.conn is None or not self.conn.open:
-            self.connect()
+    async def run(self, fn, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.maxsize, thread_name_prefix="mysql")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def start(self):
+        self._closed = False
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.maxsize)
+        await self.warm(self.minsize)
+        logger.info("✅ MySQL pool ready (%d/%d)", self._size, self.maxsize)
+
+    async def warm(self, target: int):
+        # Відкриває з'єднання паралельно, доки в пулі не стане target
+        missing = min(target, self.maxsize) - self._size
+        if missing <= 0:
+            return
+        conns = await asyncio.gather(*(self.run(self.connect) for _ in range(missing)))
+        now = time.monotonic()
+        for conn in conns:
+            if self._closed or self._size >= self.maxsize:
+                conn.close()  # поки відкривали, пул уже доріс сам
+                continue
+            self._idle.append((conn, now))
+            self._size += 1
+
+    async def acquire(self) -> pymysql.connections.Connection:
+        if self._closed:
+            raise RuntimeError("MySQL pool is closed")
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.maxsize)
+        try:
+            await asyncio.wait_for(self._sem.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"MySQL pool: no free connection in {self.acquire_timeout:.0f}s") from None
+        try:
+            while self._idle:
+                conn, last_used = self._idle.pop()  # LIFO: найсвіжіше з'єднання
+                if not conn.open:
+                    self._size -= 1
+                    continue
+                # ping лише для з'єднань, що довго простоювали, а не перед кожним запитом
+                if time.monotonic() - last_used >= self.idle_check:
+                    try:
+                        await self.run(conn.ping, True)
+                    except Exception:
+                        self._discard(conn)
+                        continue
+                return conn
+            conn = await self.run(self.connect)
+            self._size += 1
+            return conn
+        except BaseException:
+            self._sem.release()
+            raise
+
+    def release(self, conn: pymysql.connections.Connection, broken: bool = False):
+        if broken or self._closed or not conn.open:
+            self._discard(conn)
         else:
-            try:
-                self.conn.ping(reconnect=True)
-            except Exception:
-                self.connect()
-        return self.conn.cursor()
+            self._idle.append((conn, time.monotonic()))
+        self._sem.release()
 
-    def close(self):
+    def _discard(self, conn: pymysql.connections.Connection):
+        self._size -= 1
         try:
-            if self.conn:
-                self.conn.close()
-                logger.info("✅ MySQL connection closed")
-        except Exception as e:
-            logger.warning(f"Close MySQL failed: {e}")
+            conn.close()
+        except Exception:
+            pass
+
+    @asynccontextmanager
+    async def cursor(self, unbuffered: bool = False):
+        if not self.breaker.allow():
+            raise DatabaseUnavailable("MySQL circuit breaker is open")
+        try:
+            conn = await self.acquire()
+        except BaseException as e:
+            self.breaker.record(e)
+            raise
+        broken = False
+        error: Optional[BaseException] = None
+        cur = conn.cursor(pymysql.cursors.SSDictCursor if unbuffered else None)
+        try:
+            yield AsyncCursor(self, cur)
+            await self._close_cursor(cur, unbuffered)
+        except BaseException as e:
+            error = e
+            broken = not conn_reusable(e)
+            if not broken:
+                try:
+                    await self._close_cursor(cur, unbuffered)
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+            self.breaker.record(error)
+
+    async def _close_cursor(self, cur, unbuffered: bool):
+        if unbuffered:
+            await self.run(cur.close)  # дочитує залишок результату з мережі
+        else:
+            cur.close()
+
+    async def close(self):
+        self._closed = True
+        while self._idle:
+            conn, _ = self._idle.pop()
+            self._discard(conn)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        logger.info("✅ MySQL pool closed")
 
 db = MySQL()
 
-# Таблиці (якщо не існують)
-with db.cursor() as cur:
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS subscribers (
-            user_id BIGINT PRIMARY KEY,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS operator_threads (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            question TEXT NOT NULL,
-            admin_message_id BIGINT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-        """
-    )
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS error_logs (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            place VARCHAR(64) NOT NULL,
-            detail TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-        """
-    )
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "").strip().lower() in ("1", "true", "yes")
 
-# =============================== БД-хелпери ================================
+async def check_schema():
+    # DDL бот не виконує: схема ведеться міграціями (python migrate.py).
+    # На старті лише звіряємо версію; DB_AUTO_MIGRATE=1 — застосувати на місці.
+    import migrate
 
-def add_subscriber(user_id: int) -> None:
-    with db.cursor() as cur:
-        cur.execute(
-            "INSERT INTO subscribers (user_id) VALUES (%s) "
-            "ON DUPLICATE KEY UPDATE user_id=user_id",
-            (user_id,),
+    async with db.cursor() as cur:
+        await cur.execute(
+            "SELECT COUNT(*) AS c FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = 'schema_migrations'"
         )
+        has_table = int((await cur.fetchone())["c"]) > 0
+        current = 0
+        if has_table:
+            await cur.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_migrations")
+            current = int((await cur.fetchone())["v"])
+    expected = migrate.latest_version()
+    if current >= expected:
+        return
+    if not DB_AUTO_MIGRATE:
+        raise RuntimeError(
+            f"Схема БД застаріла (версія {current}, потрібна {expected}). Запустіть: python migrate.py"
+        )
+
+    def _apply():
+        conn = migrate.connect()
+        try:
+            return migrate.apply_pending(conn)
+        finally:
+            conn.close()
+
+    applied = await db.run(_apply)
+    logger.info("✅ Applied migrations: %s", ", ".join(f"{v:04d}" for v in applied))
+
+# =============================== БД-хелпери ================================
+
+async def add_subscriber(user_id: int) -> None:
+    # Відомих підписників не перезаписуємо — в БД іде лише справді новий id
+    if subscribers_cache.known(user_id):
+        return
+    write_behind.cancel_removal(user_id)
+    try:
+        async with db.cursor() as cur:
+            inserted = await cur.execute(
+                "INSERT INTO subscribers (user_id, last_active_at) VALUES (%s, NOW()) "
+                "ON DUPLICATE KEY UPDATE user_id=user_id",
+                (user_id,),
+            )
+    except Exception as e:
+        if not (spool.enabled and db_down(e)):
+            raise
+        await spool.append("subscriber", user_id=user_id)
+        inserted = 0  # лічильник оновиться під час перенесення спулу
+    subscribers_cache.add(user_id)
+    stats_counters.bump("subs_new", inserted)
+
+async def insert_thread(
+    user_id: int, question: str, admin_message_id: int, operator_id: int, order_no: Optional[str] = None
+) -> int:
+    order_no = (order_no or "")[:64] or None
+    try:
+        async with db.cursor() as cur:
+            await cur.execute(
+                "INSERT INTO operator_threads (user_id, question, admin_message_id, operator_id, assigned_at, order_no) "
+                "VALUES (%s, %s, %s, %s, NOW(), %s)",
+                (user_id, question, admin_message_id, operator_id, order_no),
+            )
+            return cur.lastrowid
+    except Exception as e:
+        if not (spool.enabled and db_down(e)):
+            raise
+    # Тимчасовий від'ємний id: справжній з'явиться після перенесення спулу в MySQL
+    return -await spool.append(
+        "thread", user_id=user_id, question=question, admin_message_id=admin_message_id,
+        operator_id=operator_id, order_no=order_no,
+    )
+
+async def remove_subscriber(user_id: int) -> None:
+    subscribers_cache.discard(user_id)
+    async with db.cursor() as cur:
+        removed = await cur.execute("DELETE FROM subscribers WHERE user_id=%s", (user_id,))
+    stats_counters.bump("subs_gone", removed)
+
+# ============================ ЛІЧИЛЬНИКИ СТАТИСТИКИ ========================
+# Інкременти за днями накопичуються в пам'яті й скидаються в stats_daily разом
+# із write-behind. /stats читає лише цю крихітну таблицю агрегатів (через
+# знімок з коротким TTL), а не рахує COUNT(*) по сирих таблицях.
+
+STATS_TTL = env_float("STATS_TTL", 30.0)  # с життя знімка /stats
+STATS_METRICS = ("threads", "errors", "subs_new", "subs_gone")
+
+class StatsCounters:
+    def __init__(self, ttl: float = STATS_TTL):
+        self.ttl = ttl
+        self._pending: Dict[Tuple[str, str], int] = {}
+        self._snapshot: Optional[dict] = None
+        self._snapshot_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def bump(self, metric: str, n: int = 1):
+        if n:
+            key = (dt.date.today().isoformat(), metric)
+            self._pending[key] = self._pending.get(key, 0) + n
+
+    def drain(self) -> List[Tuple[str, str, int]]:
+        rows = [(day, metric, n) for (day, metric), n in self._pending.items()]
+        self._pending = {}
+        return rows
+
+    def restore(self, rows: List[Tuple[str, str, int]]):
+        for day, metric, n in rows:
+            self._pending[(day, metric)] = self._pending.get((day, metric), 0) + n
+
+    async def snapshot(self, recent_days: int = 7) -> dict:
+        async with self._lock:
+            now = time.monotonic()
+            if self._snapshot is not None and now - self._snapshot_at < self.ttl:
+                return self._snapshot
+            snap = {m: {"total": 0, "recent": 0} for m in STATS_METRICS}
+            async with db.cursor() as cur:
+                await cur.execute(
+                    "SELECT metric, SUM(cnt) AS total, "
+                    "SUM(IF(day >= CURDATE() - INTERVAL %s DAY, cnt, 0)) AS recent "
+                    "FROM stats_daily GROUP BY metric",
+                    (recent_days - 1,),
+                )
+                for r in await cur.fetchall():
+                    snap[r["metric"]] = {"total": int(r["total"]), "recent": int(r["recent"])}
+                if subscribers_cache.ready:
+                    snap["subscribers"] = len(subscribers_cache)
+                else:
+                    await cur.execute("SELECT COUNT(*) AS c FROM subscribers")
+                    snap["subscribers"] = int((await cur.fetchone())["c"])
+            self._snapshot, self._snapshot_at = snap, time.monotonic()
+            return snap
+
+    async def daily(self, days: int) -> List[dict]:
+        async with db.cursor() as cur:
+            await cur.execute(
+                "SELECT DATE_FORMAT(day, '%%Y-%%m-%%d') AS day, metric, cnt FROM stats_daily "
+                "WHERE day >= CURDATE() - INTERVAL %s DAY ORDER BY day DESC",
+                (days - 1,),
+            )
+            rows = await cur.fetchall()
+        by_day: Dict[str, dict] = {}
+        for r in rows:
+            by_day.setdefault(r["day"], {"day": r["day"]})[r["metric"]] = int(r["cnt"])
+        return list(by_day.values())
+
+stats_counters = StatsCounters()
+
+# ===================== ВІДКЛАДЕНИЙ ЗАПИС (write-behind) =====================
+# Відписки та журнал помилок не пишемо по одному рядку з гарячого шляху:
+# вони накопичуються й скидаються багаторядковими DELETE ... IN / INSERT
+# за розміром буфера або за таймером.
 
-def get_all_subscribers() -> List[int]:
-    with db.cursor() as cur:
-        cur.execute("SELECT user_id FROM subscribers ORDER BY created_at DESC")
-        return [row["user_id"] for row in cur.fetchall()]
+WRITE_BEHIND_MAX = env_int("WRITE_BEHIND_MAX", 500)         # рядків у буфері до примусового скидання
+WRITE_BEHIND_EVERY = env_float("WRITE_BEHIND_EVERY", 2.0)   # с між плановими скиданнями
+WRITE_BEHIND_CHUNK = 1000                                   # id в одному DELETE ... IN
+ACTIVITY_TOUCH_EVERY = env_float("ACTIVITY_TOUCH_EVERY", 3600.0)  # с: last_active_at оновлюємо не частіше
+ACTIVITY_SEEN_MAX = 100000                                  # користувачів у пам'яті дедуплікації
 
-def get_subscribers_full() -> List[Tuple[int, str]]:
-    with db.cursor() as cur:
-        cur.execute(
-            "SELECT user_id, DATE_FORMAT(created_at, '%Y-%m-%d %H:%i:%s') AS created_at "
-            "FROM subscribers ORDER BY created_at DESC"
+class WriteBehind:
+    def __init__(self, max_items: int = WRITE_BEHIND_MAX, interval: float = WRITE_BEHIND_EVERY):
+        self.max_items = max(1, max_items)
+        self.interval = interval
+        self._removals: set[int] = set()
+        self._errors: List[Tuple[str, str]] = []
+        self._touched: set[int] = set()
+        self._seen: "OrderedDict[int, float]" = OrderedDict()  # user_id -> коли востаннє позначали
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushed = 0  # рядків записано за весь час
+
+    @property
+    def depth(self) -> int:
+        return len(self._removals) + len(self._errors) + len(self._touched) + stats_counters.pending
+
+    def remove_subscriber(self, user_id: int):
+        subscribers_cache.discard(user_id)
+        self._removals.add(user_id)
+        self._check_size()
+
+    def cancel_removal(self, user_id: int):
+        # Користувач повернувся (/start) раніше, ніж відписку скинули в БД
+        self._removals.discard(user_id)
+
+    def touch(self, user_id: int):
+        # Остання активність: один UPDATE на користувача раз на ACTIVITY_TOUCH_EVERY
+        now = time.monotonic()
+        seen = self._seen.get(user_id)
+        if seen is not None and now - seen < ACTIVITY_TOUCH_EVERY:
+            return
+        self._seen[user_id] = now
+        self._seen.move_to_end(user_id)
+        if len(self._seen) > ACTIVITY_SEEN_MAX:
+            self._seen.popitem(last=False)
+        self._touched.add(user_id)
+        self._check_size()
+
+    def save_error(self, place: str, detail: str):
+        self._errors.append((place[:64], detail[:65535]))
+        stats_counters.bump("errors")
+        self._check_size()
+
+    def _check_size(self):
+        if self.depth >= self.max_items:
+            self._wake.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="write-behind")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self.depth:
+                return
+            removals, self._removals = list(self._removals), set()
+            errors, self._errors = self._errors, []
+            touched, self._touched = list(self._touched), set()
+            counters = stats_counters.drain()
+            gone = 0
+            try:
+                async with db.cursor() as cur:
+                    for i in range(0, len(removals), WRITE_BEHIND_CHUNK):
+                        chunk = removals[i:i + WRITE_BEHIND_CHUNK]
+                        gone += await cur.execute(
+                            f"DELETE FROM subscribers WHERE user_id IN ({','.join(['%s'] * len(chunk))})",
+                            chunk,
+                        )
+                    for i in range(0, len(touched), WRITE_BEHIND_CHUNK):
+                        chunk = touched[i:i + WRITE_BEHIND_CHUNK]
+                        await cur.execute(
+                            "UPDATE subscribers SET last_active_at=NOW() "
+                            f"WHERE user_id IN ({','.join(['%s'] * len(chunk))})",
+                            chunk,
+                        )
+                    if errors:
+                        # pymysql складає executemany для INSERT ... VALUES в один багаторядковий запит
+                        await cur.executemany("INSERT INTO error_logs (place, detail) VALUES (%s, %s)", errors)
+                    if counters:
+                        await cur.executemany(
+                            "INSERT INTO stats_daily (day, metric, cnt) VALUES (%s, %s, %s) "
+                            "ON DUPLICATE KEY UPDATE cnt=cnt+VALUES(cnt)",
+                            counters,
+                        )
+                self.flushed += len(removals) + len(errors) + len(touched) + len(counters)
+                stats_counters.bump("subs_gone", gone)
+            except Exception as e:
+                # Повертаємо в буфер; журнал помилок — у спул, якщо база лежить, інакше
+                # обрізаємо, щоб не рости безмежно
+                self._removals.update(removals)
+                if errors and spool.enabled and db_down(e):
+                    await spool.extend("error", [{"place": p, "detail": d} for p, d in errors])
+                    errors = []
+                self._errors[:0] = errors
+                self._touched.update(touched)
+                del self._errors[:-self.max_items * 10]
+                stats_counters.restore(counters)
+                logger.warning(
+                    f"Write-behind flush failed ({len(removals)}+{len(errors)}+{len(touched)} rows): {e}"
+                )
+
+write_behind = WriteBehind()
+
+class ActivityMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user and user.id and not is_admin(user.id):
+            write_behind.touch(user.id)
+        return await handler(event, data)
+
+# ================= ЛОКАЛЬНИЙ СПУЛ (аварійний режим MySQL) ===================
+# Поки MySQL недоступна (запобіжник розімкнено або з'єднання рветься), треди,
+# нові підписники, закриття тредів і журнал помилок дописуються в локальний
+# SQLite-файл. Фонова задача переносить їх у MySQL пачками, щойно база
+# відповідає; зі спулу рядки видаляються лише після успішного запису.
+
+SPOOL_PATH = os.getenv("SPOOL_PATH", "spool.sqlite3").strip()  # порожній — вимкнути
+SPOOL_BATCH = env_int("SPOOL_BATCH", 500)                      # рядків спулу на одну пачку в MySQL
+SPOOL_REPLAY_EVERY = env_float("SPOOL_REPLAY_EVERY", 5.0)      # с між спробами перенесення
+
+async def db_clock_skew(cur) -> dt.timedelta:
+    # Час подій спулу — локальний час процесу; зсуваємо його на годинник MySQL
+    await cur.execute("SELECT NOW() AS now")
+    now = (await cur.fetchone())["now"]
+    if isinstance(now, str):
+        now = dt.datetime.fromisoformat(now)
+    return dt.timedelta(seconds=round((now - dt.datetime.now()).total_seconds()))
+
+class LocalSpool:
+    def __init__(self, path: str = SPOOL_PATH, batch: int = SPOOL_BATCH, interval: float = SPOOL_REPLAY_EVERY):
+        self.path = path
+        self.batch = max(1, batch)
+        self.interval = interval
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._skew: Optional[dt.timedelta] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.depth = 0
+        self.spooled = 0
+        self.replayed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS spool ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL)"
+            )
+            self.depth = conn.execute("SELECT COUNT(*) FROM spool WHERE kind NOT LIKE 'dead:%'").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    async def _local(self, fn, *args):
+        # SQLite — в окремому потоці, як і MySQL: запис із fsync не блокує event loop;
+        # один потік — доступ до з'єднання послідовний
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    def _insert(self, rows: List[Tuple[str, str]]) -> int:
+        if len(rows) == 1:  # executemany не заповнює lastrowid
+            return self._db().execute("INSERT INTO spool (kind, payload) VALUES (?, ?)", rows[0]).lastrowid
+        self._db().executemany("INSERT INTO spool (kind, payload) VALUES (?, ?)", rows)
+        return 0
+
+    def _select(self, limit: int) -> List[tuple]:
+        return self._db().execute(
+            "SELECT id, kind, payload FROM spool WHERE kind NOT LIKE 'dead:%' ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+
+    def _delete(self, last: int):
+        self._db().execute("DELETE FROM spool WHERE id <= ?", (last,))
+
+    def _quarantine(self, last: int):
+        self._db().execute("UPDATE spool SET kind = 'dead:' || kind WHERE id <= ?", (last,))
+
+    async def append(self, kind: str, **payload) -> int:
+        payload.setdefault("ts", time.time())
+        rowid = await self._local(self._insert, [(kind, json.dumps(payload, ensure_ascii=False))])
+        self.depth += 1
+        self.spooled += 1
+        return rowid
+
+    async def extend(self, kind: str, payloads: List[dict]):
+        ts = time.time()
+        await self._local(
+            self._insert, [(kind, json.dumps({"ts": ts, **p}, ensure_ascii=False)) for p in payloads]
         )
-        rows = cur.fetchall()
-        return [(int(r["user_id"]), r["created_at"]) for r in rows]
+        self.depth += len(payloads)
+        self.spooled += len(payloads)
 
-def remove_subscriber(user_id: int) -> None:
-    with db.cursor() as cur:
-        cur.execute("DELETE FROM subscribers WHERE user_id=%s", (user_id,))
+    def start(self):
+        if self.enabled and self._task is None:
+            self._db()
+            if self.depth:
+                logger.warning("Spool has %d rows from a previous run", self.depth)
+            self._task = asyncio.create_task(self._run(), name="spool-replay")
 
-def count_threads(period_days: int | None = None) -> int:
-    with db.cursor() as cur:
-        if period_days is None:
-            cur.execute("SELECT COUNT(*) AS c FROM operator_threads")
-        else:
-            cur.execute(
-                "SELECT COUNT(*) AS c FROM operator_threads "
-                "WHERE created_at >= NOW() - INTERVAL %s DAY",
-                (int(period_days),),
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.depth:
+            try:
+                await self.replay()
+            except Exception as e:
+                logger.warning(f"Spool keeps {self.depth} rows for the next start: {e}")
+        if self._conn is not None:
+            await self._local(self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.depth:
+                continue
+            try:
+                await self.replay()
+            except Exception as e:
+                if not db_down(e):
+                    logger.warning(f"Spool replay failed: {e}")
+
+    async def replay(self) -> int:
+        total = 0
+        async with self._lock:
+            while True:
+                rows = await self._local(self._select, self.batch)
+                if not rows:
+                    self.depth = 0
+                    break
+                last = rows[-1][0]
+                groups: Dict[str, List[dict]] = {}
+                for _, kind, payload in rows:
+                    groups.setdefault(kind, []).append(json.loads(payload))
+                try:
+                    # Пачка — одна транзакція: збій посередині не лишає в MySQL рядків,
+                    # які залишаться й у спулі та продублюються наступним перенесенням
+                    async with db.cursor() as cur:
+                        await cur.execute("BEGIN")
+                        try:
+                            subs_new = await self._write(cur, groups)
+                            await cur.execute("COMMIT")
+                        except Exception as e:
+                            if conn_reusable(e):
+                                await cur.execute("ROLLBACK")
+                            raise  # інакше з'єднання закриється, і MySQL відкотить сам
+                except Exception as e:
+                    if db_down(e):
+                        raise
+                    # Пачку, яку MySQL відхиляє не через зв'язок, відкладаємо, щоб не блокувала решту
+                    await self._local(self._quarantine, last)
+                    logger.error(f"Spool batch up to #{last} ({len(rows)} rows) quarantined: {e}")
+                else:
+                    await self._local(self._delete, last)
+                    stats_counters.bump("subs_new", subs_new)
+                    total += len(rows)
+                    self.replayed += len(rows)
+                self.depth = max(0, self.depth - len(rows))
+        if total:
+            logger.info("✅ Spool replayed %d rows into MySQL", total)
+        return total
+
+    async def _write(self, cur, groups: Dict[str, List[dict]]) -> int:
+        # Зсув годинника міряємо один раз: округлення до секунди між пачками могло б
+        # розійтися, і «answered» не знайшов би тред із попередньої пачки
+        if self._skew is None:
+            self._skew = await db_clock_skew(cur)
+        skew = self._skew
+
+        def at(p: dict) -> dt.datetime:
+            return dt.datetime.fromtimestamp(int(p["ts"])) + skew
+
+        inserted = 0
+        subs = groups.get("subscriber", [])
+        if subs:
+            inserted = await cur.executemany(
+                "INSERT INTO subscribers (user_id, last_active_at) VALUES (%s, %s) "
+                "ON DUPLICATE KEY UPDATE user_id=user_id",
+                [(p["user_id"], at(p)) for p in subs],
+            )
+        threads = groups.get("thread", [])
+        if threads:
+            await cur.executemany(
+                "INSERT INTO operator_threads "
+                "(user_id, question, admin_message_id, operator_id, assigned_at, order_no, created_at) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                [
+                    (p["user_id"], p["question"], p["admin_message_id"], p["operator_id"], at(p), p["order_no"], at(p))
+                    for p in threads
+                ],
+            )
+        answered = groups.get("answered", [])
+        if answered:
+            # Закриваємо лише треди, створені до відповіді, — зокрема щойно перенесені
+            await cur.executemany(
+                "UPDATE operator_threads SET answered_at=%s "
+                "WHERE user_id=%s AND answered_at IS NULL AND created_at <= %s",
+                [(at(p), p["user_id"], at(p)) for p in answered],
             )
-        return int(cur.fetchone()["c"])
+        errors = groups.get("error", [])
+        if errors:
+            await cur.executemany(
+                "INSERT INTO error_logs (place, detail, created_at) VALUES (%s, %s, %s)",
+                [(p["place"], p["detail"], at(p)) for p in errors],
+            )
+        return inserted
+
+spool = LocalSpool()
+
+# ======================= КЕШ ПІДПИСНИКІВ (у пам'яті) =======================
+
+SUBSCRIBERS_WARM_PAGE = 50000
 
-def count_errors(period_days: int | None = None) -> int:
-    with db.cursor() as cur:
-        if period_days is None:
-            cur.execute("SELECT COUNT(*) AS c FROM error_logs")
+class SubscriberSet:
+    # Компактна множина id: відсортований array('q') (8 байт на id) + невеликі
+    # дельти додавань/видалень, які періодично вливаються в масив.
+    # Інваріант: _added не перетинається з _base, _removed ⊆ _base.
+    def __init__(self, compact_at: int = 4096):
+        self.compact_at = compact_at
+        self.ready = False
+        self._base = array("q")
+        self._added: set[int] = set()
+        self._removed: set[int] = set()
+
+    def _in_base(self, uid: int) -> bool:
+        i = bisect_left(self._base, uid)
+        return i < len(self._base) and self._base[i] == uid
+
+    def __contains__(self, uid: int) -> bool:
+        if uid in self._added:
+            return True
+        return uid not in self._removed and self._in_base(uid)
+
+    def __len__(self) -> int:
+        return len(self._base) - len(self._removed) + len(self._added)
+
+    def known(self, uid: int) -> bool:
+        # Поки кеш не прогрітий, «невідомі» всі — запити йдуть у БД
+        return self.ready and uid in self
+
+    def add(self, uid: int):
+        if uid in self._removed:
+            self._removed.discard(uid)
+        elif not self._in_base(uid):
+            self._added.add(uid)
+            self._maybe_compact()
+
+    def discard(self, uid: int):
+        if uid in self._added:
+            self._added.discard(uid)
+        elif not self.ready or self._in_base(uid):
+            self._removed.add(uid)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if self.ready and len(self._added) + len(self._removed) >= self.compact_at:
+            self.compact()
+
+    def compact(self):
+        removed = self._removed
+        merged = array("q", heapq.merge((u for u in self._base if u not in removed), sorted(self._added)))
+        self._base, self._added, self._removed = merged, set(), set()
+
+    async def warm(self, page: int = SUBSCRIBERS_WARM_PAGE):
+        t0 = time.monotonic()
+        loaded = array("q")
+        last = -(2 ** 63)
+        while True:
+            async with db.cursor() as cur:
+                await cur.execute(
+                    "SELECT user_id FROM subscribers WHERE user_id > %s ORDER BY user_id LIMIT %s",
+                    (last, page),
+                )
+                rows = await cur.fetchall()
+            if not rows:
+                break
+            loaded.extend(int(r["user_id"]) for r in rows)
+            last = loaded[-1]
+        # Зміни, що відбулися під час прогріву, накладаємо поверх завантаженого
+        self._base = loaded
+        self._added = {u for u in self._added if not self._in_base(u)}
+        self._removed = {u for u in self._removed if self._in_base(u)}
+        self.ready = True
+        logger.info("✅ Subscribers cache warmed: %d ids in %.2fs", len(self), time.monotonic() - t0)
+
+subscribers_cache = SubscriberSet()
+
+# ======================= СЕГМЕНТИ ПІДПИСНИКІВ ==============================
+# Аудиторія задається токенами й перетворюється на умову WHERE над
+# subscribers s; вибірка йде keyset-пагінацією по первинному ключу, тож у
+# пам'яті лише одна сторінка. Усі фільтри спираються на індекси:
+#   from=YYYY-MM-DD / to=YYYY-MM-DD — дата підписки (created_at)
+#   active[=днів] / inactive=днів   — остання активність (last_active_at)
+#   open                            — є невідповідений тред оператору
+
+SEGMENT_HELP = "from=YYYY-MM-DD to=YYYY-MM-DD active[=днів] inactive=днів open"
+
+class Segment:
+    def __init__(self, tokens: Iterable[str] = ()):
+        self.tokens: List[str] = []
+        self.where: List[str] = []
+        self.args: list = []
+        for tok in tokens:
+            self.add(tok)
+
+    def add(self, tok: str):
+        key, _, val = tok.partition("=")
+        key = key.lower()
+        if key in ("from", "to"):
+            day = dt.date.fromisoformat(val)
+            if key == "from":
+                self.where.append("s.created_at >= %s")
+                self.args.append(day.isoformat())
+            else:
+                self.where.append("s.created_at < %s")
+                self.args.append((day + dt.timedelta(days=1)).isoformat())
+        elif key == "active":
+            self.where.append("s.last_active_at >= NOW() - INTERVAL %s DAY")
+            self.args.append(int(val) if val else 30)
+        elif key == "inactive":
+            self.where.append("(s.last_active_at IS NULL OR s.last_active_at < NOW() - INTERVAL %s DAY)")
+            self.args.append(int(val))
+        elif key == "open" and not val:
+            self.where.append(
+                "EXISTS (SELECT 1 FROM operator_threads t WHERE t.user_id = s.user_id AND t.answered_at IS NULL)"
+            )
         else:
-            cur.execute(
-                "SELECT COUNT(*) AS c FROM error_logs "
-                "WHERE created_at >= NOW() - INTERVAL %s DAY",
-                (int(period_days),),
-            )
-        return int(cur.fetchone()["c"])
-
-def save_error(place: str, detail: str) -> None:
-    with db.cursor() as cur:
-        cur.execute(
-            "INSERT INTO error_logs (place, detail) VALUES (%s, %s)",
-            (place[:64], detail[:65535]),
-        )
+            raise ValueError(f"невідомий фільтр: {tok}")
+        self.tokens.append(tok)
+
+    @property
+    def spec(self) -> str:
+        return " ".join(self.tokens)
+
+    @property
+    def cond(self) -> str:
+        return "".join(f" AND {w}" for w in self.where)
+
+    def describe(self) -> str:
+        return self.spec or "усі підписники"
+
+async def count_segment(segment: Segment) -> int:
+    async with db.cursor() as cur:
+        await cur.execute(f"SELECT COUNT(*) AS c FROM subscribers s WHERE 1=1{segment.cond}", segment.args)
+        return int((await cur.fetchone())["c"])
 
 # ============================ СЕРВІСНІ Ф-ЦІЇ ===============================
 
-async def report_error(place: str, detail: str):
-    save_error(place, detail)
-    logger.error("%s | %s", place, detail)
-    if ERROR_CHAT_ID:
+# ---- Конвеєр помилок: хендлер лише кладе помилку в чергу, а фонова задача
+# пише її в error_logs (пачками через write-behind), групує за відбитком
+# (місце + нормалізований текст) і шле в лог-чат: перший випадок — одразу
+# (з лімітом на хвилину), повтори — періодичним дайджестом з лічильниками.
+
+ERROR_QUEUE_SIZE = env_int("ERROR_QUEUE_SIZE", 1000)
+ERROR_DIGEST_EVERY = env_float("ERROR_DIGEST_EVERY", 300.0)    # с між дайджестами
+ERROR_ALERTS_PER_MIN = env_int("ERROR_ALERTS_PER_MIN", 6)       # миттєвих сповіщень на хвилину
+
+_FP_HEX = re.compile(r"0x[0-9a-f]+")
+_FP_NUM = re.compile(r"\d+")
+_FP_QUOTED = re.compile(r"'[^']*'|\"[^\"]*\"")
+_FP_SPACE = re.compile(r"\s+")
+
+def error_fingerprint(place: str, detail: str) -> str:
+    norm = detail.lower()
+    norm = _FP_QUOTED.sub("'…'", norm)
+    norm = _FP_HEX.sub("#", norm)
+    norm = _FP_NUM.sub("#", norm)
+    norm = _FP_SPACE.sub(" ", norm).strip()
+    return f"{place}|{norm[:200]}"
+
+class ErrorPipeline:
+    def __init__(
+        self,
+        queue_size: int = ERROR_QUEUE_SIZE,
+        digest_every: float = ERROR_DIGEST_EVERY,
+        alerts_per_min: int = ERROR_ALERTS_PER_MIN,
+    ):
+        self.digest_every = digest_every
+        self.alerts_per_min = max(0, alerts_per_min)
+        self._queue: asyncio.Queue[Tuple[str, str]] = asyncio.Queue(maxsize=max(1, queue_size))
+        self._groups: Dict[str, dict] = {}       # відбиток -> {place, sample, count, seen}
+        self._alerts: deque[float] = deque()     # час миттєвих сповіщень за останню хвилину
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.processed = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def report(self, place: str, detail: str):
+        try:
+            self._queue.put_nowait((place, detail))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="error-pipeline")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while not self._queue.empty():
+            await self._process(*self._queue.get_nowait(), alert=False)
+        await self._send_digest()
+
+    async def _run(self):
+        next_digest = time.monotonic() + self.digest_every
+        while True:
+            timeout = max(0.0, next_digest - time.monotonic())
+            try:
+                place, detail = await asyncio.wait_for(self._queue.get(), timeout)
+                await self._process(place, detail)
+            except asyncio.TimeoutError:
+                pass
+            except Exception as e:
+                logger.warning(f"Error pipeline failed: {e}")
+            if time.monotonic() >= next_digest:
+                await self._send_digest()
+                next_digest = time.monotonic() + self.digest_every
+
+    async def _process(self, place: str, detail: str, alert: bool = True):
+        self.processed += 1
+        write_behind.save_error(place, detail)
+        fp = error_fingerprint(place, detail)
+        group = self._groups.get(fp)
+        if group is None:
+            group = self._groups[fp] = {"place": place, "sample": detail, "count": 0, "seen": 0.0}
+            if alert and self._alert_allowed():
+                group["seen"] = time.monotonic()
+                await self._send(
+                    f"⚠️ <b>Помилка</b>\n<b>Де:</b> {html.escape(place)}\n"
+                    f"<b>Деталі:</b> <code>{html.escape(detail[:1000])}</code>"
+                )
+                return
+        group["count"] += 1
+        group["seen"] = time.monotonic()
+
+    def _alert_allowed(self) -> bool:
+        now = time.monotonic()
+        while self._alerts and now - self._alerts[0] > 60:
+            self._alerts.popleft()
+        if len(self._alerts) >= self.alerts_per_min:
+            return False
+        self._alerts.append(now)
+        return True
+
+    async def _send_digest(self):
+        pending = [g for g in self._groups.values() if g["count"]]
+        if pending:
+            pending.sort(key=lambda g: g["count"], reverse=True)
+            lines = [f"🧾 <b>Дайджест помилок</b> ({len(pending)} типів)"]
+            for g in pending[:15]:
+                lines.append(
+                    f"×{g['count']} <b>{html.escape(g['place'])}</b>: "
+                    f"<code>{html.escape(g['sample'][:200])}</code>"
+                )
+            if len(pending) > 15:
+                lines.append(f"…і ще {len(pending) - 15}")
+            if self.dropped:
+                lines.append(f"Відкинуто через переповнення черги: {self.dropped}")
+            await self._send("\n".join(lines))
+        # Групи, що давно не повторювались, забуваємо — наступний випадок знову буде «новим»
+        stale = time.monotonic() - 12 * self.digest_every
+        for fp in [fp for fp, g in self._groups.items() if g["seen"] < stale and not g["count"]]:
+            del self._groups[fp]
+        for g in pending:
+            g["count"] = 0
+
+    async def _send(self, text: str):
+        if not ERROR_CHAT_ID:
+            return
         try:
-            msg = f"⚠️ <b>Помилка</b>\n<b>Де:</b> {place}\n<b>Деталі:</b> <code>{detail}</code>"
-            await bot.send_message(ERROR_CHAT_ID, msg)
+            await bot.send_message(ERROR_CHAT_ID, text)
         except Exception as e:
             logger.warning(f"Failed to send error to log chat: {e}")
 
+error_pipeline = ErrorPipeline()
+
+async def report_error(place: str, detail: str):
+    # Не блокує хендлер: ні запису в БД, ні відправки в Telegram на цьому шляху
+    logger.error("%s | %s", place, detail)
+    error_pipeline.report(place, detail)
+
 def extract_ttn(text: Optional[str]) -> Optional[str]:
     if not text:
         return None
@@ -251,17 +1431,120 @@ def tracking_kb(ttn: str) -> InlineKeyboardMarkup:
     )
 
 # ---- Хук для картки товару -----------------------------------------------
-# Повертає dict: {sku,title,price,url,image_url} або None
-async def fetch_product_by_code(code: str) -> Optional[dict]:
-    # 1) Спроба з БД, якщо задано PRODUCT_DB_TABLE
-    if PRODUCT_DB_TABLE:
+# Картки кешуються (LRU + TTL, «немає такого товару» теж кешується, коротше),
+# одночасні запити одного коду зливаються в один виклик джерела (single-flight),
+# а HTTP API ходить через один спільний keep-alive клієнт.
+
+PRODUCT_CACHE_SIZE = env_int("PRODUCT_CACHE_SIZE", 2048)
+PRODUCT_CACHE_TTL = env_float("PRODUCT_CACHE_TTL", 300.0)       # с для знайдених товарів
+PRODUCT_CACHE_NEG_TTL = env_float("PRODUCT_CACHE_NEG_TTL", 60.0)  # с для невідомих кодів
+PRODUCT_HTTP_TIMEOUT = env_float("PRODUCT_HTTP_TIMEOUT", 7.0)
+
+class ProductCache:
+    def __init__(self, size: int = PRODUCT_CACHE_SIZE, ttl: float = PRODUCT_CACHE_TTL, neg_ttl: float = PRODUCT_CACHE_NEG_TTL):
+        self.size = max(1, size)
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self._data: "OrderedDict[str, Tuple[float, Optional[dict]]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.neg_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+        self.upstream_errors = 0
+        self.upstream_seconds = 0.0
+        self.upstream_max = 0.0
+
+    def observe_upstream(self, seconds: float, ok: bool = True):
+        self.upstream_calls += 1
+        self.upstream_seconds += seconds
+        self.upstream_max = max(self.upstream_max, seconds)
+        if not ok:
+            self.upstream_errors += 1
+
+    async def get(self, code: str, loader) -> Optional[dict]:
+        entry = self._data.get(code)
+        if entry is not None and entry[0] > time.monotonic():
+            self._data.move_to_end(code)
+            if entry[1] is None:
+                self.neg_hits += 1
+            else:
+                self.hits += 1
+            return entry[1]
+
+        fut = self._inflight.get(code)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[code] = fut
+        try:
+            value = await loader(code)
+        except BaseException as e:
+            # Помилки джерела не кешуємо — наступний запит спробує знову
+            if isinstance(e, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(e)
+                fut.exception()  # позначаємо як прочитану, якщо чекачів немає
+            raise
+        else:
+            fut.set_result(value)
+            self._data[code] = (time.monotonic() + (self.ttl if value is not None else self.neg_ttl), value)
+            self._data.move_to_end(code)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+            return value
+        finally:
+            self._inflight.pop(code, None)
+
+    def summary(self) -> str:
+        lookups = self.hits + self.neg_hits + self.misses + self.coalesced
+        hit_pct = (self.hits + self.neg_hits + self.coalesced) * 100 / lookups if lookups else 0.0
+        avg_ms = self.upstream_seconds * 1000 / self.upstream_calls if self.upstream_calls else 0.0
+        return (
+            f"📦 Кеш товарів: {len(self._data)} • влучань {hit_pct:.0f}% "
+            f"(hit {self.hits}, neg {self.neg_hits}, merge {self.coalesced}, miss {self.misses})\n"
+            f"🌐 Джерело: {self.upstream_calls} запитів, помилок {self.upstream_errors}, "
+            f"сер. {avg_ms:.0f} мс, макс. {self.upstream_max * 1000:.0f} мс"
+        )
+
+product_cache = ProductCache()
+http_client = None  # httpx.AsyncClient, створюється на старті, якщо задано PRODUCT_API_URL
+
+async def start_http_client():
+    global http_client
+    if http_client is None and PRODUCT_API_URL:
+        import httpx  # імпортуємо тільки коли потрібно
+        http_client = httpx.AsyncClient(
+            timeout=PRODUCT_HTTP_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+        )
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+async def _load_product(code: str) -> Optional[dict]:
+    failed = False
+    # 1) Спроба з БД, якщо задано PRODUCT_DB_TABLE (і каталог ще не в пам'яті)
+    if PRODUCT_DB_TABLE and not catalog.ready:
+        t0 = time.monotonic()
         try:
-            with db.cursor() as cur:
-                cur.execute(
+            async with db.cursor() as cur:
+                await cur.execute(
                     f"SELECT sku, title, price, url, image_url FROM {PRODUCT_DB_TABLE} WHERE sku=%s LIMIT 1",
                     (code,),
                 )
-                row = cur.fetchone()
+                row = await cur.fetchone()
+            product_cache.observe_upstream(time.monotonic() - t0)
             if row:
                 url = row.get("url") or (PRODUCT_URL_TMPL.format(code=code) if PRODUCT_URL_TMPL else None)
                 return {
@@ -272,30 +1555,50 @@ async def fetch_product_by_code(code: str) -> Optional[dict]:
                     "image_url": row.get("image_url"),
                 }
         except Exception as e:
+            product_cache.observe_upstream(time.monotonic() - t0, ok=False)
+            failed = True
             await report_error("fetch_product_db", str(e))
 
     # 2) Спроба через HTTP API, якщо задано PRODUCT_API_URL
     if PRODUCT_API_URL:
+        t0 = time.monotonic()
         try:
-            import httpx  # імпортуємо тільки коли потрібно
+            client = await start_http_client()
             api_url = PRODUCT_API_URL.format(code=code)
-            async with httpx.AsyncClient(timeout=7.0, follow_redirects=True) as client:
-                r = await client.get(api_url)
-                if r.status_code == 200:
-                    j = r.json() if r.headers.get("content-type", "").startswith("application/json") else {}
-                    title = j.get("title") or j.get("name") or j.get("product", {}).get("title")
-                    price = j.get("price") or j.get("product", {}).get("price")
-                    url = j.get("url") or (PRODUCT_URL_TMPL.format(code=code) if PRODUCT_URL_TMPL else None)
-                    image_url = j.get("image_url") or j.get("image") or j.get("photo")
-                    return {"sku": code, "title": title, "price": price, "url": url, "image_url": image_url}
+            r = await client.get(api_url)
+            product_cache.observe_upstream(time.monotonic() - t0, ok=r.status_code < 500)
+            if r.status_code == 200:
+                j = r.json() if r.headers.get("content-type", "").startswith("application/json") else {}
+                title = j.get("title") or j.get("name") or j.get("product", {}).get("title")
+                price = j.get("price") or j.get("product", {}).get("price")
+                url = j.get("url") or (PRODUCT_URL_TMPL.format(code=code) if PRODUCT_URL_TMPL else None)
+                image_url = j.get("image_url") or j.get("image") or j.get("photo")
+                return {"sku": code, "title": title, "price": price, "url": url, "image_url": image_url}
+            if r.status_code >= 500:
+                failed = True
         except Exception as e:
+            product_cache.observe_upstream(time.monotonic() - t0, ok=False)
+            failed = True
             await report_error("fetch_product_api", str(e))
 
+    if failed:
+        raise RuntimeError(f"product lookup failed for {code}")
+    return None
+
+# Повертає dict: {sku,title,price,url,image_url} або None
+async def fetch_product_by_code(code: str) -> Optional[dict]:
+    product = catalog.get(code) if catalog.ready else None
+    if product is None and ((PRODUCT_DB_TABLE and not catalog.ready) or PRODUCT_API_URL):
+        try:
+            product = await product_cache.get(code, _load_product)
+        except Exception:
+            pass  # вже залоговано в _load_product; падаємо на фолбек
+
     # 3) Фолбек — лише посилання за шаблоном, якщо задано
-    if PRODUCT_URL_TMPL:
+    if product is None and PRODUCT_URL_TMPL:
         return {"sku": code, "title": f"Товар {code}", "price": None, "url": PRODUCT_URL_TMPL.format(code=code), "image_url": None}
 
-    return None
+    return product
 
 async def send_product_preview(chat_id: int, product: dict):
     title = product.get("title") or f"Товар {product.get('sku','')}"
@@ -319,36 +1622,710 @@ async def send_product_preview(chat_id: int, product: dict):
             pass
     await bot.send_message(chat_id, caption + (f"\n{url}" if url else ""), reply_markup=kb)
 
-# ============================ АНТИСПАМ =====================================
+# ==================== КАТАЛОГ ТОВАРІВ (індекс у пам'яті) ====================
+# З PRODUCT_DB_TABLE увесь каталог завантажується в пам'ять пачками і
+# оновлюється за розкладом (з PRODUCT_DB_UPDATED_COLUMN — лише змінені рядки,
+# повне перечитування рідше). Пошук — бінарний у відсортованих масивах:
+#   • точний і за префіксом — по нормалізованих SKU;
+#   • з одруківкою — при одній помилці ціла лишається або перша половина коду
+#     (префікс у прямому масиві), або друга (префікс у масиві перевернутих SKU);
+#     кандидатів звіряємо обмеженою відстанню Левенштейна;
+#   • за назвою — префікс слова у відсортованому списку слів назв.
 
-class ThrottleMiddleware(BaseMiddleware):
-    def __init__(self, rate: float = 0.7, burst_cnt: int = 6, burst_window: float = 10.0):
-        self.rate = rate
-        self._last: dict[int, float] = {}
-        self.burst_cnt = burst_cnt
-        self.burst_window = burst_window
-        self._hist: dict[int, List[float]] = {}
+CATALOG_INDEX = os.getenv("CATALOG_INDEX", "1").strip().lower() in ("1", "true", "yes")
+CATALOG_REFRESH_EVERY = env_float("CATALOG_REFRESH_EVERY", 600.0)    # с між оновленнями
+CATALOG_FULL_EVERY = env_float("CATALOG_FULL_EVERY", 21600.0)        # с між повними перечитуваннями
+CATALOG_PAGE = env_int("CATALOG_PAGE", 5000)                         # рядків на одну вибірку
+CATALOG_FUZZY_MAX = env_int("CATALOG_FUZZY_MAX", 2)                  # максимум правок для підказок
+CATALOG_FUZZY_SCAN = 2000                                            # кандидатів з кожної половини
+CATALOG_INLINE_LIMIT = 20                                            # результатів inline-пошуку
+CATALOG_INLINE_CACHE = env_int("CATALOG_INLINE_CACHE", 300)          # с кешу відповіді в Telegram
+PRODUCT_DB_UPDATED_COLUMN = os.getenv("PRODUCT_DB_UPDATED_COLUMN", "").strip()  # напр. updated_at
 
-    async def __call__(self, handler, event, data):
-        user = getattr(event, "from_user", None)
-        if user and user.id:
-            now = time.monotonic()
-            last = self._last.get(user.id, 0.0)
-            if now - last < self.rate:
-                return
-            self._last[user.id] = now
-            hist = self._hist.setdefault(user.id, [])
-            hist.append(now)
-            self._hist[user.id] = [t for t in hist if now - t <= self.burst_window]
-            if len(self._hist[user.id]) > self.burst_cnt:
-                return
+# Кирилиця, що виглядає як латиниця, — типова «одруківка» в артикулах
+_SKU_LOOKALIKES = str.maketrans("АВЕКМНОРСТХІ", "ABEKMHOPCTXI")
+_SKU_JUNK_RE = re.compile(r"[^0-9A-ZА-ЯЇЄҐ]")
+_WORD_RE = re.compile(r"\w+")
+
+def normalize_sku(code: str) -> str:
+    return _SKU_JUNK_RE.sub("", (code or "").upper().translate(_SKU_LOOKALIKES))
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    # Левенштейн із перестановкою сусідніх символів; рахує лише до limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            v = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                v = min(v, prev2[j - 2] + 1)
+            cur[j] = v
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+_SKU_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def sku_edits1(key: str) -> set:
+    # Усі варіанти на відстані 1 (пропуск, перестановка, заміна, вставка) — для коротких SKU це сотні рядків
+    splits = [(key[:i], key[i:]) for i in range(len(key) + 1)]
+    out = {a + b[1:] for a, b in splits if b}
+    out.update(a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1)
+    out.update(a + c + b[1:] for a, b in splits if b for c in _SKU_ALPHABET)
+    out.update(a + c + b for a, b in splits for c in _SKU_ALPHABET)
+    out.discard(key)
+    return out
+
+def _prefix_range(keys: List[str], prefix: str) -> Tuple[int, int]:
+    lo = bisect_left(keys, prefix)
+    return lo, bisect_left(keys, prefix + "\uffff", lo)
+
+class CatalogIndex:
+    def __init__(self):
+        self._products: Dict[str, tuple] = {}  # нормалізований SKU -> (sku, title, price, url, image_url)
+        self._keys: List[str] = []
+        self._rev: List[str] = []             # перевернуті ключі, відсортовані
+        self._rev_pos = array("l")            # позиція перевернутого ключа в _keys
+        self._words: List[str] = []           # слова назв, відсортовані
+        self._word_pos = array("l")
+        self._task: Optional[asyncio.Task] = None
+        self._since: Any = None               # найбільше значення колонки оновлення
+        self._full_at = 0.0
+        self.loaded_at = 0.0
+        self.lookups = 0
+
+    @property
+    def enabled(self) -> bool:
+        return CATALOG_INDEX and bool(PRODUCT_DB_TABLE)
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded_at > 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    # ---- завантаження
+
+    async def refresh(self, full: bool = False):
+        if not self.enabled:
+            return
+        t0 = time.perf_counter()
+        full = full or not self.ready or not PRODUCT_DB_UPDATED_COLUMN or (
+            time.monotonic() - self._full_at >= CATALOG_FULL_EVERY
+        )
+        products = {} if full else dict(self._products)
+        since = None if full else self._since
+        upd = f", {PRODUCT_DB_UPDATED_COLUMN} AS _upd" if PRODUCT_DB_UPDATED_COLUMN else ""
+        changed = 0
+        last_sku = ""
+        async with db.cursor() as cur:
+            while True:
+                # Keyset за sku: кожна вибірка — короткий індексний діапазон
+                where = "sku > %s" + (f" AND {PRODUCT_DB_UPDATED_COLUMN} > %s" if since is not None else "")
+                await cur.execute(
+                    f"SELECT sku, title, price, url, image_url{upd} FROM {PRODUCT_DB_TABLE} "
+                    f"WHERE {where} ORDER BY sku LIMIT %s",
+                    (last_sku, since, CATALOG_PAGE) if since is not None else (last_sku, CATALOG_PAGE),
+                )
+                rows = await cur.fetchall()
+                for r in rows:
+                    key = normalize_sku(r["sku"])
+                    if key:
+                        products[key] = (r["sku"], r["title"], r["price"], r["url"], r["image_url"])
+                    if PRODUCT_DB_UPDATED_COLUMN and r["_upd"] is not None:
+                        self._since = r["_upd"] if self._since is None else max(self._since, r["_upd"])
+                changed += len(rows)
+                if len(rows) < CATALOG_PAGE:
+                    break
+                last_sku = rows[-1]["sku"]
+        if full:
+            self._full_at = time.monotonic()
+        if full or changed:
+            self._build(products)
+        self.loaded_at = time.monotonic()
+        logger.info(
+            "Catalog %s: %d products (%d rows read) in %.0fms",
+            "loaded" if full else "updated", len(self._keys), changed, (time.perf_counter() - t0) * 1000,
+        )
+
+    def _build(self, products: Dict[str, tuple]):
+        keys = sorted(products)
+        rev = sorted((k[::-1], i) for i, k in enumerate(keys))
+        words = sorted(
+            {(w, i) for i, k in enumerate(keys) for w in _WORD_RE.findall(str(products[k][1] or "").lower())}
+        )
+        # Між присвоєннями немає await — пошук бачить або старий, або новий індекс цілком
+        self._products = products
+        self._keys = keys
+        self._rev = [r for r, _ in rev]
+        self._rev_pos = array("l", (i for _, i in rev))
+        self._words = [w for w, _ in words]
+        self._word_pos = array("l", (i for _, i in words))
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run(), name="catalog-refresh")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CATALOG_REFRESH_EVERY)
+            try:
+                await self.refresh()
+            except Exception as e:
+                if not db_down(e):
+                    await report_error("catalog_refresh", str(e))
+
+    # ---- пошук
+
+    def _product(self, key: str) -> dict:
+        sku, title, price, url, image_url = self._products[key]
+        if not url and PRODUCT_URL_TMPL:
+            url = PRODUCT_URL_TMPL.format(code=sku)
+        return {"sku": sku, "title": title or sku, "price": price, "url": url, "image_url": image_url}
+
+    def get(self, code: str) -> Optional[dict]:
+        self.lookups += 1
+        key = normalize_sku(code)
+        return self._product(key) if key in self._products else None
+
+    def prefix(self, code: str, limit: int = 10) -> List[dict]:
+        key = normalize_sku(code)
+        if not key:
+            return []
+        lo, hi = _prefix_range(self._keys, key)
+        return [self._product(k) for k in self._keys[lo:min(hi, lo + limit)]]
+
+    def fuzzy(self, code: str, limit: int = 5, max_dist: int = CATALOG_FUZZY_MAX) -> List[dict]:
+        key = normalize_sku(code)
+        if len(key) < 3:
+            return []
+        keys = self._keys
+        # Одна одруківка — точний перебір сусідів; вікна нижче — для двох
+        scored = [(1, k) for k in sku_edits1(key) if k in self._products]
+        if len(scored) >= limit or max_dist < 2:
+            scored.sort()
+            return [self._product(k) for _, k in scored[:limit]]
+        half = len(key) // 2
+        candidates: set = set()
+        lo, hi = _prefix_range(keys, key[:half])
+        mid = bisect_left(keys, key, lo, hi)  # найближчі до самого коду — першими
+        candidates.update(range(max(lo, mid - CATALOG_FUZZY_SCAN // 2), min(hi, mid + CATALOG_FUZZY_SCAN // 2)))
+        rkey = key[::-1]
+        lo, hi = _prefix_range(self._rev, rkey[:len(key) - half])
+        mid = bisect_left(self._rev, rkey, lo, hi)
+        for p in range(max(lo, mid - CATALOG_FUZZY_SCAN // 2), min(hi, mid + CATALOG_FUZZY_SCAN // 2)):
+            candidates.add(self._rev_pos[p])
+        for i in candidates:
+            d = edit_distance(key, keys[i], max_dist)
+            if 1 < d <= max_dist:
+                scored.append((d, keys[i]))
+        scored.sort()
+        return [self._product(k) for _, k in scored[:limit]]
+
+    def suggest(self, code: str, limit: int = 5) -> List[dict]:
+        # Недописаний код — продовження за префіксом, далі — схожі з одруківкою
+        found = self.prefix(code, limit)
+        seen = {p["sku"] for p in found}
+        for p in self.fuzzy(code, limit):
+            if len(found) >= limit:
+                break
+            if p["sku"] not in seen:
+                found.append(p)
+                seen.add(p["sku"])
+        return found
+
+    def search(self, query: str, limit: int = 20) -> List[dict]:
+        # Inline-пошук: SKU за префіксом, потім назви за словами, потім одруківки в SKU
+        self.lookups += 1
+        found = self.prefix(query, limit)
+        seen = {p["sku"] for p in found}
+        tokens = _WORD_RE.findall(query.lower())
+        if tokens and len(found) < limit:
+            lo, hi = _prefix_range(self._words, max(tokens, key=len))
+            for p in range(lo, hi):
+                k = self._keys[self._word_pos[p]]
+                title = str(self._products[k][1] or "").lower()
+                if all(t in title for t in tokens) and self._products[k][0] not in seen:
+                    found.append(self._product(k))
+                    seen.add(self._products[k][0])
+                    if len(found) >= limit:
+                        break
+        if len(found) < limit:
+            for p in self.fuzzy(query, limit - len(found)):
+                if p["sku"] not in seen:
+                    found.append(p)
+        return found
+
+catalog = CatalogIndex()
+
+# ============================ АНТИСПАМ =====================================
+# GCRA: на користувача зберігаються лише два числа (теоретичний час наступної
+# події та час останньої прийнятої), перевірка — O(1). Записи користувачів, що
+# вже «відпочили», витісняються, тож пам'ять не росте з кожним новим юзером.
+# Бекенд змінний: у пам'яті процесу або спільний Redis для кількох воркерів.
+
+THROTTLE_REDIS_URL = os.getenv("THROTTLE_REDIS_URL", "").strip()  # redis://... — спільні ліміти
+
+class ThrottleBackend:
+    def __init__(self, rate: float, burst_cnt: int, burst_window: float):
+        self.gap = rate                                        # мін. інтервал між подіями
+        self.interval = burst_window / max(1, burst_cnt)       # GCRA: період емісії
+        self.tolerance = burst_window - self.interval          # GCRA: допустимий «сплеск»
+
+    async def hit(self, key: int) -> bool:
+        raise NotImplementedError
+
+class MemoryThrottleBackend(ThrottleBackend):
+    def __init__(self, rate: float, burst_cnt: int, burst_window: float):
+        super().__init__(rate, burst_cnt, burst_window)
+        # key -> (tat, last); порядок = давність останнього звернення
+        self._state: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    async def hit(self, key: int) -> bool:
+        now = time.monotonic()
+        self._evict(now)
+        tat, last = self._state.get(key, (now, float("-inf")))
+        if now - last < self.gap:
+            return False
+        tat = max(tat, now)
+        allowed = tat - now <= self.tolerance
+        self._state[key] = (tat + self.interval if allowed else tat, now)
+        self._state.move_to_end(key)
+        return allowed
+
+    def _evict(self, now: float):
+        # Найдавніші записи — спереду; знімаємо ті, чий стан уже рівний «свіжому»
+        state = self._state
+        while state:
+            key, (tat, last) = next(iter(state.items()))
+            if tat > now or now - last < self.gap:
+                break
+            del state[key]
+
+_GCRA_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local interval, tolerance, gap = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local v = redis.call('HMGET', KEYS[1], 'tat', 'last')
+local tat = tonumber(v[1]) or now
+local last = tonumber(v[2]) or -1e18
+if now - last < gap then return 0 end
+tat = math.max(tat, now)
+local allowed = 0
+if tat - now <= tolerance then
+  tat = tat + interval
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tat', tat, 'last', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((tat - now + gap) * 1000) + 1000)
+return allowed
+"""
+
+class RedisThrottleBackend(ThrottleBackend):
+    def __init__(self, url: str, prefix: str, rate: float, burst_cnt: int, burst_window: float):
+        super().__init__(rate, burst_cnt, burst_window)
+        self.url = url
+        self.prefix = prefix
+        self._redis = None
+        self._script = None
+        self._warned_at = 0.0
+
+    async def hit(self, key: int) -> bool:
+        try:
+            if self._redis is None:
+                import redis.asyncio as aioredis  # опційна залежність
+                self._redis = aioredis.from_url(self.url)
+                self._script = self._redis.register_script(_GCRA_LUA)
+            res = await self._script(
+                keys=[f"{self.prefix}:{key}"], args=[self.interval, self.tolerance, self.gap]
+            )
+            return bool(int(res))
+        except Exception as e:
+            # Недоступний Redis не повинен блокувати бота — пропускаємо подію
+            now = time.monotonic()
+            if now - self._warned_at > 60:
+                self._warned_at = now
+                logger.warning(f"Throttle backend unavailable, failing open: {e}")
+            return True
+
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(
+        self,
+        rate: float = 0.7,
+        burst_cnt: int = 6,
+        burst_window: float = 10.0,
+        backend: Optional[ThrottleBackend] = None,
+        name: str = "msg",
+    ):
+        if backend is None:
+            if THROTTLE_REDIS_URL:
+                backend = RedisThrottleBackend(THROTTLE_REDIS_URL, f"throttle:{name}", rate, burst_cnt, burst_window)
+            else:
+                backend = MemoryThrottleBackend(rate, burst_cnt, burst_window)
+        self.backend = backend
+        self.dropped = 0
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user and user.id and not await self.backend.hit(user.id):
+            self.dropped += 1
+            if isinstance(event, types.CallbackQuery):
+                try:
+                    await event.answer("Забагато натискань, зачекайте трохи.")
+                except Exception:
+                    pass
+            return
         return await handler(event, data)
 
+# ============================ FSM-СХОВИЩЕ ==================================
+# Стан діалогів (ТТН, рахунок, наявність...) зберігається у спільному сховищі,
+# тож переживає рестарт і доступний з будь-якої репліки. Поверх бекенду —
+# кеш у пам'яті з наскрізним записом: повторні читання в межах діалогу не
+# ходять у мережу. Покинуті діалоги зникають через FSM_TTL. Поки MySQL
+# недоступна (запобіжник розімкнено), діалоги тривають на локальній копії, а
+# стан дописується в сховище при наступній зміні після відновлення.
+#
+#   FSM_STORAGE=memory — лише пам'ять процесу (локально й для тестів)
+#   FSM_STORAGE=mysql  — таблиця fsm_states у тій самій БД
+#   FSM_STORAGE=redis  — Redis (FSM_REDIS_URL або THROTTLE_REDIS_URL)
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory").strip().lower()
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "").strip() or THROTTLE_REDIS_URL
+FSM_TTL = env_int("FSM_TTL", 24 * 3600)                  # с без активності, після яких діалог скидається
+FSM_CACHE_SIZE = env_int("FSM_CACHE_SIZE", 10000)        # ключів у локальному кеші
+# Скільки секунд довіряти локальній копії. Кілька реплік за webhook можуть
+# змінити стан одного користувача по черзі — тоді кеш має бути коротким.
+FSM_CACHE_TTL = env_float(
+    "FSM_CACHE_TTL", 2.0 if os.getenv("BOT_MODE", "").strip().lower() == "webhook" else 600.0
+)
+FSM_SWEEP_EVERY = env_float("FSM_SWEEP_EVERY", 600.0)    # с між чистками прострочених рядків у MySQL
+FSM_SWEEP_BATCH = 1000
+
+fsm_key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+
+class FSMBackend:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    # -> (state, data, секунд до закінчення терміну)
+    async def load(self, key: str) -> Tuple[Optional[str], dict, float]:
+        raise NotImplementedError
+
+    async def save_state(self, key: str, state: Optional[str]):
+        raise NotImplementedError
+
+    async def save_data(self, key: str, data: dict):
+        raise NotImplementedError
+
+    def unavailable(self, e: Exception) -> bool:
+        # Збій, який можна пересидіти на локальній копії
+        return False
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+class MySQLFSMBackend(FSMBackend):
+    def __init__(self, ttl: int, sweep_every: float = FSM_SWEEP_EVERY):
+        super().__init__(ttl)
+        self.sweep_every = sweep_every
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self, key: str) -> Tuple[Optional[str], dict, float]:
+        async with db.cursor() as cur:
+            await cur.execute(
+                "SELECT state, data, TIMESTAMPDIFF(SECOND, updated_at, NOW()) AS age "
+                "FROM fsm_states WHERE storage_key=%s",
+                (key,),
+            )
+            row = await cur.fetchone()
+        if not row or int(row["age"]) >= self.ttl:
+            return None, {}, self.ttl
+        return row["state"], json.loads(row["data"] or "{}"), self.ttl - int(row["age"])
+
+    async def save_state(self, key: str, state: Optional[str]):
+        async with db.cursor() as cur:
+            await cur.execute(
+                "INSERT INTO fsm_states (storage_key, state, data) VALUES (%s, %s, '{}') "
+                "ON DUPLICATE KEY UPDATE state=VALUES(state), updated_at=CURRENT_TIMESTAMP",
+                (key, state),
+            )
+
+    async def save_data(self, key: str, data: dict):
+        async with db.cursor() as cur:
+            await cur.execute(
+                "INSERT INTO fsm_states (storage_key, state, data) VALUES (%s, NULL, %s) "
+                "ON DUPLICATE KEY UPDATE data=VALUES(data), updated_at=CURRENT_TIMESTAMP",
+                (key, json.dumps(data, ensure_ascii=False)),
+            )
+
+    def unavailable(self, e: Exception) -> bool:
+        return db_down(e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._sweep_loop(), name="fsm-sweeper")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_every)
+            try:
+                removed = await self.sweep()
+                if removed:
+                    logger.info("FSM sweeper removed %d rows", removed)
+            except Exception as e:
+                logger.warning(f"FSM sweep failed: {e}")
+
+    async def sweep(self) -> int:
+        # Прострочені та порожні (після state.clear()) рядки, пачками
+        removed = 0
+        while True:
+            async with db.cursor() as cur:
+                n = await cur.execute(
+                    "DELETE FROM fsm_states WHERE updated_at < NOW() - INTERVAL %s SECOND "
+                    "OR (state IS NULL AND data='{}') LIMIT %s",
+                    (self.ttl, FSM_SWEEP_BATCH),
+                )
+            removed += n
+            if n < FSM_SWEEP_BATCH:
+                return removed
+
+class RedisFSMBackend(FSMBackend):
+    def __init__(self, url: str, ttl: int):
+        super().__init__(ttl)
+        self.url = url
+        self._redis = None
+
+    def _client(self):
+        if self._redis is None:
+            import redis.asyncio as aioredis  # опційна залежність
+            self._redis = aioredis.from_url(self.url, decode_responses=True)
+        return self._redis
+
+    async def load(self, key: str) -> Tuple[Optional[str], dict, float]:
+        pipe = self._client().pipeline(transaction=False)
+        pipe.hgetall(key)
+        pipe.ttl(key)
+        row, ttl_left = await pipe.execute()
+        if not row:
+            return None, {}, self.ttl
+        return row.get("state") or None, json.loads(row.get("data") or "{}"), max(1, ttl_left)
+
+    async def _save(self, key: str, field: str, value: Optional[str]):
+        pipe = self._client().pipeline(transaction=True)
+        if value is None:
+            pipe.hdel(key, field)
+        else:
+            pipe.hset(key, field, value)
+        pipe.expire(key, self.ttl)
+        await pipe.execute()
+
+    async def save_state(self, key: str, state: Optional[str]):
+        await self._save(key, "state", state)
+
+    async def save_data(self, key: str, data: dict):
+        await self._save(key, "data", json.dumps(data, ensure_ascii=False) if data else None)
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+class CachedFSMStorage(BaseStorage):
+    def __init__(self, backend: FSMBackend, size: int = FSM_CACHE_SIZE, cache_ttl: float = FSM_CACHE_TTL):
+        self.backend = backend
+        self.size = max(1, size)
+        self.cache_ttl = cache_ttl
+        # ключ -> (state, data, діє_до); порядок = давність звернення
+        self._cache: "OrderedDict[str, Tuple[Optional[str], dict, float]]" = OrderedDict()
+        self._dirty: set = set()  # змінені, поки сховище було недоступне
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def start(self):
+        self.backend.start()
+
+    async def _entry(self, key: StorageKey) -> Tuple[str, Optional[str], dict]:
+        k = fsm_key_builder.build(key)
+        now = time.monotonic()
+        entry = self._cache.get(k)
+        if entry is not None and (entry[2] > now or k in self._dirty):
+            self._cache.move_to_end(k)
+            self.hits += 1
+            return k, entry[0], entry[1]
+        self.misses += 1
+        try:
+            state, data, ttl_left = await self.backend.load(k)
+        except Exception as e:
+            if not self.backend.unavailable(e):
+                raise
+            # Прострочена локальна копія краща за обірваний діалог
+            if entry is not None:
+                return k, entry[0], entry[1]
+            return k, None, {}
+        self._put(k, state, data, min(self.cache_ttl, ttl_left))
+        return k, state, data
+
+    def _put(self, k: str, state: Optional[str], data: dict, ttl: float):
+        self._cache[k] = (state, data, time.monotonic() + ttl)
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.size:
+            self._dirty.discard(self._cache.popitem(last=False)[0])
+
+    async def _save(self, k: str, state: Optional[str], data: dict, changed: str):
+        # Спершу бекенд: якщо запис не вдався, кеш не розходиться зі сховищем
+        try:
+            if k in self._dirty:
+                await self.backend.save_state(k, state)
+                await self.backend.save_data(k, data)
+                self._dirty.discard(k)
+            elif changed == "state":
+                await self.backend.save_state(k, state)
+            else:
+                await self.backend.save_data(k, data)
+            ttl = min(self.cache_ttl, self.backend.ttl)
+        except Exception as e:
+            if not self.backend.unavailable(e):
+                raise
+            self._dirty.add(k)
+            ttl = self.backend.ttl
+        self._put(k, state, data, ttl)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, state, _ = await self._entry(key)
+        return state
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, _, data = await self._entry(key)
+        return dict(data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, _, data = await self._entry(key)
+        value = state.state if isinstance(state, State) else state
+        await self._save(k, value, data, "state")
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k, state, _ = await self._entry(key)
+        await self._save(k, state, dict(data), "data")
+
+    async def close(self) -> None:
+        self._cache.clear()
+        await self.backend.close()
+
+def build_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "mysql":
+        return CachedFSMStorage(MySQLFSMBackend(FSM_TTL))
+    if FSM_STORAGE == "redis":
+        if not FSM_REDIS_URL:
+            raise RuntimeError("Для FSM_STORAGE=redis потрібен FSM_REDIS_URL або THROTTLE_REDIS_URL")
+        return CachedFSMStorage(RedisFSMBackend(FSM_REDIS_URL, FSM_TTL))
+    return MemoryStorage()
+
 # ============================ БОТ/ДИСПЕТЧЕР ================================
+# Імпорт модуля нічого не відкриває й не перевіряє: Bot, сесія та FSM-сховище
+# створюються в create_bot(), з'єднання з БД і прогрів — у startup()/warm_up().
+
+# Власний Bot API сервер (self-hosted telegram-bot-api) або локальна заглушка для bench.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/")
+
+def build_session() -> Optional[AiohttpSession]:
+    if not TELEGRAM_API_URL:
+        return None
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+
+bot: Optional[Bot] = None
+fsm_storage: BaseStorage = MemoryStorage()
+dp = Dispatcher(storage=fsm_storage)
+message_throttle = ThrottleMiddleware(0.7, 6, 10.0, name="msg")
+callback_throttle = ThrottleMiddleware(0.3, 10, 10.0, name="cb")
+dp.message.outer_middleware(message_throttle)
+dp.callback_query.outer_middleware(callback_throttle)
+dp.message.outer_middleware(ActivityMiddleware())
+dp.callback_query.outer_middleware(ActivityMiddleware())
+dp.message.middleware(HandlerTimingMiddleware("message"))
+dp.callback_query.middleware(HandlerTimingMiddleware("callback_query"))
+
+def create_bot() -> Bot:
+    global bot, fsm_storage
+    if bot is None:
+        check_config()
+        bot = Bot(token=API_TOKEN, session=build_session(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        bot.session.middleware(APITimingMiddleware())
+        fsm_storage = build_fsm_storage()
+        dp.fsm.storage = fsm_storage
+    return bot
+
+def fsm_sessions() -> int:
+    # Діалоги, що зараз у якомусь стані (у межах цього процесу)
+    if isinstance(fsm_storage, CachedFSMStorage):
+        return sum(1 for state, _, _ in fsm_storage._cache.values() if state)
+    if isinstance(fsm_storage, MemoryStorage):
+        return sum(1 for rec in fsm_storage.storage.values() if rec.state)
+    return 0
 
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
-dp.message.outer_middleware(ThrottleMiddleware(0.7, 6, 10.0))
+metrics.gauge("bot_event_loop_lag_seconds", "Last measured event loop lag", lambda: loop_lag["last"])
+metrics.gauge("bot_event_loop_lag_max_seconds", "Max event loop lag since start", lambda: loop_lag["max"])
+metrics.gauge("bot_fsm_sessions", "Conversations in a non-empty FSM state", fsm_sessions)
+metrics.gauge(
+    "bot_throttle_dropped_total", "Updates dropped by the throttle",
+    lambda: {("message",): message_throttle.dropped, ("callback_query",): callback_throttle.dropped},
+    ("event",), kind="counter",
+)
+metrics.gauge(
+    "bot_broadcast_throughput", "Messages per second of running broadcast jobs",
+    lambda: {(job_id,): st.throughput() for job_id, st in broadcast_progress.items()}, ("job",),
+)
+metrics.gauge(
+    "bot_broadcast_done", "Recipients processed by running broadcast jobs",
+    lambda: {
+        (job_id, outcome): getattr(st, outcome)
+        for job_id, st in broadcast_progress.items() for outcome in ("ok", "blocked", "failed")
+    },
+    ("job", "outcome"),
+)
+metrics.gauge("bot_write_behind_depth", "Rows waiting in the write-behind buffer", lambda: write_behind.depth)
+metrics.gauge("bot_db_pool_connections", "Open MySQL connections", lambda: db.size)
+metrics.gauge("bot_db_pool_idle", "Idle MySQL connections", lambda: db.idle)
+metrics.gauge("bot_db_circuit_open", "1 while the MySQL circuit breaker is open", lambda: int(db.breaker.state != "closed"))
+metrics.gauge("bot_spool_depth", "Writes waiting in the local spool for MySQL", lambda: spool.depth)
+metrics.gauge("bot_catalog_products", "Products in the in-memory catalog index", lambda: len(catalog))
+metrics.gauge("bot_subscribers_cached", "Subscribers in the in-memory set", lambda: len(subscribers_cache))
+metrics.gauge("bot_operator_open_threads", "Open threads per operator",
+              lambda: {(op,): operator_queue.open_count(op) for op in operator_queue.operators}, ("operator",))
+metrics.gauge(
+    "bot_product_cache_total", "Product cache lookups by result",
+    lambda: {
+        ("hit",): product_cache.hits, ("neg_hit",): product_cache.neg_hits,
+        ("miss",): product_cache.misses, ("coalesced",): product_cache.coalesced,
+    },
+    ("result",), kind="counter",
+)
 
 # ============================== КЛАВІАТУРИ ================================
 
@@ -374,6 +2351,14 @@ def back_kb() -> ReplyKeyboardMarkup:
         is_persistent=True,
     )
 
+def sku_suggestions_kb(products: List[dict], keep: Optional[str] = None) -> ReplyKeyboardMarkup:
+    # Натиск надсилає SKU текстом — далі той самий хендлер коду товару
+    rows = [[KeyboardButton(text=p["sku"])] for p in products]
+    if keep:
+        rows.append([KeyboardButton(text=keep)])
+    rows.append([KeyboardButton(text=BACK_BTN)])
+    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True, one_time_keyboard=True)
+
 # --------- Швидкі відповіді (інлайн для адміна)
 
 TEMPLATES: dict[str, str] = {
@@ -413,19 +2398,27 @@ def user_commands() -> list[BotCommand]:
 def admin_commands() -> list[BotCommand]:
     return user_commands() + [
         BotCommand(command="reply", description="Відповідь: /reply <id> <текст>"),
-        BotCommand(command="broadcast", description="Зробити розсилку"),
-        BotCommand(command="stats", description="Статистика"),
-        BotCommand(command="export", description="Експорт підписників (CSV)"),
+        BotCommand(command="broadcast", description="Розсилка: /broadcast [active=30 open from= to=]"),
+        BotCommand(command="broadcast_status", description="Статус розсилок"),
+        BotCommand(command="broadcast_cancel", description="Скасувати розсилку: /broadcast_cancel [id]"),
+        BotCommand(command="queue", description="Черга операторів"),
+        BotCommand(command="bulk_reply", description="Масові відповіді зі списку/CSV"),
+        BotCommand(command="stats", description="Статистика: /stats [днів]"),
+        BotCommand(command="export", description="Експорт підписників (CSV.gz): from= to= active cols="),
     ]
 
 async def setup_bot_commands(bot: Bot):
-    await bot.set_my_commands(user_commands(), scope=BotCommandScopeAllPrivateChats())
-    for aid in ADMIN_IDS:
+    async def for_admin(aid: int):
         try:
             await bot.set_my_commands(admin_commands(), scope=BotCommandScopeChat(chat_id=aid))
         except Exception as e:
             logger.warning(f"set_my_commands for admin {aid} failed: {e}")
 
+    await asyncio.gather(
+        bot.set_my_commands(user_commands(), scope=BotCommandScopeAllPrivateChats()),
+        *(for_admin(aid) for aid in ADMIN_IDS),
+    )
+
 # ================================ СТАНи ====================================
 
 class SendBroadcast(StatesGroup):
@@ -445,15 +2438,353 @@ class BillRequest(StatesGroup):
 class StockRequest(StatesGroup):
     waiting_code = State()
 
-# ------------------------- АЛІАСИ ДЛЯ REPLY-ID -----------------------------
-# key: admin_message_id (будь-яке службове), value: (user_id, is_ttn_thread)
-reply_alias: Dict[int, Tuple[int, bool]] = {}
+class BulkReply(StatesGroup):
+    waiting_rows = State()
+
+# ------------------------- МАРШРУТИЗАЦІЯ REPLY -----------------------------
+# Будь-яке службове повідомлення адміну (нотатка треду, «Швидкі відповіді»,
+# попередження про ТТН) -> (user_id, тип треду). Маршрути зберігаються в
+# reply_routes і переживають рестарт; у пам'яті — лише LRU з жорсткою межею.
+
+REPLY_CACHE_SIZE = env_int("REPLY_CACHE_SIZE", 10000)
+
+THREAD_KINDS = {"[TTN]": "ttn", "[BILL]": "bill", "[STOCK]": "stock"}
+
+def thread_kind(question: str) -> str:
+    for prefix, kind in THREAD_KINDS.items():
+        if question.startswith(prefix):
+            return kind
+    return "question"
+
+class ReplyRouter:
+    def __init__(self, size: int = REPLY_CACHE_SIZE):
+        self.size = max(1, size)
+        self._lru: "OrderedDict[Tuple[int, int], Tuple[int, str]]" = OrderedDict()
+
+    def cache(self, chat_id: int, message_id: int, user_id: int, kind: str):
+        key = (chat_id, message_id)
+        self._lru[key] = (user_id, kind)
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    async def remember(self, chat_id: int, message_id: int, user_id: int, kind: str):
+        self.cache(chat_id, message_id, user_id, kind)
+        try:
+            async with db.cursor() as cur:
+                await cur.execute(
+                    "INSERT INTO reply_routes (admin_chat_id, admin_message_id, user_id, kind) "
+                    "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE user_id=VALUES(user_id), kind=VALUES(kind)",
+                    (chat_id, message_id, user_id, kind),
+                )
+        except Exception as e:
+            logger.warning(f"reply route {chat_id}/{message_id} not persisted: {e}")
+
+    async def resolve(self, chat_id: int, message_id: int) -> Optional[Tuple[int, str]]:
+        key = (chat_id, message_id)
+        route = self._lru.get(key)
+        if route is not None:
+            self._lru.move_to_end(key)
+            return route
+        async with db.cursor() as cur:
+            await cur.execute(
+                "SELECT user_id, kind FROM reply_routes WHERE admin_chat_id=%s AND admin_message_id=%s",
+                (chat_id, message_id),
+            )
+            row = await cur.fetchone()
+            if row:
+                route = (int(row["user_id"]), row["kind"])
+            else:
+                # Нотатки тредів адресуються через сам operator_threads
+                # (message_id унікальний лише в межах чату оператора)
+                await cur.execute(
+                    "SELECT user_id, question FROM operator_threads "
+                    "WHERE admin_message_id=%s AND (operator_id=%s OR operator_id IS NULL) "
+                    "ORDER BY id DESC LIMIT 1",
+                    (message_id, chat_id),
+                )
+                row = await cur.fetchone()
+                if row:
+                    route = (int(row["user_id"]), thread_kind(row.get("question") or ""))
+        if route is not None:
+            self.cache(chat_id, message_id, *route)
+        return route
+
+reply_router = ReplyRouter()
+
+# ------------------------- ЧЕРГА ОПЕРАТОРІВ --------------------------------
+# Нові треди розподіляються між усіма ADMIN_IDS: по колу (round_robin) або
+# тому, в кого найменше відкритих (least_open). Тред відкритий, доки оператор
+# не відповів користувачу; без відповіді за OPERATOR_REASSIGN_AFTER секунд
+# він пересилається наступному оператору (кожному — не більше одного разу).
+
+OPERATOR_STRATEGY = os.getenv("OPERATOR_STRATEGY", "least_open").strip().lower()  # least_open | round_robin
+OPERATOR_REASSIGN_AFTER = env_float("OPERATOR_REASSIGN_AFTER", 600.0)  # с без відповіді; 0 — не перепризначати
+OPERATOR_CHECK_EVERY = env_float("OPERATOR_CHECK_EVERY", 30.0)
+OPERATOR_WARM_DAYS = 7  # старіші невідповідені треди в чергу не піднімаємо
+
+class OpenThread:
+    __slots__ = ("id", "user_id", "operator_id", "kind", "note", "assigned_at", "tried")
+
+    def __init__(self, thread_id: int, user_id: int, operator_id: int, kind: str, note: str, assigned_at: float):
+        self.id = thread_id
+        self.user_id = user_id
+        self.operator_id = operator_id
+        self.kind = kind
+        self.note = note
+        self.assigned_at = assigned_at
+        self.tried = {operator_id}
+
+class OperatorQueue:
+    def __init__(
+        self,
+        operators: Iterable[int],
+        strategy: str = OPERATOR_STRATEGY,
+        reassign_after: float = OPERATOR_REASSIGN_AFTER,
+    ):
+        self.operators = sorted(operators)
+        self.strategy = strategy
+        self.reassign_after = reassign_after
+        self._open: Dict[int, OpenThread] = {}
+        self._by_user: Dict[int, set] = {}
+        self._load: Dict[int, int] = {op: 0 for op in self.operators}
+        self._last: Dict[int, float] = {op: 0.0 for op in self.operators}
+        self._rr = 0
+        self._task: Optional[asyncio.Task] = None
+        self.reassigned = 0
+
+    def open_count(self, operator_id: Optional[int] = None) -> int:
+        if operator_id is None:
+            return len(self._open)
+        return self._load.get(operator_id, 0)
+
+    def pick(self, exclude: Iterable[int] = ()) -> Optional[int]:
+        # Навантаження резервується одразу, до першого await: одночасні звернення
+        # розходяться по різних операторах. Якщо тред не відкрився — release().
+        op = self._choose(set(exclude))
+        if op is not None:
+            self._load[op] += 1
+            self._last[op] = time.monotonic()
+        return op
+
+    def _choose(self, skip: set) -> Optional[int]:
+        candidates = [op for op in self.operators if op not in skip]
+        if not candidates:
+            return None
+        if self.strategy == "round_robin":
+            for _ in range(len(self.operators)):
+                op = self.operators[self._rr % len(self.operators)]
+                self._rr += 1
+                if op not in skip:
+                    return op
+        # least_open; за рівності — той, хто довше не отримував тредів
+        return min(candidates, key=lambda op: (self._load[op], self._last[op]))
+
+    def release(self, operator_id: int):
+        self._load[operator_id] = max(0, self._load.get(operator_id, 0) - 1)
+
+    def _track(self, t: OpenThread, reserved: bool = False):
+        self._open[t.id] = t
+        self._by_user.setdefault(t.user_id, set()).add(t.id)
+        if not reserved:
+            self._load[t.operator_id] = self._load.get(t.operator_id, 0) + 1
+            self._last[t.operator_id] = time.monotonic()
+
+    def _untrack(self, t: OpenThread):
+        self._open.pop(t.id, None)
+        ids = self._by_user.get(t.user_id)
+        if ids is not None:
+            ids.discard(t.id)
+            if not ids:
+                del self._by_user[t.user_id]
+        self.release(t.operator_id)
+
+    def opened(
+        self, thread_id: int, user_id: int, operator_id: int, kind: str, note: str, reserved: bool = False
+    ):
+        self._track(OpenThread(thread_id, user_id, operator_id, kind, note, time.monotonic()), reserved)
+
+    async def answered(self, user_id: int):
+        await self.answered_many([user_id])
+
+    async def answered_many(self, user_ids: Iterable[int]):
+        # Будь-яка відповідь користувачу закриває всі його відкриті треди
+        uids = list(set(user_ids))
+        for uid in uids:
+            for thread_id in list(self._by_user.get(uid, ())):
+                self._untrack(self._open[thread_id])
+        try:
+            async with db.cursor() as cur:
+                for i in range(0, len(uids), WRITE_BEHIND_CHUNK):
+                    chunk = uids[i:i + WRITE_BEHIND_CHUNK]
+                    await cur.execute(
+                        "UPDATE operator_threads SET answered_at=NOW() "
+                        f"WHERE user_id IN ({','.join(['%s'] * len(chunk))}) AND answered_at IS NULL",
+                        chunk,
+                    )
+        except Exception as e:
+            if spool.enabled and db_down(e):
+                await spool.extend("answered", [{"user_id": uid} for uid in uids])
+                return
+            logger.warning(f"operator_threads answered_at for {len(uids)} users not saved: {e}")
+
+    async def warm(self):
+        async with db.cursor() as cur:
+            await cur.execute(
+                "SELECT id, user_id, question, operator_id, "
+                "TIMESTAMPDIFF(SECOND, COALESCE(assigned_at, created_at), NOW()) AS age "
+                "FROM operator_threads WHERE answered_at IS NULL "
+                "AND created_at >= NOW() - INTERVAL %s DAY ORDER BY id",
+                (OPERATOR_WARM_DAYS,),
+            )
+            rows = await cur.fetchall()
+        now = time.monotonic()
+        for r in rows:
+            if int(r["id"]) in self._open:
+                continue  # уже відкрито цим процесом, поки йшов прогрів
+            op = r["operator_id"]
+            if op is None or int(op) not in self._load:
+                op = ADMIN_ID_PRIMARY
+            question = r.get("question") or ""
+            note = thread_note(
+                f"Звернення від користувача <code>{r['user_id']}</code>\n\n{html.escape(question)}\n\n"
+                "Відповідайте реплаєм на це повідомлення.",
+                int(r["id"]),
+            )
+            self._track(OpenThread(
+                int(r["id"]), int(r["user_id"]), int(op), thread_kind(question), note, now - int(r["age"] or 0)
+            ))
+        if rows:
+            logger.info("Operator queue: %d open threads restored", len(rows))
+
+    def start(self):
+        if self._task is None and self.reassign_after > 0 and len(self.operators) > 1:
+            self._task = asyncio.create_task(self._run(), name="operator-queue")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(OPERATOR_CHECK_EVERY)
+            now = time.monotonic()
+            overdue = [t for t in self._open.values() if now - t.assigned_at >= self.reassign_after]
+            for t in overdue:
+                try:
+                    await self.reassign(t)
+                except Exception as e:
+                    await report_error("operator_reassign", f"thread {t.id}: {e}")
+
+    async def reassign(self, t: OpenThread):
+        op = self.pick(exclude=t.tried)
+        if op is None:
+            # Усі оператори вже бачили тред — більше не пересилаємо
+            t.assigned_at = float("inf")
+            return
+        waited = int((time.monotonic() - t.assigned_at) // 60)
+        try:
+            sent = await bot.send_message(
+                op,
+                f"⏰ <b>Перепризначено</b> (без відповіді {waited} хв)\n\n{t.note}",
+                reply_markup=templates_kb(t.user_id),
+            )
+            await reply_router.remember(op, sent.message_id, t.user_id, t.kind)
+        except BaseException:
+            self.release(op)
+            raise
+        if t.id not in self._open:
+            self.release(op)  # поки йшла відправка, користувачу вже відповіли
+            return
+        self._untrack(t)
+        t.operator_id = op
+        t.assigned_at = time.monotonic()
+        t.tried.add(op)
+        self._track(t, reserved=True)
+        self.reassigned += 1
+        async with db.cursor() as cur:
+            await cur.execute(
+                "UPDATE operator_threads SET operator_id=%s, assigned_at=NOW() WHERE id=%s",
+                (op, t.id),
+            )
+
+    def oldest(self, limit: int = 10) -> List[OpenThread]:
+        return heapq.nsmallest(limit, self._open.values(), key=lambda t: t.id)
+
+operator_queue = OperatorQueue(ADMIN_IDS)
+
+# ------------------------- ДИСПЕТЧЕР ТРЕДІВ --------------------------------
+# Спільний шлях для всіх звернень до оператора: одне службове повідомлення
+# (нотатка + «Швидкі відповіді» в одній клавіатурі), один INSERT одразу з
+# admin_message_id, а відповідь користувачу йде паралельно зі сповіщенням адміна.
+# Після INSERT нотатка доповнюється «Thread #id» — ключем для /bulk_reply.
+
+def thread_note(note: str, thread_id: int) -> str:
+    head, _, rest = note.partition("\n")
+    return f"{head}\nThread #{thread_id}\n{rest}"
+
+async def dispatch_thread(
+    message: types.Message,
+    kind: str,
+    question: str,
+    note: str,
+    answer: str,
+    place: str,
+    before_answer=None,
+    order_no: Optional[str] = None,
+) -> Optional[int]:
+    user_id = message.from_user.id
+    picked = operator_queue.pick()
+    admin_chat = picked or ADMIN_ID_PRIMARY
+    sent_ok = False
+
+    async def notify_admin() -> Optional[int]:
+        nonlocal sent_ok
+        try:
+            sent = await bot.send_message(admin_chat, note, reply_markup=templates_kb(user_id))
+            sent_ok = True
+            reply_router.cache(admin_chat, sent.message_id, user_id, kind)
+            thread_id = await insert_thread(user_id, question, sent.message_id, admin_chat, order_no)
+        except BaseException:
+            if picked is not None:
+                operator_queue.release(picked)
+            raise
+        text = note
+        if thread_id > 0:  # від'ємний — тимчасовий id зі спулу, його не показуємо
+            text = thread_note(note, thread_id)
+            try:
+                await bot.edit_message_text(
+                    text, chat_id=admin_chat, message_id=sent.message_id, reply_markup=templates_kb(user_id)
+                )
+            except Exception as e:
+                logger.warning(f"Thread #{thread_id} note not updated: {e}")
+        operator_queue.opened(thread_id, user_id, admin_chat, kind, text, reserved=picked is not None)
+        stats_counters.bump("threads")
+        return thread_id
+
+    async def answer_user():
+        if before_answer is not None:
+            await before_answer()
+        await message.answer(answer, reply_markup=main_kb(user_id))
+
+    admin_res, user_res = await asyncio.gather(notify_admin(), answer_user(), return_exceptions=True)
+    if isinstance(user_res, Exception):
+        await report_error(f"{place}_answer", str(user_res))
+    if isinstance(admin_res, Exception):
+        await report_error(place, str(admin_res))
+        if not sent_ok:
+            # Оператор звернення не отримав — користувач має про це знати
+            await message.answer("Сталася помилка. Спробуйте пізніше.", reply_markup=main_kb(user_id))
+        return None
+    return admin_res
 
 # ============================== ХЕНДЛЕРИ ===================================
 
 @dp.message(CommandStart())
 async def start(message: types.Message):
-    add_subscriber(message.from_user.id)
+    await add_subscriber(message.from_user.id)
     await message.answer(
         "Вітаємо у магазині Заморські подарунки! Оберіть дію нижче.",
         reply_markup=main_kb(message.from_user.id),
@@ -507,38 +2838,16 @@ async def ask_operator(message: types.Message, state: FSMContext):
 async def got_question(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     text = message.text or ""
+    note = (
+        f"Питання від користувача <code>{user_id}</code>\n\n{html.escape(text)}\n\n"
+        "Відповідайте реплаєм на це повідомлення."
+    )
     try:
-        with db.cursor() as cur:
-            cur.execute(
-                "INSERT INTO operator_threads (user_id, question) VALUES (%s, %s)",
-                (user_id, text),
-            )
-            thread_id = cur.lastrowid
-
-        note = (
-            f"Питання від користувача <code>{user_id}</code>\n"
-            f"Thread #{thread_id}\n\n{text}"
-        )
-        sent = await bot.send_message(
-            ADMIN_ID_PRIMARY,
-            note,
-            reply_markup=ForceReply(input_field_placeholder="Напишіть відповідь користувачу…"),
-        )
-        with db.cursor() as cur:
-            cur.execute(
-                "UPDATE operator_threads SET admin_message_id=%s WHERE id=%s",
-                (sent.message_id, thread_id),
-            )
-        tpl_msg = await bot.send_message(ADMIN_ID_PRIMARY, "Швидкі відповіді:", reply_markup=templates_kb(user_id))
-        reply_alias[tpl_msg.message_id] = (user_id, False)
-
-        await message.answer(
-            "Ваше питання надіслано оператору. Дякуємо за звернення.",
-            reply_markup=main_kb(message.from_user.id),
+        await dispatch_thread(
+            message, "question", text, note,
+            answer="Ваше питання надіслано оператору. Дякуємо за звернення.",
+            place="got_question",
         )
-    except Exception as e:
-        await report_error("got_question", str(e))
-        await message.answer("Сталася помилка. Спробуйте пізніше.")
     finally:
         await state.clear()
 
@@ -556,49 +2865,79 @@ async def stock_start(message: types.Message, state: FSMContext):
 async def stock_got_code(message: types.Message, state: FSMContext):
     code = (message.text or "").strip()
     # Базова валідація коду: 3..32 символи, букви/цифри та - _ / .
-    if not re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9_\-\/.]{2,31}", code):
+    valid = re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9_\-\/.]{2,31}", code) is not None
+    product = catalog.get(code) if catalog.ready else None
+    if product is not None:
+        code = product["sku"]  # написання з каталогу, навіть якщо ввели з пробілами чи кирилицею
+    elif catalog.ready and code != (await state.get_data()).get("suggested_for"):
+        # Коду немає в каталозі — пропонуємо найближчі; повторне введення того самого коду приймаємо як є
+        suggestions = catalog.suggest(code)
+        if suggestions:
+            await state.update_data(suggested_for=code)
+            lines = "\n".join(
+                f"• <code>{html.escape(p['sku'])}</code> — {html.escape(str(p['title']))}" for p in suggestions
+            )
+            await message.answer(
+                f"Код <b>{html.escape(code)}</b> не знайдено в каталозі. Можливо, ви мали на увазі:\n{lines}",
+                reply_markup=sku_suggestions_kb(suggestions, keep=code if valid else None),
+            )
+            return
+    if product is None and not valid:
         await message.answer(
             "Здається, це не схоже на код товару. Спробуйте ще раз (3–32 символи, букви/цифри та - _ / .)."
         )
         return
 
     user_id = message.from_user.id
-    try:
-        # Збережемо тред для оператора
-        with db.cursor() as cur:
-            cur.execute(
-                "INSERT INTO operator_threads (user_id, question) VALUES (%s, %s)",
-                (user_id, f"[STOCK]\nКод: {code}"),
-            )
-            thread_id = cur.lastrowid
+    note = (
+        f"Запит <b>НАЯВНОСТІ</b> від користувача <code>{user_id}</code>\n"
+        f"Код товару: <b>{html.escape(code)}</b>\n\n"
+        "Відповідайте реплаєм статусом/коментарем (можна скористатися швидкими кнопками)."
+    )
 
-        # Надішлемо адміну службове повідомлення + шаблони
-        note = (
-            f"Запит <b>НАЯВНОСТІ</b> від користувача <code>{user_id}</code>\n"
-            f"Код товару: <b>{code}</b>\n"
-            f"Thread #{thread_id}\n\nВідповідайте реплаєм статусом/коментарем (можна скористатися швидкими кнопками)."
-        )
-        sent = await bot.send_message(
-            ADMIN_ID_PRIMARY,
-            note,
-            reply_markup=ForceReply(input_field_placeholder="Вкажіть статус/коментар…"),
+    # Автопідтягування картки товару (для користувача) — паралельно зі сповіщенням оператора
+    async def product_preview():
+        card = product or await fetch_product_by_code(code)
+        if card:
+            await send_product_preview(user_id, card)
+
+    try:
+        await dispatch_thread(
+            message, "stock", f"[STOCK]\nКод: {code}", note,
+            answer="Дякуємо! Перевіримо наявність і відповімо вам незабаром.",
+            place="stock_got_code",
+            before_answer=product_preview,
         )
-        with db.cursor() as cur:
-            cur.execute("UPDATE operator_threads SET admin_message_id=%s WHERE id=%s", (sent.message_id, thread_id))
-        tpl_msg = await bot.send_message(ADMIN_ID_PRIMARY, "Швидкі відповіді:", reply_markup=templates_kb(user_id))
-        reply_alias[tpl_msg.message_id] = (user_id, False)
-
-        # Автопідтягування картки товару (для користувача)
-        product = await fetch_product_by_code(code)
-        if product:
-            await send_product_preview(user_id, product)
-        await message.answer("Дякуємо! Перевіримо наявність і відповімо вам незабаром.", reply_markup=main_kb(user_id))
-    except Exception as e:
-        await report_error("stock_got_code", str(e))
-        await message.answer("Сталася помилка. Спробуйте пізніше.", reply_markup=main_kb(user_id))
     finally:
         await state.clear()
 
+# Inline-режим: @бот <код або назва> — пошук по каталогу в пам'яті, без запитів до БД
+@dp.inline_query()
+async def inline_catalog(query: types.InlineQuery):
+    text = query.query.strip()
+    if not catalog.ready or len(text) < 2:
+        await query.answer([], cache_time=5)
+        return
+    results = []
+    for p in catalog.search(text, CATALOG_INLINE_LIMIT):
+        price = f"Ціна: {p['price']}" if p["price"] not in (None, "") else ""
+        body = f"<b>{html.escape(str(p['title']))}</b>\nКод: <code>{html.escape(p['sku'])}</code>"
+        if price:
+            body += f"\n{price}"
+        if p["url"]:
+            body += f"\n{p['url']}"
+        results.append(
+            InlineQueryResultArticle(
+                id=normalize_sku(p["sku"])[:64] or "0",
+                title=str(p["title"]),
+                description=" • ".join(x for x in (p["sku"], price) if x),
+                input_message_content=InputTextMessageContent(message_text=body),
+                url=p["url"] or None,
+                thumbnail_url=p["image_url"] or None,
+            )
+        )
+    await query.answer(results, cache_time=CATALOG_INLINE_CACHE)
+
 # ----------------------- Запит ТТН -----------------------------------------
 
 @dp.message(F.text == "Запитати ТТН по замовленню")
@@ -618,35 +2957,18 @@ async def ttn_order(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     name = data.get("ttn_name", "-")
     order_no = (message.text or "").strip()
-
+    note = (
+        f"Запит ТТН від користувача <code>{user_id}</code>\n"
+        f"ПІБ: <b>{html.escape(name)}</b>\nЗамовлення: <b>{html.escape(order_no)}</b>\n\n"
+        "Відповідайте реплаєм: вкажіть номер ТТН (14 цифр)."
+    )
     try:
-        with db.cursor() as cur:
-            cur.execute(
-                "INSERT INTO operator_threads (user_id, question) VALUES (%s, %s)",
-                (user_id, f"[TTN]\nПІБ: {name}\nЗамовлення: {order_no}"),
-            )
-            thread_id = cur.lastrowid
-
-        note = (
-            f"Запит ТТН від користувача <code>{user_id}</code>\n"
-            f"ПІБ: <b>{name}</b>\nЗамовлення: <b>{order_no}</b>\n"
-            f"Thread #{thread_id}\n\nВідповідайте реплаєм: вкажіть номер ТТН (14 цифр)."
-        )
-        sent = await bot.send_message(
-            ADMIN_ID_PRIMARY,
-            note,
-            reply_markup=ForceReply(input_field_placeholder="Введіть ТТН або відповідь…"),
+        await dispatch_thread(
+            message, "ttn", f"[TTN]\nПІБ: {name}\nЗамовлення: {order_no}", note,
+            answer="Дякуємо! Ми перевіримо ТТН і надішлемо вам відповідь.",
+            place="ttn_order",
+            order_no=order_no,
         )
-        with db.cursor() as cur:
-            cur.execute("UPDATE operator_threads SET admin_message_id=%s WHERE id=%s", (sent.message_id, thread_id))
-
-        tpl_msg = await bot.send_message(ADMIN_ID_PRIMARY, "Швидкі відповіді:", reply_markup=templates_kb(user_id))
-        reply_alias[tpl_msg.message_id] = (user_id, True)
-
-        await message.answer("Дякуємо! Ми перевіримо ТТН і надішлемо вам відповідь.", reply_markup=main_kb(user_id))
-    except Exception as e:
-        await report_error("ttn_order", str(e))
-        await message.answer("Сталася помилка. Спробуйте пізніше.", reply_markup=main_kb(user_id))
     finally:
         await state.clear()
 
@@ -669,35 +2991,18 @@ async def bill_order(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     name = data.get("bill_name", "-")
     order_no = (message.text or "").strip()
-
+    note = (
+        f"Запит РАХУНКУ від користувача <code>{user_id}</code>\n"
+        f"ПІБ: <b>{html.escape(name)}</b>\nЗамовлення: <b>{html.escape(order_no)}</b>\n\n"
+        "Надішліть реквізити/рахунок у reply на це повідомлення."
+    )
     try:
-        with db.cursor() as cur:
-            cur.execute(
-                "INSERT INTO operator_threads (user_id, question) VALUES (%s, %s)",
-                (user_id, f"[BILL]\nПІБ: {name}\nЗамовлення: {order_no}"),
-            )
-            thread_id = cur.lastrowid
-
-        note = (
-            f"Запит РАХУНКУ від користувача <code>{user_id}</code>\n"
-            f"ПІБ: <b>{name}</b>\nЗамовлення: <b>{order_no}</b>\n"
-            f"Thread #{thread_id}\n\nНадішліть реквізити/рахунок у цьому reply."
-        )
-        sent = await bot.send_message(
-            ADMIN_ID_PRIMARY,
-            note,
-            reply_markup=ForceReply(input_field_placeholder="Надішліть реквізити/рахунок…"),
+        await dispatch_thread(
+            message, "bill", f"[BILL]\nПІБ: {name}\nЗамовлення: {order_no}", note,
+            answer="Дякуємо! Надішлемо вам реквізити для оплати.",
+            place="bill_order",
+            order_no=order_no,
         )
-        with db.cursor() as cur:
-            cur.execute("UPDATE operator_threads SET admin_message_id=%s WHERE id=%s", (sent.message_id, thread_id))
-
-        tpl_msg = await bot.send_message(ADMIN_ID_PRIMARY, "Швидкі відповіді:", reply_markup=templates_kb(user_id))
-        reply_alias[tpl_msg.message_id] = (user_id, False)
-
-        await message.answer("Дякуємо! Надішлемо вам реквізити для оплати.", reply_markup=main_kb(user_id))
-    except Exception as e:
-        await report_error("bill_order", str(e))
-        await message.answer("Сталася помилка. Спробуйте пізніше.", reply_markup=main_kb(user_id))
     finally:
         await state.clear()
 
@@ -712,6 +3017,7 @@ async def template_send(cb: types.CallbackQuery):
         if not text:
             await cb.answer("Невідомий шаблон", show_alert=True); return
         await bot.send_message(uid, text, reply_markup=main_kb(uid))
+        await operator_queue.answered(uid)
         await cb.answer("Надіслано")
     except Exception as e:
         await report_error("template_send", str(e))
@@ -724,28 +3030,12 @@ async def admin_reply_to_service(message: types.Message):
         return
     admin_msg_id = message.reply_to_message.message_id
     try:
-        uid: Optional[int] = None
-        is_ttn_thread = False
-        qtext = ""
-
-        with db.cursor() as cur:
-            cur.execute(
-                "SELECT user_id, question FROM operator_threads "
-                "WHERE admin_message_id=%s ORDER BY id DESC LIMIT 1",
-                (admin_msg_id,),
-            )
-            row = cur.fetchone()
-        if row:
-            uid = int(row["user_id"])
-            qtext = row.get("question") or ""
-            is_ttn_thread = "[TTN]" in qtext
-
-        if uid is None and admin_msg_id in reply_alias:
-            uid, is_ttn_thread = reply_alias[admin_msg_id]
-
-        if uid is None:
+        route = await reply_router.resolve(message.chat.id, admin_msg_id)
+        if route is None:
             await message.reply("Не вдалося визначити одержувача (не reply на службове).")
             return
+        uid, kind = route
+        is_ttn_thread = kind == "ttn"
 
         ttn = extract_ttn(message.text or message.caption or "")
 
@@ -754,21 +3044,11 @@ async def admin_reply_to_service(message: types.Message):
                 "Це запит ТТН: номер має містити 14 цифр. Будь ласка, введіть правильний ТТН.",
                 reply_markup=ForceReply(input_field_placeholder="Вкажіть номер ТТН (14 цифр)"),
             )
-            reply_alias[warn.message_id] = (uid, True)
+            await reply_router.remember(message.chat.id, warn.message_id, uid, "ttn")
             return
 
         if ttn:
-            rest = (message.text or message.caption or "")
-            rest = re.sub(re.escape(ttn), "", rest).strip()
-            text_out = f"Ваша ТТН Нової пошти: <code>{ttn}</code>"
-            if rest:
-                text_out += f"\n{rest}"
-            await bot.send_message(uid, text_out, reply_markup=tracking_kb(ttn))
-            await bot.send_message(
-                uid,
-                "Якщо маєте ще питання — натисніть «Питання оператору».",
-                reply_markup=main_kb(uid),
-            )
+            await deliver_answer(uid, message.text or message.caption or "")
         else:
             if message.photo:
                 await bot.send_photo(
@@ -778,6 +3058,7 @@ async def admin_reply_to_service(message: types.Message):
             else:
                 await bot.send_message(uid, message.text or "", reply_markup=main_kb(uid))
 
+        await operator_queue.answered(uid)
         await message.reply("Надіслано користувачу")
     except TelegramForbiddenError:
         await message.reply("Користувач заблокував бота або недоступний")
@@ -785,6 +3066,32 @@ async def admin_reply_to_service(message: types.Message):
         await report_error("admin_reply_to_service", str(e))
         await message.reply(f"Помилка відправки: {e}")
 
+def answer_parts(uid: int, txt: str) -> List[Tuple[str, Any]]:
+    # Текстова відповідь оператора; ТТН оформлюється окремим повідомленням із кнопкою трекінгу
+    ttn = extract_ttn(txt)
+    if ttn:
+        rest = re.sub(re.escape(ttn), "", txt).strip()
+        text_out = f"Ваша ТТН Нової пошти: <code>{ttn}</code>"
+        if rest:
+            text_out += f"\n{rest}"
+        return [
+            (text_out, tracking_kb(ttn)),
+            ("Якщо маєте ще питання — натисніть «Питання оператору».", main_kb(uid)),
+        ]
+    return [(txt, main_kb(uid))]
+
+async def deliver_answer(uid: int, txt: str, before_send=None, progress: Optional[List[int]] = None):
+    # before_send — хук перед кожною відправкою (напр. спільний ліміт темпу);
+    # progress — [скільки частин уже надіслано]: повтор після збою не дублює перші частини
+    progress = progress if progress is not None else [0]
+    parts = answer_parts(uid, txt)
+    while progress[0] < len(parts):
+        text_out, kb = parts[progress[0]]
+        if before_send:
+            await before_send()
+        await bot.send_message(uid, text_out, reply_markup=kb)
+        progress[0] += 1
+
 # 2) АЛЬТЕРНАТИВА: /reply <user_id> <текст>
 @dp.message(Command("reply"))
 async def reply_cmd(message: types.Message):
@@ -798,21 +3105,53 @@ async def reply_cmd(message: types.Message):
     uid = int(parts[1])
     txt = parts[2]
     try:
-        ttn = extract_ttn(txt)
-        if ttn:
-            rest = re.sub(re.escape(ttn), "", txt).strip()
-            text_out = f"Ваша ТТН Нової пошти: <code>{ttn}</code>"
-            if rest:
-                text_out += f"\n{rest}"
-            await bot.send_message(uid, text_out, reply_markup=tracking_kb(ttn))
-            await bot.send_message(uid, "Якщо маєте ще питання — натисніть «Питання оператору».", reply_markup=main_kb(uid))
-        else:
-            await bot.send_message(uid, txt, reply_markup=main_kb(uid))
+        await deliver_answer(uid, txt)
+        await operator_queue.answered(uid)
         await message.reply("Надіслано користувачу")
     except Exception as e:
         await report_error("reply_cmd", str(e))
         await message.reply(f"Помилка відправки: {e}")
 
+# Черга операторів: хто скільки тредів тримає і хто чекає найдовше
+@dp.message(Command("queue"))
+async def queue_cmd(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        async with db.cursor() as cur:
+            await cur.execute(
+                "SELECT operator_id, COUNT(*) AS c, "
+                "TIMESTAMPDIFF(MINUTE, MIN(created_at), NOW()) AS oldest_min "
+                "FROM operator_threads WHERE answered_at IS NULL "
+                "AND created_at >= NOW() - INTERVAL %s DAY GROUP BY operator_id",
+                (OPERATOR_WARM_DAYS,),
+            )
+            rows = {r["operator_id"]: r for r in await cur.fetchall()}
+        lines = [f"📥 <b>Черга операторів</b> ({OPERATOR_STRATEGY})"]
+        total = 0
+        for op in operator_queue.operators:
+            r = rows.get(op)
+            cnt = int(r["c"]) if r else 0
+            total += cnt
+            oldest = f", найстаріший {int(r['oldest_min'])} хв" if r else ""
+            lines.append(f"• <code>{op}</code>: {cnt} відкритих{oldest}")
+        unassigned = rows.get(None)
+        if unassigned:
+            total += int(unassigned["c"])
+            lines.append(f"• без оператора: {unassigned['c']}")
+        lines.append(f"Всього відкритих: <b>{total}</b> • перепризначено: {operator_queue.reassigned}")
+        waiting = operator_queue.oldest(10)
+        if waiting:
+            now = time.monotonic()
+            lines.append("\nНайдовше чекають:")
+            for t in waiting:
+                mins = int((now - t.assigned_at) // 60) if t.assigned_at != float("inf") else "—"
+                lines.append(f"#{t.id} [{t.kind}] user <code>{t.user_id}</code> → <code>{t.operator_id}</code>, {mins} хв")
+        await message.answer("\n".join(lines))
+    except Exception as e:
+        await report_error("queue_cmd", str(e))
+        await message.answer("Не вдалося отримати чергу.")
+
 # 3) РОЗСИЛКА (кнопка)
 @dp.message(F.text == "Зробити розсилку")
 async def start_broadcast(message: types.Message, state: FSMContext):
@@ -823,93 +3162,1663 @@ async def start_broadcast(message: types.Message, state: FSMContext):
 
 # =========================== РОЗСИЛКА (АДМІН) =============================
 
+# /broadcast [сегмент] — розсилка частині аудиторії; без параметрів — усім
+@dp.message(Command("broadcast"))
+async def broadcast_cmd(message: types.Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        segment = Segment((message.text or "").split()[1:])
+    except ValueError as e:
+        await message.answer(f"Некоректний сегмент: {e}\nФормат: /broadcast [{SEGMENT_HELP}]")
+        return
+    try:
+        total = await count_segment(segment)
+    except Exception as e:
+        await report_error("broadcast_cmd", str(e))
+        await message.answer("Не вдалося порахувати аудиторію.")
+        return
+    if not total:
+        await message.answer(f"У сегменті «{html.escape(segment.describe())}» немає підписників.")
+        return
+    await state.set_state(SendBroadcast.waiting_content)
+    await state.update_data(segment=segment.spec)
+    await message.answer(
+        f"🎯 {html.escape(segment.describe())}: <b>{total}</b> одержувачів.\n"
+        "Надішліть текст або фото з підписом для розсилки.",
+        reply_markup=back_kb(),
+    )
+
 @dp.message(SendBroadcast.waiting_content, F.photo)
 async def broadcast_photo(message: types.Message, state: FSMContext):
-    await do_broadcast(photo_id=message.photo[-1].file_id, caption=message.caption or "")
+    data = await state.get_data()
     await state.clear()
-    await message.answer("Розсилку завершено ✅", reply_markup=main_kb(message.from_user.id))
+    await launch_broadcast(
+        message,
+        data.get("segment", ""),
+        photo_id=message.photo[-1].file_id,
+        caption=message.caption or "",
+    )
 
 @dp.message(SendBroadcast.waiting_content)
 async def broadcast_text(message: types.Message, state: FSMContext):
-    await do_broadcast(text=message.text or "")
+    data = await state.get_data()
     await state.clear()
-    await message.answer("Розсилку завершено ✅", reply_markup=main_kb(message.from_user.id))
+    await launch_broadcast(message, data.get("segment", ""), text=message.text or "")
 
-async def do_broadcast(text: str = "", photo_id: Optional[str] = None, caption: str = ""):
-    users = get_all_subscribers()
-    ok = 0
-    blocked = 0
-    for uid in users:
-        try:
-            if photo_id:
-                await bot.send_photo(uid, photo_id, caption=caption)
-            else:
-                await bot.send_message(uid, text)
-            ok += 1
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after + 1); continue
-        except (TelegramForbiddenError, TelegramBadRequest):
-            blocked += 1; remove_subscriber(uid)
-        except Exception as e:
-            await report_error("broadcast_loop", f"{uid}: {e}")
-        await asyncio.sleep(0.05)
+async def launch_broadcast(message: types.Message, segment_spec: str = "", **content):
     try:
-        await bot.send_message(ADMIN_ID_PRIMARY, f"Розсилка завершена. Успішно: {ok}, видалено зі списку: {blocked}.")
-    except Exception:
-        pass
-
+        job_id, total = await do_broadcast(
+            report_chat_id=message.chat.id,
+            created_by=message.from_user.id,
+            segment=Segment(segment_spec.split()),
+            **content,
+        )
+    except Exception as e:
+        await report_error("launch_broadcast", str(e))
+        await message.answer("Не вдалося запустити розсилку.", reply_markup=main_kb(message.from_user.id))
+        return
+    await message.answer(
+        f"Розсилку #{job_id} запущено ✅ Одержувачів: {total}.\n"
+        "Статус: /broadcast_status, скасувати: /broadcast_cancel",
+        reply_markup=main_kb(message.from_user.id),
+    )
+
+# =========================== РОЗСИЛКА: ДВИГУН =============================
+
+BROADCAST_RATE = env_float("BROADCAST_RATE", 28.0)                 # повідомлень/с (ліміт Telegram ~30)
+BROADCAST_CONCURRENCY = env_int("BROADCAST_CONCURRENCY", 16)       # одночасних відправок
+BROADCAST_MAX_RETRIES = env_int("BROADCAST_MAX_RETRIES", 5)        # повторів на одного одержувача
+BROADCAST_PROGRESS_EVERY = env_float("BROADCAST_PROGRESS_EVERY", 5.0)  # с між оновленнями прогресу
+BROADCAST_ABORT_AFTER = env_int("BROADCAST_ABORT_AFTER", 20)       # однакових BadRequest поспіль до зупинки
+
+class TokenBucket:
+    # Глобальний ліміт темпу. На RetryAfter — пауза для всіх воркерів і
+    # мультиплікативне зниження темпу; кожна успішна відправка потроху його відновлює.
+    def __init__(self, rate: float, capacity: float = 1.0, min_rate: float = 1.0):
+        self.max_rate = max(min_rate, rate)
+        self.rate = self.max_rate
+        self.min_rate = min_rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._ts = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+    def penalize(self, retry_after: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._tokens = 0.0
+        self.rate = max(self.min_rate, self.rate * 0.7)
+
+    def reward(self):
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + 0.05)
+
+class BroadcastStats:
+    def __init__(self, total: int, ok: int = 0, blocked: int = 0, failed: int = 0):
+        self.total = total
+        self.ok = ok
+        self.blocked = blocked
+        self.failed = failed
+        self.retries = 0
+        self.started = time.monotonic()
+        self._base = self.done  # уже доставлене до (від)новлення задачі
+        self._sample = (self.started, self.done)  # (час, done) останнього заміру для «живого» темпу
+
+    @property
+    def done(self) -> int:
+        return self.ok + self.blocked + self.failed
+
+    def throughput(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return (self.done - self._base) / elapsed if elapsed > 0 else 0.0
+
+    def live_throughput(self) -> float:
+        now, done = time.monotonic(), self.done
+        t0, d0 = self._sample
+        self._sample = (now, done)
+        return (done - d0) / (now - t0) if now > t0 else 0.0
+
+    def eta(self, rate: Optional[float] = None) -> Optional[float]:
+        rate = self.throughput() if rate is None else rate
+        if rate <= 0:
+            return None
+        return max(0, self.total - self.done) / rate
+
+    def render(self, title: str = "Розсилка") -> str:
+        pct = (self.done * 100 / self.total) if self.total else 100.0
+        live = self.live_throughput()
+        eta = self.eta(live or None)
+        eta_txt = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None else "—"
+        return (
+            f"📣 <b>{title}</b>: {self.done}/{self.total} ({pct:.1f}%)\n"
+            f"⚡ {live:.1f} повід./с (сер. {self.throughput():.1f}) • ETA {eta_txt}\n"
+            f"✅ {self.ok} • 🚫 {self.blocked} • ⚠️ {self.failed} • 🔁 {self.retries}"
+        )
+
+class BroadcastAborted(Exception):
+    pass
+
+class BroadcastEngine:
+    # Обмежена конкурентність + спільний TokenBucket. Одержувача, на якому
+    # спрацював RetryAfter або мережевий збій, повторюємо, а не пропускаємо.
+    # «Заблокований» — лише Forbidden або «chat not found»; інший BadRequest —
+    # це вада самого повідомлення (HTML, photo_id), тож однаковий BadRequest
+    # поспіль на BROADCAST_ABORT_AFTER одержувачах зупиняє розсилку.
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = BROADCAST_RATE,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        max_retries: int = BROADCAST_MAX_RETRIES,
+        unsubscribe: bool = True,
+        abort_after: int = BROADCAST_ABORT_AFTER,
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max(0, max_retries)
+        self.unsubscribe = unsubscribe
+        self.abort_after = abort_after
+        self.errors: Dict[int, str] = {}  # uid -> текст помилки для "failed"
+        self._bad: Tuple[str, int] = ("", 0)
+
+    def _blocked(self, uid: int) -> str:
+        if self.unsubscribe:
+            write_behind.remove_subscriber(uid)
+        return "blocked"
+
+    def _bad_request(self, uid: int, e: TelegramBadRequest) -> str:
+        msg, n = self._bad
+        n = n + 1 if e.message == msg else 1
+        self._bad = (e.message, n)
+        if self.abort_after and n >= self.abort_after:
+            raise BroadcastAborted(f"{n} одержувачів поспіль: {e.message}")
+        self.errors[uid] = e.message
+        return "failed"
+
+    async def _deliver(self, uid: int, send, stats: BroadcastStats) -> str:
+        failures = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await send(uid)
+                self.bucket.reward()
+                self._bad = ("", 0)
+                return "ok"
+            except TelegramRetryAfter as e:
+                # Флуд-контроль — не вина одержувача, тож ліміт повторів не витрачаємо
+                self.bucket.penalize(e.retry_after + 1)
+                logger.warning("Broadcast RetryAfter %ss, rate -> %.1f/s", e.retry_after, self.bucket.rate)
+            except TelegramForbiddenError:
+                return self._blocked(uid)
+            except TelegramBadRequest as e:
+                if "chat not found" in e.message.lower():
+                    return self._blocked(uid)
+                return self._bad_request(uid, e)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                failures += 1
+                if failures > self.max_retries:
+                    await report_error("broadcast_loop", f"{uid}: {e}")
+                    self.errors[uid] = str(e)
+                    return "failed"
+                await asyncio.sleep(min(30.0, 2 ** failures))
+            except Exception as e:
+                await report_error("broadcast_loop", f"{uid}: {e}")
+                self.errors[uid] = str(e)
+                return "failed"
+            stats.retries += 1
+
+    async def run(
+        self,
+        recipients: Iterable[int] | AsyncIterable[int],
+        send,
+        on_progress=None,
+        on_result=None,
+        stats: Optional[BroadcastStats] = None,
+    ) -> BroadcastStats:
+        if stats is None:
+            stats = BroadcastStats(len(recipients) if isinstance(recipients, (list, tuple)) else 0)
+        # Обмежена черга: одержувачі підтягуються з джерела порціями, а не всі одразу
+        queue: asyncio.Queue[Optional[int]] = asyncio.Queue(maxsize=self.concurrency * 4)
+
+        async def producer():
+            if hasattr(recipients, "__aiter__"):
+                async for uid in recipients:
+                    await queue.put(uid)
+            else:
+                for uid in recipients:
+                    await queue.put(uid)
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def worker():
+            while True:
+                uid = await queue.get()
+                if uid is None:
+                    return
+                outcome = await self._deliver(uid, send, stats)
+                if outcome == "ok":
+                    stats.ok += 1
+                elif outcome == "blocked":
+                    stats.blocked += 1
+                else:
+                    stats.failed += 1
+                if on_result:
+                    await on_result(uid, outcome)
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(BROADCAST_PROGRESS_EVERY)
+                await on_progress(stats)
+
+        tasks = [asyncio.create_task(producer())]
+        tasks += [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        if on_progress:
+            tasks.append(asyncio.create_task(reporter()))
+        try:
+            await asyncio.gather(*tasks[: self.concurrency + 1])
+        finally:
+            for t in tasks:
+                t.cancel()
+        if on_progress:
+            await on_progress(stats)
+        return stats
+
+# ===================== РОЗСИЛКА: ЗАДАЧІ З ЧЕКПОІНТАМИ =======================
+# Розсилка — це рядок у broadcast_jobs + стан кожного одержувача у
+# broadcast_recipients. Статуси пишемо пачками, тож після рестарту задача
+# продовжується з pending-одержувачів (повтор можливий лише для останньої пачки).
+
+BROADCAST_PAGE = env_int("BROADCAST_PAGE", 1000)                        # одержувачів на вибірку
+BROADCAST_FILL_PAGE = env_int("BROADCAST_FILL_PAGE", 10000)             # рядків на один INSERT ... SELECT
+BROADCAST_CHECKPOINT_BATCH = env_int("BROADCAST_CHECKPOINT_BATCH", 500)  # статусів на один запис
+BROADCAST_CHECKPOINT_EVERY = env_float("BROADCAST_CHECKPOINT_EVERY", 5.0)
+
+RCPT_PENDING, RCPT_OK, RCPT_BLOCKED, RCPT_FAILED = 0, 1, 2, 3
+_RCPT_CODE = {"ok": RCPT_OK, "blocked": RCPT_BLOCKED, "failed": RCPT_FAILED}
+
+# job_id -> задача/живий прогрес, що виконуються в цьому процесі
+broadcast_tasks: Dict[int, asyncio.Task] = {}
+broadcast_progress: Dict[int, BroadcastStats] = {}
+
+async def create_broadcast_job(
+    text: str = "",
+    photo_id: Optional[str] = None,
+    caption: str = "",
+    created_by: Optional[int] = None,
+    report_chat_id: Optional[int] = None,
+    segment: Optional[Segment] = None,
+) -> Tuple[int, int]:
+    segment = segment or Segment()
+    # 'filling', доки список одержувачів не зафіксовано повністю: обірване заповнення
+    # не стане 'running' з половиною аудиторії, а дозаповниться при наступному старті
+    async with db.cursor() as cur:
+        await cur.execute(
+            "INSERT INTO broadcast_jobs (status, text, photo_id, caption, created_by, report_chat_id, segment) "
+            "VALUES ('filling', %s, %s, %s, %s, %s, %s)",
+            (text, photo_id, caption, created_by, report_chat_id, segment.spec or None),
+        )
+        job_id = cur.lastrowid
+    try:
+        total = await fill_broadcast_recipients(job_id, segment)
+    except Exception:
+        # Адмін бачить помилку й може повторити — тож цю задачу не дозаповнюємо
+        try:
+            await set_broadcast_job_status(job_id, "cancelled")
+        except Exception:
+            pass
+        raise
+    return job_id, total
+
+async def fill_broadcast_recipients(job_id: int, segment: Segment) -> int:
+    # Список одержувачів фіксуємо на боці MySQL: INSERT ... SELECT сторінками
+    # по первинному ключу, щоб не тримати довгих блокувань на subscribers.
+    # Продовжує з останнього вставленого user_id — тож годиться і для дозаповнення
+    async with db.cursor() as cur:
+        await cur.execute("SELECT MAX(user_id) AS m FROM broadcast_recipients WHERE job_id=%s", (job_id,))
+        row = await cur.fetchone()
+        last = int(row["m"]) if row and row["m"] is not None else -(2 ** 63)
+        while True:
+            n = await cur.execute(
+                "INSERT IGNORE INTO broadcast_recipients (job_id, user_id) "
+                f"SELECT %s, s.user_id FROM subscribers s WHERE s.user_id > %s{segment.cond} "
+                "ORDER BY s.user_id LIMIT %s",
+                (job_id, last, *segment.args, BROADCAST_FILL_PAGE),
+            )
+            if n < BROADCAST_FILL_PAGE:
+                break
+            await cur.execute("SELECT MAX(user_id) AS m FROM broadcast_recipients WHERE job_id=%s", (job_id,))
+            last = int((await cur.fetchone())["m"])
+        await cur.execute("SELECT COUNT(*) AS c FROM broadcast_recipients WHERE job_id=%s", (job_id,))
+        total = int((await cur.fetchone())["c"])
+        await cur.execute(
+            "UPDATE broadcast_jobs SET total=%s, status='running' WHERE id=%s AND status='filling'",
+            (total, job_id),
+        )
+    return total
+
+async def get_broadcast_job(job_id: int) -> Optional[dict]:
+    async with db.cursor() as cur:
+        await cur.execute("SELECT * FROM broadcast_jobs WHERE id=%s", (job_id,))
+        return await cur.fetchone()
+
+async def set_broadcast_job_status(job_id: int, status: str) -> None:
+    async with db.cursor() as cur:
+        await cur.execute(
+            "UPDATE broadcast_jobs SET status=%s, "
+            "finished_at=IF(%s IN ('done', 'cancelled', 'aborted'), NOW(), finished_at) WHERE id=%s",
+            (status, status, job_id),
+        )
+
+async def iter_pending_recipients(job_id: int, page: int = BROADCAST_PAGE) -> AsyncIterator[int]:
+    last = 0
+    while True:
+        async with db.cursor() as cur:
+            await cur.execute(
+                "SELECT user_id FROM broadcast_recipients "
+                "WHERE job_id=%s AND status=%s AND user_id > %s ORDER BY user_id LIMIT %s",
+                (job_id, RCPT_PENDING, last, page),
+            )
+            rows = await cur.fetchall()
+        if not rows:
+            return
+        for r in rows:
+            yield int(r["user_id"])
+        last = int(rows[-1]["user_id"])
+
+class BroadcastCheckpoint:
+    # Накопичує результати доставки й пише їх пачкою: по одному UPDATE на
+    # кожен статус + інкремент лічильників задачі.
+    def __init__(self, job_id: int, batch: int = BROADCAST_CHECKPOINT_BATCH):
+        self.job_id = job_id
+        self.batch = max(1, batch)
+        self._buf: List[Tuple[int, int]] = []
+        self._lock = asyncio.Lock()
+
+    async def add(self, uid: int, outcome: str):
+        self._buf.append((uid, _RCPT_CODE.get(outcome, RCPT_FAILED)))
+        if len(self._buf) >= self.batch:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buf:
+                return
+            buf, self._buf = self._buf, []
+            by_code: Dict[int, List[int]] = {}
+            for uid, code in buf:
+                by_code.setdefault(code, []).append(uid)
+            try:
+                async with db.cursor() as cur:
+                    for code, uids in by_code.items():
+                        await cur.execute(
+                            "UPDATE broadcast_recipients SET status=%s "
+                            f"WHERE job_id=%s AND user_id IN ({','.join(['%s'] * len(uids))})",
+                            (code, self.job_id, *uids),
+                        )
+                    await cur.execute(
+                        "UPDATE broadcast_jobs SET ok=ok+%s, blocked=blocked+%s, failed=failed+%s WHERE id=%s",
+                        (
+                            len(by_code.get(RCPT_OK, ())),
+                            len(by_code.get(RCPT_BLOCKED, ())),
+                            len(by_code.get(RCPT_FAILED, ())),
+                            self.job_id,
+                        ),
+                    )
+            except Exception as e:
+                self._buf[:0] = buf  # спробуємо записати разом із наступною пачкою
+                logger.warning(f"Broadcast #{self.job_id} checkpoint failed: {e}")
+
+async def run_broadcast_job(job_id: int):
+    job = await get_broadcast_job(job_id)
+    if not job or job["status"] != "running":
+        return
+    photo_id = job.get("photo_id")
+    text = job.get("text") or ""
+    caption = job.get("caption") or ""
+    report_chat_id = job.get("report_chat_id") or ADMIN_ID_PRIMARY
+
+    stats = BroadcastStats(int(job["total"]), int(job["ok"]), int(job["blocked"]), int(job["failed"]))
+    broadcast_progress[job_id] = stats
+    title = f"Розсилка #{job_id}"
+
+    async def send(uid: int):
+        if photo_id:
+            await bot.send_photo(uid, photo_id, caption=caption)
+        else:
+            await bot.send_message(uid, text)
+
+    progress_msg: Optional[types.Message] = None
+    try:
+        progress_msg = await bot.send_message(report_chat_id, stats.render(title))
+    except Exception as e:
+        logger.warning(f"Broadcast progress message failed: {e}")
+
+    async def on_progress(st: BroadcastStats):
+        if progress_msg is None:
+            return
+        try:
+            await bot.edit_message_text(
+                st.render(title), chat_id=progress_msg.chat.id, message_id=progress_msg.message_id
+            )
+        except TelegramBadRequest:
+            pass  # "message is not modified"
+        except Exception as e:
+            logger.warning(f"Broadcast progress update failed: {e}")
+
+    checkpoint = BroadcastCheckpoint(job_id)
+
+    async def ticker():
+        while True:
+            await asyncio.sleep(BROADCAST_CHECKPOINT_EVERY)
+            await checkpoint.flush()
+
+    tick = asyncio.create_task(ticker())
+    aborted: Optional[str] = None
+    try:
+        await BroadcastEngine(bot).run(
+            iter_pending_recipients(job_id), send, on_progress, checkpoint.add, stats
+        )
+    except BroadcastAborted as e:
+        aborted = str(e)
+    finally:
+        tick.cancel()
+        await checkpoint.flush()
+        broadcast_progress.pop(job_id, None)
+
+    job = await get_broadcast_job(job_id)
+    if job and job["status"] == "running":
+        await set_broadcast_job_status(job_id, "aborted" if aborted else "done")
+    logger.info(
+        "Broadcast #%d %s: ok=%d blocked=%d failed=%d retries=%d in %.1fs",
+        job_id, "aborted" if aborted else "done", stats.ok, stats.blocked, stats.failed, stats.retries,
+        time.monotonic() - stats.started,
+    )
+    if aborted:
+        await report_error("broadcast_aborted", f"#{job_id}: {aborted}")
+        summary = (
+            f"⛔️ Розсилку #{job_id} зупинено: Telegram відхиляє саме повідомлення "
+            f"({html.escape(aborted)}). Перевірте текст/фото; підписників не видалено. "
+            f"Успішно: {stats.ok}, решта одержувачів не отримала розсилку."
+        )
+    else:
+        summary = (
+            f"Розсилка #{job_id} завершена. Успішно: {stats.ok}, видалено зі списку: {stats.blocked}, "
+            f"помилок: {stats.failed}."
+        )
+    try:
+        await bot.send_message(report_chat_id, summary)
+    except Exception:
+        pass
+
+def start_broadcast_job(job_id: int) -> asyncio.Task:
+    task = asyncio.create_task(run_broadcast_job(job_id), name=f"broadcast-{job_id}")
+    broadcast_tasks[job_id] = task
+
+    def _done(t: asyncio.Task):
+        broadcast_tasks.pop(job_id, None)
+        if not t.cancelled() and t.exception():
+            logger.error("Broadcast #%d crashed: %s", job_id, t.exception())
+
+    task.add_done_callback(_done)
+    return task
+
+async def resume_broadcast_jobs():
+    async with db.cursor() as cur:
+        await cur.execute("SELECT id, segment FROM broadcast_jobs WHERE status='filling' ORDER BY id")
+        filling = await cur.fetchall()
+    for r in filling:
+        # Процес упав посеред заповнення — дозаповнюємо, а вже потім розсилаємо
+        logger.warning("Broadcast #%d was interrupted while filling recipients, refilling", r["id"])
+        try:
+            await fill_broadcast_recipients(int(r["id"]), Segment((r["segment"] or "").split()))
+        except ValueError as e:
+            await set_broadcast_job_status(int(r["id"]), "cancelled")
+            await report_error("broadcast_refill", f"#{r['id']}: {e}")
+    async with db.cursor() as cur:
+        await cur.execute("SELECT id FROM broadcast_jobs WHERE status='running' ORDER BY id")
+        rows = await cur.fetchall()
+    for r in rows:
+        logger.info("Resuming broadcast #%d", r["id"])
+        start_broadcast_job(int(r["id"]))
+
+async def stop_broadcast_jobs():
+    # Зупинка процесу: задачі лишаються 'running' і продовжаться при наступному старті
+    tasks = list(broadcast_tasks.values())
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def do_broadcast(
+    text: str = "",
+    photo_id: Optional[str] = None,
+    caption: str = "",
+    report_chat_id: Optional[int] = None,
+    created_by: Optional[int] = None,
+    segment: Optional[Segment] = None,
+) -> Tuple[int, int]:
+    job_id, total = await create_broadcast_job(
+        text=text,
+        photo_id=photo_id,
+        caption=caption,
+        created_by=created_by,
+        report_chat_id=report_chat_id or ADMIN_ID_PRIMARY,
+        segment=segment,
+    )
+    start_broadcast_job(job_id)
+    return job_id, total
+
+@dp.message(Command("broadcast_status"))
+async def broadcast_status(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    try:
+        async with db.cursor() as cur:
+            await cur.execute("SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT 5")
+            jobs = await cur.fetchall()
+        if not jobs:
+            await message.answer("Розсилок ще не було.")
+            return
+        blocks = []
+        for job in jobs:
+            job_id = int(job["id"])
+            live = broadcast_progress.get(job_id)
+            if live:
+                blocks.append(live.render(f"Розсилка #{job_id}"))
+                continue
+            done = int(job["ok"]) + int(job["blocked"]) + int(job["failed"])
+            blocks.append(
+                f"📣 <b>Розсилка #{job_id}</b> [{job['status']}]: {done}/{job['total']}\n"
+                f"✅ {job['ok']} • 🚫 {job['blocked']} • ⚠️ {job['failed']}"
+                + (f"\n🎯 {html.escape(job['segment'])}" if job.get("segment") else "")
+            )
+        await message.answer("\n\n".join(blocks))
+    except Exception as e:
+        await report_error("broadcast_status", str(e))
+        await message.answer("Не вдалося отримати статус розсилок.")
+
+@dp.message(Command("broadcast_cancel"))
+async def broadcast_cancel(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    parts = (message.text or "").split()
+    try:
+        if len(parts) > 1:
+            if not parts[1].isdigit():
+                await message.reply("Формат: /broadcast_cancel [id]")
+                return
+            job_ids = [int(parts[1])]
+        else:
+            async with db.cursor() as cur:
+                await cur.execute("SELECT id FROM broadcast_jobs WHERE status='running'")
+                job_ids = [int(r["id"]) for r in await cur.fetchall()]
+        if not job_ids:
+            await message.reply("Немає активних розсилок.")
+            return
+        for job_id in job_ids:
+            await set_broadcast_job_status(job_id, "cancelled")
+            task = broadcast_tasks.get(job_id)
+            if task:
+                task.cancel()
+        await message.reply("Скасовано: " + ", ".join(f"#{j}" for j in job_ids))
+    except Exception as e:
+        await report_error("broadcast_cancel", str(e))
+        await message.reply(f"Не вдалося скасувати: {e}")
+
+# ============================ МАСОВІ ВІДПОВІДІ =============================
+# /bulk_reply — багато відповідей одним списком або CSV-файлом, рядок на відповідь:
+# «ключ;відповідь». Ключ — номер замовлення або #id треду. Відправка йде через
+# BroadcastEngine (спільний ліміт темпу, повтори на RetryAfter), наприкінці —
+# CSV-звіт по кожному рядку.
+
+BULK_REPLY_RATE = env_float("BULK_REPLY_RATE", 20.0)                 # повідомлень/с
+BULK_REPLY_CONCURRENCY = env_int("BULK_REPLY_CONCURRENCY", 8)        # одночасних відправок
+BULK_REPLY_MAX_ROWS = env_int("BULK_REPLY_MAX_ROWS", 2000)           # рядків за один раз
+BULK_REPLY_MAX_BYTES = env_int("BULK_REPLY_MAX_BYTES", 1024 * 1024)  # розмір CSV-файлу
+
+BULK_REPLY_HELP = (
+    "Рядок на відповідь: <code>номер_замовлення;відповідь</code> або <code>#id_треду;відповідь</code>.\n"
+    "Роздільник — «;», «,», табуляція або пробіл. Для запитів ТТН відповідь має містити ТТН (14 цифр)."
+)
+
+class BulkRow:
+    def __init__(self, no: int, key: str, answer: str):
+        self.no = no
+        self.key = key
+        self.answer = answer
+        self.thread_id: Optional[int] = None
+        self.user_id: Optional[int] = None
+        self.status = "pending"
+        self.detail = ""
+
+    def fail(self, status: str, detail: str):
+        self.status = status
+        self.detail = detail
+
+def decode_upload(raw: bytes) -> str:
+    # Excel під Windows зберігає CSV у cp1251
+    try:
+        return raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return raw.decode("cp1251", errors="replace")
+
+# Ключ не містить пробілів і роздільників, тож рядок розбирається однаково для
+# CSV («;», «,», табуляція) і для списку, вставленого з пробілами
+BULK_ROW_RE = re.compile(r"^\s*№?\s*([^\s;,]*)\s*[;,\t]?\s*(.*?)\s*$")
+
+def parse_bulk_rows(text: str) -> List[BulkRow]:
+    lines = [ln for ln in text.splitlines() if ln.strip()]
+    rows = []
+    for no, line in enumerate(lines, 1):
+        key, answer = BULK_ROW_RE.match(line).groups()
+        # Заголовок CSV: у першому «ключі» немає жодної цифри
+        if no == 1 and not re.search(r"\d", key):
+            continue
+        if len(answer) >= 2 and answer[0] == answer[-1] == '"':
+            answer = answer[1:-1].replace('""', '"')
+        row = BulkRow(no, key, answer)
+        if not key:
+            row.fail("invalid", "порожній ключ")
+        elif not answer:
+            row.fail("invalid", "порожня відповідь")
+        elif key.startswith("#") and not key[1:].isdigit():
+            row.fail("invalid", "некоректний id треду")
+        rows.append(row)
+    return rows
+
+async def resolve_bulk_rows(rows: List[BulkRow]):
+    todo = [r for r in rows if r.status == "pending"]
+    ids = sorted({int(r.key[1:]) for r in todo if r.key.startswith("#")})
+    orders = sorted({r.key[:64] for r in todo if not r.key.startswith("#")})
+    by_id: Dict[int, dict] = {}
+    by_order: Dict[str, dict] = {}
+    async with db.cursor() as cur:
+        for column, keys in (("id", ids), ("order_no", orders)):
+            for i in range(0, len(keys), WRITE_BEHIND_CHUNK):
+                chunk = keys[i:i + WRITE_BEHIND_CHUNK]
+                await cur.execute(
+                    "SELECT id, user_id, question, order_no, answered_at FROM operator_threads "
+                    f"WHERE {column} IN ({','.join(['%s'] * len(chunk))}) ORDER BY id",
+                    chunk,
+                )
+                for t in await cur.fetchall():
+                    if column == "id":
+                        by_id[int(t["id"])] = t
+                        continue
+                    # На один номер замовлення — останній відкритий тред, інакше просто останній
+                    prev = by_order.get(t["order_no"])
+                    if prev is None or t["answered_at"] is None or prev["answered_at"] is not None:
+                        by_order[t["order_no"]] = t
+    for r in todo:
+        t = by_id.get(int(r.key[1:])) if r.key.startswith("#") else by_order.get(r.key[:64])
+        if t is None:
+            r.fail("not_found", "тред не знайдено")
+            continue
+        r.thread_id = int(t["id"])
+        r.user_id = int(t["user_id"])
+        if thread_kind(t["question"] or "") == "ttn" and not extract_ttn(r.answer):
+            r.fail("invalid", "запит ТТН: потрібен номер із 14 цифр")
+        elif t["answered_at"] is not None:
+            r.detail = "тред уже мав відповідь"
+
+async def send_bulk_rows(rows: List[BulkRow]) -> BroadcastStats:
+    pending: Dict[int, List[BulkRow]] = {}
+    for r in rows:
+        if r.status == "pending":
+            pending.setdefault(r.user_id, []).append(r)
+    # Масова відповідь нікого не відписує, а кожен рядок — окремий текст, тож без зупинки
+    # на серії однакових BadRequest: помилка лишається в звіті на своєму рядку
+    engine = BroadcastEngine(
+        bot, rate=BULK_REPLY_RATE, concurrency=BULK_REPLY_CONCURRENCY, unsubscribe=False, abort_after=0
+    )
+    # uid -> [частин першої відповіді в черзі, уже надісланих]; живе між повторами send()
+    progress: Dict[int, List[int]] = {uid: [0] for uid in pending}
+
+    async def send(uid: int):
+        # Перше повідомлення вже пройшло через ліміт двигуна, решта — через той самий bucket
+        first = True
+
+        async def gate():
+            nonlocal first
+            if first:
+                first = False
+            else:
+                await engine.bucket.acquire()
+
+        queue = pending[uid]
+        while queue:
+            await deliver_answer(uid, queue[0].answer, before_send=gate, progress=progress[uid])
+            progress[uid][0] = 0
+            queue.pop(0).status = "sent"
+
+    async def on_result(uid: int, outcome: str):
+        queue = pending[uid]
+        if not queue:
+            return
+        if outcome == "blocked":
+            detail = "користувач заблокував бота"
+        else:
+            detail = engine.errors.get(uid) or "помилка відправки"
+            if progress[uid][0]:
+                detail = f"надіслано частково: {detail}"
+        for r in queue:
+            r.fail(outcome, detail)
+
+    stats = await engine.run(list(pending), send, on_result=on_result)
+    await operator_queue.answered_many(r.user_id for r in rows if r.status == "sent")
+    return stats
+
+def bulk_report(rows: List[BulkRow]) -> bytes:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["row", "key", "thread_id", "user_id", "status", "detail"])
+    for r in rows:
+        w.writerow([r.no, r.key, r.thread_id or "", r.user_id or "", r.status, r.detail])
+    return buf.getvalue().encode("utf-8-sig")
+
+async def run_bulk_reply(message: types.Message, text: str):
+    rows = parse_bulk_rows(text)
+    if not rows:
+        await message.answer("Не знайшов жодного рядка.\n" + BULK_REPLY_HELP)
+        return
+    if len(rows) > BULK_REPLY_MAX_ROWS:
+        await message.answer(f"Забагато рядків: {len(rows)} (максимум {BULK_REPLY_MAX_ROWS}).")
+        return
+    try:
+        await resolve_bulk_rows(rows)
+        ready = sum(1 for r in rows if r.status == "pending")
+        await message.answer(f"📨 Масова відповідь: {ready} з {len(rows)} рядків до відправки…")
+        started = time.monotonic()
+        stats = await send_bulk_rows(rows)
+    except Exception as e:
+        await report_error("bulk_reply", str(e))
+        await message.answer("Не вдалося виконати масову відповідь.", reply_markup=main_kb(message.from_user.id))
+        return
+    counts: Dict[str, int] = {}
+    for r in rows:
+        counts[r.status] = counts.get(r.status, 0) + 1
+    summary = (
+        f"✅ надіслано {counts.get('sent', 0)} • 🚫 заблокували {counts.get('blocked', 0)} • "
+        f"⚠️ помилок {counts.get('failed', 0)} • ❓ не знайдено {counts.get('not_found', 0)} • "
+        f"✏️ некоректних {counts.get('invalid', 0)} • 🔁 {stats.retries} • {time.monotonic() - started:.0f} с"
+    )
+    logger.info("Bulk reply by %s: %s rows, %s", message.from_user.id, len(rows), counts)
+    await message.answer_document(
+        BufferedInputFile(bulk_report(rows), filename="bulk_reply_report.csv"),
+        caption=summary,
+        reply_markup=main_kb(message.from_user.id),
+    )
+
+@dp.message(Command("bulk_reply"))
+async def bulk_reply_cmd(message: types.Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    parts = (message.text or "").split(maxsplit=1)
+    if len(parts) > 1:
+        await run_bulk_reply(message, parts[1])
+        return
+    await state.set_state(BulkReply.waiting_rows)
+    await message.answer(
+        "Надішліть список відповідей текстом або CSV-файлом.\n" + BULK_REPLY_HELP,
+        reply_markup=back_kb(),
+    )
+
+@dp.message(BulkReply.waiting_rows, F.document)
+async def bulk_reply_file(message: types.Message, state: FSMContext):
+    if (message.document.file_size or 0) > BULK_REPLY_MAX_BYTES:
+        await message.answer(f"Файл завеликий (максимум {BULK_REPLY_MAX_BYTES // 1024} КБ).")
+        return
+    await state.clear()
+    try:
+        raw = await bot.download(message.document)
+    except Exception as e:
+        await report_error("bulk_reply_file", str(e))
+        await message.answer("Не вдалося завантажити файл.", reply_markup=main_kb(message.from_user.id))
+        return
+    await run_bulk_reply(message, decode_upload(raw.read()))
+
+@dp.message(BulkReply.waiting_rows)
+async def bulk_reply_text(message: types.Message, state: FSMContext):
+    await state.clear()
+    await run_bulk_reply(message, message.text or "")
+
 # =========================== АДМІН: СТАТИСТИКА/ЕКСПОРТ ====================
 
 @dp.message(Command("stats"))
 async def stats(message: types.Message):
     if not is_admin(message.from_user.id):
         return
+    parts = (message.text or "").split()
     try:
-        total_subs = len(get_all_subscribers())
-        threads7 = count_threads(7)
-        threads_total = count_threads(None)
-        err7 = count_errors(7)
-        err_total = count_errors(None)
+        if len(parts) > 1:
+            if not parts[1].isdigit():
+                await message.answer("Формат: /stats [днів]")
+                return
+            days = max(1, min(int(parts[1]), 90))
+            rows = await stats_counters.daily(days)
+            lines = [f"<b>Статистика за {days} дн.</b>", "<code>дата        тред  пом  +підп −підп</code>"]
+            for r in rows:
+                lines.append(
+                    f"<code>{r['day']}  {r.get('threads', 0):>4} {r.get('errors', 0):>4} "
+                    f"{r.get('subs_new', 0):>5} {r.get('subs_gone', 0):>5}</code>"
+                )
+            if not rows:
+                lines.append("Даних немає.")
+            await message.answer("\n".join(lines))
+            return
+
+        snap = await stats_counters.snapshot()
         text = (
             "<b>Статистика</b>\n"
-            f"👥 Підписників: <b>{total_subs}</b>\n"
-            f"💬 Тредів за 7 днів: <b>{threads7}</b>\n"
-            f"💬 Тредів всього: <b>{threads_total}</b>\n"
-            f"⚠️ Помилки за 7 днів: <b>{err7}</b>\n"
-            f"⚠️ Помилки всього: <b>{err_total}</b>"
+            f"👥 Підписників: <b>{snap['subscribers']}</b>\n"
+            f"💬 Тредів за 7 днів: <b>{snap['threads']['recent']}</b>\n"
+            f"💬 Тредів всього: <b>{snap['threads']['total']}</b>\n"
+            f"⚠️ Помилки за 7 днів: <b>{snap['errors']['recent']}</b>\n"
+            f"⚠️ Помилки всього: <b>{snap['errors']['total']}</b>\n"
+            f"📝 У черзі запису: <b>{write_behind.depth}</b>"
         )
+        if PRODUCT_DB_TABLE or PRODUCT_API_URL:
+            text += "\n" + product_cache.summary()
         await message.answer(text)
     except Exception as e:
         await report_error("stats", str(e))
         await message.answer("Не вдалося отримати статистику.")
 
+# ---- Потоковий експорт: keyset-пагінація + gzip CSV частинами
+
+EXPORT_PAGE = env_int("EXPORT_PAGE", 10000)                       # рядків на одну вибірку
+EXPORT_PART_BYTES = env_int("EXPORT_PART_BYTES", 45 * 1024 * 1024)  # ліміт документа (Telegram — 50 МБ)
+EXPORT_COLUMNS = {
+    "user_id": "s.user_id",
+    "created_at": "DATE_FORMAT(s.created_at, '%%Y-%%m-%%d %%H:%%i:%%s')",
+    "last_active_at": "DATE_FORMAT(s.last_active_at, '%%Y-%%m-%%d %%H:%%i:%%s')",
+    "last_thread_at": (
+        "(SELECT DATE_FORMAT(MAX(t.created_at), '%%Y-%%m-%%d %%H:%%i:%%s') "
+        "FROM operator_threads t WHERE t.user_id = s.user_id)"
+    ),
+}
+
+def parse_export_args(text: str) -> Tuple[List[str], Segment]:
+    # /export [фільтри сегмента] [cols=user_id,created_at,...]
+    cols = ["user_id", "created_at"]
+    segment = Segment()
+    for tok in text.split()[1:]:
+        key, _, val = tok.partition("=")
+        if key.lower() == "cols":
+            cols = [c.strip() for c in val.split(",") if c.strip()]
+            unknown = [c for c in cols if c not in EXPORT_COLUMNS]
+            if unknown or not cols:
+                raise ValueError(f"невідомі колонки: {', '.join(unknown) or '—'}")
+        else:
+            segment.add(tok)
+    if "user_id" not in cols:
+        cols.insert(0, "user_id")  # потрібен як ключ пагінації
+    return cols, segment
+
+async def iter_subscriber_rows(
+    cols: List[str], segment: Segment, page: int = EXPORT_PAGE
+) -> AsyncIterator[List[dict]]:
+    select = ", ".join(f"{EXPORT_COLUMNS[c]} AS {c}" for c in cols)
+    last = -(2 ** 63)
+    while True:
+        # Серверний курсор: рядки сторінки читаються з мережі порціями. Сторінку
+        # дочитуємо й відпускаємо з'єднання до yield — споживач може чекати на
+        # завантаження документа, а курсор тим часом не тримається
+        chunks: List[List[dict]] = []
+        async with db.cursor(unbuffered=True) as cur:
+            await cur.execute(
+                f"SELECT {select} FROM subscribers s WHERE s.user_id > %s{segment.cond} "
+                "ORDER BY s.user_id LIMIT %s",
+                (last, *segment.args, page),
+            )
+            while True:
+                rows = await cur.fetchmany(1000)
+                if not rows:
+                    break
+                chunks.append(rows)
+        for rows in chunks:
+            yield rows
+        fetched = sum(len(rows) for rows in chunks)
+        if fetched < page:
+            return
+        last = int(chunks[-1][-1]["user_id"])
+
+class GzipCsvPart:
+    def __init__(self, header: List[str]):
+        self.rows = 0
+        self._raw = io.BytesIO()
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb", mtime=0)
+        self._text = io.TextIOWrapper(self._gz, encoding="utf-8", newline="")
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(header)
+
+    @property
+    def size(self) -> int:
+        return self._raw.tell()  # стиснуті байти, вже віддані gzip
+
+    def write(self, row: list):
+        self._writer.writerow(row)
+        self.rows += 1
+
+    def finish(self) -> bytes:
+        self._text.flush()
+        self._text.detach()
+        self._gz.close()
+        return self._raw.getvalue()
+
 @dp.message(Command("export"))
 async def export_csv(message: types.Message):
     if not is_admin(message.from_user.id):
         return
     try:
-        rows = get_subscribers_full()
-        buf = io.StringIO()
-        writer = csv.writer(buf)
-        writer.writerow(["user_id", "created_at"])
-        for uid, created in rows:
-            writer.writerow([uid, created])
-        data = buf.getvalue().encode("utf-8")
-        file = BufferedInputFile(data, filename="subscribers.csv")
-        await message.answer_document(file, caption=f"Експортовано: {len(rows)} записів")
+        cols, segment = parse_export_args(message.text or "")
+    except ValueError as e:
+        await message.answer(
+            f"Некоректні параметри: {e}\n"
+            f"Формат: /export [{SEGMENT_HELP}] [cols={','.join(EXPORT_COLUMNS)}]"
+        )
+        return
+    try:
+        total = 0
+        parts = 0
+        part = GzipCsvPart(cols)
+        upload: Optional[asyncio.Task] = None
+
+        async def send_part(p: GzipCsvPart, no: int):
+            file = BufferedInputFile(p.finish(), filename=f"subscribers_part{no}.csv.gz")
+            await message.answer_document(file, caption=f"Частина {no}: {p.rows} записів")
+
+        # aclosing: якщо запис чи відправка впаде, генератор закриється одразу, а не в GC
+        async with aclosing(iter_subscriber_rows(cols, segment)) as pages:
+            async for rows in pages:
+                for r in rows:
+                    part.write([r[c] for c in cols])
+                total += len(rows)
+                # Запас на дані, які gzip ще тримає у своєму буфері
+                if part.size >= EXPORT_PART_BYTES - 1024 * 1024:
+                    # Завантаження йде у фоні, поки читається наступна сторінка; одночасно — не більше одного
+                    if upload:
+                        await upload
+                    parts += 1
+                    upload = asyncio.create_task(send_part(part, parts))
+                    part = GzipCsvPart(cols)
+        if upload:
+            await upload
+
+        if parts == 0:
+            file = BufferedInputFile(part.finish(), filename="subscribers.csv.gz")
+            await message.answer_document(file, caption=f"Експортовано: {total} записів")
+            return
+        if part.rows:
+            parts += 1
+            await send_part(part, parts)
+        await message.answer(f"Експорт завершено: {total} записів у {parts} файлах.")
     except Exception as e:
         await report_error("export_csv", str(e))
         await message.answer("Не вдалося сформувати CSV.")
 
+# ================== ОБСЛУГОВУВАННЯ: АГРЕГАТИ ТА РЕТЕНШН =====================
+# Раз на MAINTENANCE_EVERY одна з реплік (GET_LOCK) перераховує денні агрегати
+# operator_threads_daily / error_logs_daily за останні ROLLUP_REFRESH_DAYS днів
+# (щоб урахувати пізні відповіді), а сирі рядки, старші за ретеншн, переносить в
+# архів або видаляє пачками з паузами (як і маршрути reply_routes того ж віку).
+# З RETENTION_PARTITIONS=1 старі місяці прибираються через DROP PARTITION
+# (migrations/optional/monthly_partitions.sql).
+
+MAINTENANCE_EVERY = env_float("MAINTENANCE_EVERY", 3600.0)             # с між проходами
+MAINTENANCE_DELAY = env_float("MAINTENANCE_DELAY", 120.0)              # с після старту до першого проходу
+ROLLUP_REFRESH_DAYS = env_int("ROLLUP_REFRESH_DAYS", 7)                # днів, що перераховуються щоразу
+ROLLUP_CHUNK_DAYS = 7                                                  # днів на один INSERT ... SELECT
+RETENTION_THREADS_DAYS = env_int("RETENTION_THREADS_DAYS", 180)        # 0 — зберігати без обмежень
+RETENTION_ERRORS_DAYS = env_int("RETENTION_ERRORS_DAYS", 30)           # 0 — зберігати без обмежень
+RETENTION_ARCHIVE_THREADS = os.getenv("RETENTION_ARCHIVE_THREADS", "1").strip().lower() in ("1", "true", "yes")
+RETENTION_BATCH = env_int("RETENTION_BATCH", 5000)                     # рядків на один DELETE
+RETENTION_PAUSE = env_float("RETENTION_PAUSE", 0.2)                    # с між пачками
+RETENTION_PARTITIONS = os.getenv("RETENTION_PARTITIONS", "").strip().lower() in ("1", "true", "yes")
+PARTITIONS_AHEAD = 2                                                   # місяців, створених наперед
+MAINTENANCE_LOCK = "zamorski-bot-maintenance"
+ROLLUP_KEY = "rollup_day"
+
+THREAD_COLUMNS = "id, user_id, question, admin_message_id, operator_id, order_no, created_at, assigned_at, answered_at"
+ARCHIVES = {"operator_threads": ("operator_threads_archive", THREAD_COLUMNS)}
+
+THREAD_KIND_SQL = (
+    "CASE " + " ".join(f"WHEN question LIKE '{p}%%' THEN '{k}'" for p, k in THREAD_KINDS.items())
+    + " ELSE 'question' END"
+)
+
+ROLLUP_THREADS_SQL = (
+    "INSERT INTO operator_threads_daily (day, kind, operator_id, threads, answered, answer_seconds) "
+    f"SELECT DATE(created_at), {THREAD_KIND_SQL}, COALESCE(operator_id, 0), COUNT(*), COUNT(answered_at), "
+    "COALESCE(SUM(UNIX_TIMESTAMP(answered_at) - UNIX_TIMESTAMP(created_at)), 0) "
+    "FROM operator_threads WHERE created_at >= %s AND created_at < %s "
+    f"GROUP BY DATE(created_at), {THREAD_KIND_SQL}, COALESCE(operator_id, 0) "
+    "ON DUPLICATE KEY UPDATE threads=VALUES(threads), answered=VALUES(answered), answer_seconds=VALUES(answer_seconds)"
+)
+
+ROLLUP_ERRORS_SQL = (
+    "INSERT INTO error_logs_daily (day, place, cnt, sample) "
+    "SELECT DATE(created_at), place, COUNT(*), MAX(SUBSTRING(detail, 1, 500)) "
+    "FROM error_logs WHERE created_at >= %s AND created_at < %s "
+    "GROUP BY DATE(created_at), place "
+    "ON DUPLICATE KEY UPDATE cnt=VALUES(cnt), sample=VALUES(sample)"
+)
+
+def as_date(v: Any) -> dt.date:
+    if isinstance(v, dt.datetime):
+        return v.date()
+    if isinstance(v, dt.date):
+        return v
+    return dt.date.fromisoformat(str(v)[:10])
+
+def month_start(day: dt.date, shift: int = 0) -> dt.date:
+    m = day.month - 1 + shift
+    return dt.date(day.year + m // 12, m % 12 + 1, 1)
+
+class Maintenance:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._unpartitioned: set = set()  # уже попередили, що таблиця без партицій
+        self.runs = 0
+        self.pruned = 0
+
+    def start(self):
+        if self._task is None and MAINTENANCE_EVERY > 0:
+            self._task = asyncio.create_task(self._run(), name="maintenance")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        await asyncio.sleep(MAINTENANCE_DELAY)
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                if db_down(e):
+                    logger.warning(f"Maintenance skipped, MySQL unavailable: {e}")
+                else:
+                    await report_error("maintenance", str(e))
+            await asyncio.sleep(MAINTENANCE_EVERY)
+
+    async def run_once(self) -> Optional[dict]:
+        t0 = time.perf_counter()
+        # Одне з'єднання на весь прохід: GET_LOCK прив'язаний до сесії
+        async with db.cursor() as cur:
+            await cur.execute("SELECT GET_LOCK(%s, 0) AS ok", (MAINTENANCE_LOCK,))
+            if not (await cur.fetchone())["ok"]:
+                return None  # проходить інша репліка
+            try:
+                await cur.execute("SELECT CURDATE() AS today")
+                today = as_date((await cur.fetchone())["today"])
+                report = {"rollup_days": await self.rollup(cur, today)}
+                report["threads"] = await self.prune(
+                    cur, "operator_threads", RETENTION_THREADS_DAYS, today, RETENTION_ARCHIVE_THREADS
+                )
+                report["errors"] = await self.prune(cur, "error_logs", RETENTION_ERRORS_DAYS, today)
+                report["routes"] = await self.prune_routes(cur, RETENTION_THREADS_DAYS, today)
+            finally:
+                await cur.execute("SELECT RELEASE_LOCK(%s)", (MAINTENANCE_LOCK,))
+        self.runs += 1
+        self.pruned += report["threads"] + report["errors"] + report["routes"]
+        logger.info(
+            "✅ Maintenance in %.1fs: rolled up %d days, pruned %d threads, %d errors, %d reply routes",
+            time.perf_counter() - t0, report["rollup_days"], report["threads"], report["errors"], report["routes"],
+        )
+        return report
+
+    async def rollup(self, cur, today: dt.date) -> int:
+        await cur.execute("SELECT value FROM bot_state WHERE name=%s", (ROLLUP_KEY,))
+        row = await cur.fetchone()
+        if row:
+            start = dt.datetime.strptime(str(row["value"]), "%Y%m%d").date() - dt.timedelta(days=ROLLUP_REFRESH_DAYS)
+        else:
+            # Перший прохід: агрегуємо всю наявну історію
+            await cur.execute(
+                "SELECT MIN(created_at) AS m FROM operator_threads UNION ALL SELECT MIN(created_at) FROM error_logs"
+            )
+            firsts = [as_date(r["m"]) for r in await cur.fetchall() if r["m"] is not None]
+            start = min(firsts, default=today)
+        day = start
+        while day < today:
+            end = min(today, day + dt.timedelta(days=ROLLUP_CHUNK_DAYS))
+            await cur.execute(ROLLUP_THREADS_SQL, (day, end))
+            await cur.execute(ROLLUP_ERRORS_SQL, (day, end))
+            day = end
+        await cur.execute(
+            "INSERT INTO bot_state (name, value) VALUES (%s, %s) ON DUPLICATE KEY UPDATE value=VALUES(value)",
+            (ROLLUP_KEY, int(today.strftime("%Y%m%d"))),
+        )
+        return max(0, (today - start).days)
+
+    async def prune(self, cur, table: str, days: int, today: dt.date, archive: bool = False) -> int:
+        if days <= 0:
+            return 0
+        # Сирі рядки живуть щонайменше вікно перерахунку агрегатів
+        cutoff = today - dt.timedelta(days=max(days, ROLLUP_REFRESH_DAYS + 1))
+        if RETENTION_PARTITIONS:
+            pruned = await self.drop_partitions(cur, table, cutoff, today, archive)
+            if pruned is not None:
+                return pruned
+        return await self.prune_rows(cur, table, cutoff, archive)
+
+    async def prune_rows(self, cur, table: str, cutoff: dt.date, archive: bool = False) -> int:
+        total = 0
+        while True:
+            await cur.execute(
+                f"SELECT id FROM {table} WHERE created_at < %s ORDER BY id LIMIT %s", (cutoff, RETENTION_BATCH)
+            )
+            ids = [r["id"] for r in await cur.fetchall()]
+            if not ids:
+                return total
+            marks = ",".join(["%s"] * len(ids))
+            if archive:
+                target, cols = ARCHIVES[table]
+                # IGNORE: пачку, скопійовану перед збоєм, можна безпечно повторити
+                await cur.execute(
+                    f"INSERT IGNORE INTO {target} ({cols}) SELECT {cols} FROM {table} WHERE id IN ({marks})", ids
+                )
+            total += await cur.execute(f"DELETE FROM {table} WHERE id IN ({marks})", ids)
+            if len(ids) < RETENTION_BATCH:
+                return total
+            await asyncio.sleep(RETENTION_PAUSE)
+
+    async def prune_routes(self, cur, days: int, today: dt.date) -> int:
+        # Маршрути reply живуть стільки ж, скільки треди. Ключ складений, без id —
+        # пачки через DELETE ... LIMIT по індексу created_at (міграція 0013)
+        if days <= 0:
+            return 0
+        cutoff = today - dt.timedelta(days=max(days, ROLLUP_REFRESH_DAYS + 1))
+        total = 0
+        while True:
+            deleted = await cur.execute(
+                "DELETE FROM reply_routes WHERE created_at < %s LIMIT %s", (cutoff, RETENTION_BATCH)
+            )
+            total += deleted
+            if deleted < RETENTION_BATCH:
+                return total
+            await asyncio.sleep(RETENTION_PAUSE)
+
+    async def unix_ts(self, cur, day: dt.date) -> int:
+        # Межі партицій — у часовому поясі сесії MySQL, як і UNIX_TIMESTAMP(created_at)
+        await cur.execute("SELECT UNIX_TIMESTAMP(%s) AS ts", (day,))
+        return int((await cur.fetchone())["ts"])
+
+    async def drop_partitions(
+        self, cur, table: str, cutoff: dt.date, today: dt.date, archive: bool
+    ) -> Optional[int]:
+        await cur.execute(
+            "SELECT partition_name AS name, partition_description AS bound, table_rows AS est "
+            "FROM information_schema.partitions WHERE table_schema = DATABASE() AND table_name = %s "
+            "AND partition_name IS NOT NULL ORDER BY partition_ordinal_position",
+            (table,),
+        )
+        parts = await cur.fetchall()
+        if not parts:
+            if table not in self._unpartitioned:
+                self._unpartitioned.add(table)
+                logger.warning("RETENTION_PARTITIONS is on but %s is not partitioned; pruning rows instead", table)
+            return None
+        await self.add_partitions(cur, table, parts, today)
+        pruned = await self.prune_rows(cur, table, cutoff, archive=True) if archive else 0
+        cutoff_ts = await self.unix_ts(cur, cutoff)
+        old = [p for p in parts if p["bound"] != "MAXVALUE" and int(p["bound"]) <= cutoff_ts]
+        if old:
+            await cur.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(p['name'] for p in old)}")
+            logger.info("Dropped partitions %s of %s", ", ".join(p["name"] for p in old), table)
+            if not archive:
+                pruned += sum(int(p["est"] or 0) for p in old)  # оцінка InnoDB, без COUNT(*)
+        return pruned
+
+    async def add_partitions(self, cur, table: str, parts: List[dict], today: dt.date):
+        if parts[-1]["name"] != "pmax":
+            return  # схема партицій ведеться вручну
+        bounds = [int(p["bound"]) for p in parts if p["bound"] != "MAXVALUE"]
+        this_month = month_start(today)
+        new: List[Tuple[str, int]] = []
+        if not bounds:
+            # Перший прохід: уся історія — в одну партицію до початку поточного місяця
+            new.append(("p" + month_start(today, -1).strftime("%Y%m"), await self.unix_ts(cur, this_month)))
+        last = new[-1][1] if new else max(bounds)
+        for i in range(PARTITIONS_AHEAD + 1):
+            bound = await self.unix_ts(cur, month_start(today, i + 1))
+            if bound > last:
+                new.append(("p" + month_start(today, i).strftime("%Y%m"), bound))
+                last = bound
+        if not new:
+            return
+        defs = ", ".join(f"PARTITION {name} VALUES LESS THAN ({bound})" for name, bound in new)
+        await cur.execute(
+            f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO ({defs}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+        )
+        logger.info("Added partitions %s to %s", ", ".join(name for name, _ in new), table)
+
+maintenance = Maintenance()
+
+# ========================== ЖИТТЄВИЙ ЦИКЛ ОНОВЛЕНЬ =========================
+# Обидва режими подають оновлення через UpdateLifecycle: не більше
+# UPDATE_CONCURRENCY обробників одночасно, кожен відстежується. Прийом не чекає
+# на обробку: polling підтверджує все отримане (зсув зберігається в bot_state),
+# webhook відповідає 200 одразу, а повторні доставки відсіюються за update_id.
+# На SIGTERM — стоп прийому, дочікування обробників (до SHUTDOWN_DRAIN_TIMEOUT);
+# скасовані на дедлайні зберігаються в pending_updates і обробляються після
+# рестарту. Потім скидання буферів і лише тоді закриття ресурсів.
+
+UPDATE_CONCURRENCY = env_int("UPDATE_CONCURRENCY", 64)             # одночасних обробників оновлень
+POLL_TIMEOUT = env_int("POLL_TIMEOUT", 30)                         # с long polling getUpdates
+POLL_LIMIT = 100                                                   # максимум Telegram
+SHUTDOWN_DRAIN_TIMEOUT = env_float("SHUTDOWN_DRAIN_TIMEOUT", 20.0)  # с на дочікування обробників
+SHUTDOWN_TIMEOUT = env_float("SHUTDOWN_TIMEOUT", 28.0)             # с на все; Render дає 30 до SIGKILL
+RECENT_UPDATES = 10_000                                            # завершених update_id для відсіву повторів
+OFFSET_KEY = "update_offset"
+
+class UpdateLifecycle:
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY):
+        self._sem = asyncio.Semaphore(max(1, concurrency))
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._queued: set = set()                     # чекають вільного слота
+        self._abandoned: Dict[int, Update] = {}       # скасовані на дедлайні — до pending_updates
+        self._recent: Dict[int, None] = {}            # нещодавно завершені, в порядку завершення
+        self.max_seen = 0
+        self.saved_offset: Optional[int] = None
+        self.stopping = False
+        self.stop_requested_at: Optional[float] = None
+        self.handled = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    @property
+    def offset(self) -> int:
+        # Зсув getUpdates: усе отримане підтверджуємо, навіть якщо воно ще обробляється
+        return self.max_seen + 1
+
+    def known(self, update_id: int) -> bool:
+        return (
+            update_id in self._tasks
+            or update_id in self._queued
+            or update_id in self._recent
+            or update_id in self._abandoned
+        )
+
+    async def submit(self, update: Update) -> Optional[asyncio.Task]:
+        update_id = update.update_id
+        if self.known(update_id):
+            return None  # повторна доставка того, що вже обробляється або оброблено
+        self._queued.add(update_id)
+        try:
+            await self._sem.acquire()
+        finally:
+            self._queued.discard(update_id)
+        self.max_seen = max(self.max_seen, update_id)
+        task = self._tasks[update_id] = asyncio.create_task(self._handle(update), name=f"update-{update_id}")
+        return task
+
+    async def _handle(self, update: Update):
+        update_id = update.update_id
+        try:
+            await dp.feed_update(bot, update)
+            self.handled += 1
+        except asyncio.CancelledError:
+            self._abandoned[update_id] = update
+            raise
+        except Exception as e:
+            logger.exception(f"Update {update_id} failed: {e}")
+        finally:
+            self._tasks.pop(update_id, None)
+            if update_id not in self._abandoned:
+                self._recent[update_id] = None
+                if len(self._recent) > RECENT_UPDATES:
+                    del self._recent[next(iter(self._recent))]
+            self._sem.release()
+
+    def request_stop(self):
+        if not self.stopping:
+            self.stopping = True
+            self.stop_requested_at = time.monotonic()
+            logger.info("Stop requested: %d updates in flight", self.in_flight)
+
+    async def drain(self, timeout: float = SHUTDOWN_DRAIN_TIMEOUT):
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        logger.info("Draining %d in-flight updates (up to %.0fs)", len(tasks), timeout)
+        _, pending = await asyncio.wait(tasks, timeout=max(0.0, timeout))
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning("Shutdown deadline: %d updates cancelled, kept for replay after restart", len(pending))
+
+    async def save_abandoned(self):
+        if not self._abandoned:
+            return
+        rows = [
+            (update_id, update.model_dump_json(by_alias=True, exclude_none=True))
+            for update_id, update in sorted(self._abandoned.items())
+        ]
+        try:
+            async with db.cursor() as cur:
+                await cur.executemany(
+                    "INSERT IGNORE INTO pending_updates (update_id, payload) VALUES (%s, %s)", rows
+                )
+        except Exception as e:
+            logger.error(f"Cancelled updates {[r[0] for r in rows]} not saved: {e}")
+            return
+        self._abandoned.clear()
+        logger.info("Saved %d cancelled updates for replay", len(rows))
+
+    async def replay_saved(self) -> int:
+        try:
+            async with db.cursor() as cur:
+                await cur.execute("SELECT update_id, payload FROM pending_updates ORDER BY update_id")
+                rows = await cur.fetchall()
+                claimed = []
+                for row in rows:
+                    # Рядок забирає той, хто його видалив: репліки не оброблять його двічі
+                    if await cur.execute("DELETE FROM pending_updates WHERE update_id=%s", (row["update_id"],)):
+                        claimed.append(row["payload"])
+        except Exception as e:
+            logger.warning(f"Saved updates not replayed: {e}")
+            return 0
+        for payload in claimed:
+            await self.submit(Update.model_validate_json(payload, context={"bot": bot}))
+        if claimed:
+            logger.info("Replaying %d updates cancelled by the previous shutdown", len(claimed))
+        return len(claimed)
+
+    async def load_offset(self) -> Optional[int]:
+        async with db.cursor() as cur:
+            await cur.execute("SELECT value FROM bot_state WHERE name=%s", (OFFSET_KEY,))
+            row = await cur.fetchone()
+        if row:
+            self.saved_offset = int(row["value"])
+            self.max_seen = max(self.max_seen, self.saved_offset - 1)
+        return self.saved_offset
+
+    async def save_offset(self):
+        offset = self.offset
+        if offset == self.saved_offset or self.max_seen == 0:
+            return
+        try:
+            async with db.cursor() as cur:
+                await cur.execute(
+                    "INSERT INTO bot_state (name, value) VALUES (%s, %s) "
+                    "ON DUPLICATE KEY UPDATE value=VALUES(value)",
+                    (OFFSET_KEY, offset),
+                )
+            self.saved_offset = offset
+        except Exception as e:
+            logger.warning(f"Update offset {offset} not saved: {e}")
+
+    async def _poll(self):
+        # Вебхук знімаємо без drop_pending_updates: накопичене за час простою обробиться
+        await bot.delete_webhook(drop_pending_updates=False)
+        offset = await self.load_offset()
+        logger.info("✅ Polling from offset %s", offset if offset is not None else "(Telegram)")
+        await self.replay_saved()
+        allowed = dp.resolve_used_update_types()
+        backoff = 1.0
+        while not self.stopping:
+            await self.save_offset()
+            try:
+                # Довгий обробник (/bulk_reply, /export) не тримає зсув: прийом іде далі
+                updates = await bot.get_updates(
+                    offset=self.offset if self.max_seen else None,
+                    limit=POLL_LIMIT,
+                    timeout=POLL_TIMEOUT,
+                    allowed_updates=allowed,
+                    request_timeout=POLL_TIMEOUT + 10,
+                )
+            except Exception as e:
+                # Мережа, 5xx, а під час деплою — Conflict від старого процесу, що ще опитує
+                delay = e.retry_after if isinstance(e, TelegramRetryAfter) else backoff
+                logger.warning(f"getUpdates failed, retry in {delay:.0f}s: {e}")
+                await asyncio.sleep(delay)
+                backoff = min(30.0, backoff * 2)
+                continue
+            backoff = 1.0
+            for update in updates:
+                await self.submit(update)
+
+    async def run_polling(self):
+        poller = asyncio.create_task(self._poll(), name="polling")
+        stop = asyncio.create_task(wait_for_stop_signal(), name="stop-signal")
+        try:
+            await asyncio.wait({poller, stop}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.request_stop()
+            # Перерваний long poll нічого не підтверджує: ці оновлення Telegram віддасть знову
+            for t in (poller, stop):
+                t.cancel()
+            await asyncio.gather(poller, stop, return_exceptions=True)
+            await self.drain(self.remaining(SHUTDOWN_DRAIN_TIMEOUT))
+            await self.save_offset()
+        if poller.done() and not poller.cancelled() and poller.exception():
+            raise poller.exception()
+
+    def remaining(self, budget: float = SHUTDOWN_TIMEOUT) -> float:
+        if self.stop_requested_at is None:
+            return budget
+        return max(0.0, budget - (time.monotonic() - self.stop_requested_at))
+
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows
+    await stop.wait()
+
+update_lifecycle = UpdateLifecycle()
+
+metrics.gauge("bot_updates_in_flight", "Updates being handled right now", lambda: update_lifecycle.in_flight)
+
+# ============================== WEBHOOK ====================================
+# BOT_MODE=webhook: оновлення приходять POST-ом на вбудований aiohttp-сервер.
+# Запит перевіряється за секретним токеном, підтверджується одразу, а обробка
+# йде у фоні через UpdateLifecycle. Кілька реплік можуть стояти за одним URL.
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()          # polling | webhook
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").strip().rstrip("/")  # https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip()
+WEBHOOK_PORT = env_int("PORT", 8080)                                   # Render передає PORT
+WEBHOOK_MAX_CONNECTIONS = env_int("WEBHOOK_MAX_CONNECTIONS", 40)       # 1..100, ліміт Telegram
+
+app_ready = False  # readiness: старт завершено, можна приймати оновлення
+
+async def healthz(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+async def readyz(request: web.Request) -> web.Response:
+    if not app_ready:
+        return web.Response(status=503, text="starting")
+    try:
+        async with db.cursor() as cur:
+            await asyncio.wait_for(cur.execute("SELECT 1"), 2.0)
+    except Exception as e:
+        if spool.enabled and db_down(e):
+            # Аварійний режим: записи йдуть у спул, бот лишається в ротації
+            return web.Response(text=f"degraded: {e}")
+        return web.Response(status=503, text=f"db: {e}")
+    return web.Response(text="ready")
+
+async def webhook_update(request: web.Request) -> web.Response:
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        return web.Response(status=401, text="unauthorized")
+    if update_lifecycle.stopping:
+        # Telegram повторить доставку — іншій репліці або цьому процесу після рестарту
+        return web.Response(status=503, text="stopping")
+    update = Update.model_validate(await request.json(), context={"bot": bot})
+    # 200 одразу, обробка — у фоні; повторна доставка того, що вже в роботі чи
+    # оброблено, відкидається в submit. Семафор тримає відповідь, доки не звільниться
+    # слот: Telegram сам пригальмує доставку
+    await update_lifecycle.submit(update)
+    return web.json_response({})
+
+def build_web_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook_update)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    return app
+
+async def run_webhook():
+    if not WEBHOOK_BASE_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook потрібні WEBHOOK_BASE_URL і WEBHOOK_SECRET")
+    runner = web.AppRunner(build_web_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info("✅ Webhook server on %s:%d%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await update_lifecycle.replay_saved()
+        # Невідправлені оновлення не скидаємо: Telegram доставить їх на новий URL
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=max(1, min(WEBHOOK_MAX_CONNECTIONS, 100)),
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=False,
+        )
+        await wait_for_stop_signal()
+    finally:
+        update_lifecycle.request_stop()
+        await update_lifecycle.drain(update_lifecycle.remaining(SHUTDOWN_DRAIN_TIMEOUT))
+        # Вебхук не знімаємо — його продовжують обслуговувати інші репліки
+        await runner.cleanup()
+
 # =============================== MAIN ======================================
+# Критичний шлях старту — лише конфіг, Bot, пул і звірка схеми; решта
+# (команди, кеші, пул до DB_POOL_WARM, відновлення розсилок) гріється у фоні,
+# поки бот уже приймає оновлення.
+
+class StartupTimer:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.steps: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def step(self, name: str):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - t))
+
+    async def run(self, name: str, coro):
+        with self.step(name):
+            return await coro
+
+    def report(self, label: str) -> str:
+        parts = ", ".join(f"{name} {sec * 1000:.0f}ms" for name, sec in self.steps)
+        return f"{label} in {(time.perf_counter() - self.t0) * 1000:.0f}ms ({parts})"
+
+async def startup():
+    timer = StartupTimer()
+    with timer.step("bot"):
+        create_bot()
+    await asyncio.gather(
+        timer.run("db", db.start()),
+        timer.run("metrics", start_metrics()),
+        timer.run("http", start_http_client()),
+    )
+    await timer.run("schema", check_schema())
+    write_behind.start()
+    spool.start()
+    error_pipeline.start()
+    operator_queue.start()
+    maintenance.start()
+    catalog.start()
+    if isinstance(fsm_storage, CachedFSMStorage):
+        fsm_storage.start()
+    logger.info("✅ " + timer.report("Startup ready"))
+
+async def warm_up():
+    timer = StartupTimer()
+    steps = {
+        "commands": setup_bot_commands(bot),
+        "pool": db.warm(DB_POOL_WARM),
+        "subscribers": subscribers_cache.warm(),
+        "operator_queue": operator_queue.warm(),
+        "catalog": catalog.refresh(),
+        "broadcasts": resume_broadcast_jobs(),
+    }
+    results = await asyncio.gather(*(timer.run(n, c) for n, c in steps.items()), return_exceptions=True)
+    for name, res in zip(steps, results):
+        if isinstance(res, Exception):
+            await report_error(f"warm_up_{name}", str(res))
+    logger.info("✅ " + timer.report("Warm-up done"))
+
+async def shutdown_step(name: str, coro):
+    # Буфери скидаються в межах загального SHUTDOWN_TIMEOUT від сигналу зупинки
+    try:
+        await asyncio.wait_for(coro, max(1.0, update_lifecycle.remaining()))
+    except asyncio.TimeoutError:
+        logger.error("Shutdown step %s hit the deadline", name)
+    except Exception as e:
+        logger.warning(f"Shutdown step {name} failed: {e}")
 
 async def main():
+    global app_ready
+    warm_task: Optional[asyncio.Task] = None
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        await setup_bot_commands(bot)
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        await startup()
+        warm_task = asyncio.create_task(warm_up(), name="warm-up")
+        app_ready = True
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await update_lifecycle.run_polling()
     finally:
-        db.close()
+        app_ready = False
+        # 1) прийом зупинено, обробники дочекались (або скасовані на дедлайні)
+        update_lifecycle.request_stop()
+        await update_lifecycle.drain(update_lifecycle.remaining(SHUTDOWN_DRAIN_TIMEOUT))
+        if warm_task is not None:
+            warm_task.cancel()
+            await asyncio.gather(warm_task, return_exceptions=True)
+        # 2) фонові задачі зберігають чекпоінти, буфери скидаються в БД
+        await shutdown_step("updates", update_lifecycle.save_abandoned())
+        await shutdown_step("broadcasts", stop_broadcast_jobs())
+        await shutdown_step("maintenance", maintenance.stop())
+        await shutdown_step("catalog", catalog.stop())
+        await shutdown_step("operator_queue", operator_queue.stop())
+        await shutdown_step("error_pipeline", error_pipeline.stop())
+        await shutdown_step("write_behind", write_behind.stop())
+        await shutdown_step("spool", spool.stop())
+        await shutdown_step("fsm", fsm_storage.close())
+        # 3) лише тепер закриваємо з'єднання
+        await close_http_client()
+        if bot is not None:
+            await bot.session.close()
+        await db.close()
+        await stop_metrics()
+        logger.info("✅ Stopped: %d updates handled", update_lifecycle.handled)
 
 if __name__ == "__main__":
     asyncio.run(main())
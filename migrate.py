@@ -0,0 +1,136 @@
+import os
+import re
+import sys
+import logging
+from typing import List, Tuple
+
+import pymysql
+
+# Міграції схеми: migrations/NNNN_опис.sql застосовуються по порядку, кожна
+# рівно один раз; застосовані версії пишуться в schema_migrations.
+#
+#   python migrate.py           — застосувати всі нові міграції
+#   python migrate.py --status  — показати, що застосовано, а що ні
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_RE = re.compile(r"^(\d{4})_([\w\-]+)\.sql$")
+LOCK_NAME = "zamorski-bot-migrate"
+
+# Дублікат індексу/колонки — міграцію вже застосовано вручну або старим кодом
+IGNORED_ERRORS = {1060, 1061}
+
+logger = logging.getLogger("zamorski-bot.migrate")
+
+def connect() -> pymysql.connections.Connection:
+    return pymysql.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=os.getenv("DB_NAME"),
+        charset="utf8mb4",
+        autocommit=True,
+        cursorclass=pymysql.cursors.DictCursor,
+        connect_timeout=10,
+    )
+
+def discover(path: str = MIGRATIONS_DIR) -> List[Tuple[int, str, str]]:
+    found = []
+    for fname in sorted(os.listdir(path)):
+        m = MIGRATION_RE.match(fname)
+        if m:
+            found.append((int(m.group(1)), m.group(2), os.path.join(path, fname)))
+    versions = [v for v, _, _ in found]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError("Duplicate migration versions in " + path)
+    return found
+
+def latest_version(path: str = MIGRATIONS_DIR) -> int:
+    found = discover(path)
+    return found[-1][0] if found else 0
+
+def split_statements(sql: str) -> List[str]:
+    lines = [ln for ln in sql.splitlines() if not ln.strip().startswith("--")]
+    return [st.strip() for st in "\n".join(lines).split(";") if st.strip()]
+
+def ensure_versions_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        """
+    )
+
+def applied_versions(cur) -> set:
+    cur.execute("SELECT version FROM schema_migrations")
+    return {int(r["version"]) for r in cur.fetchall()}
+
+def current_version(conn) -> int:
+    with conn.cursor() as cur:
+        try:
+            cur.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_migrations")
+        except pymysql.err.ProgrammingError:
+            return 0  # таблиці ще немає
+        return int(cur.fetchone()["v"])
+
+def apply_pending(conn, path: str = MIGRATIONS_DIR) -> List[int]:
+    applied_now: List[int] = []
+    with conn.cursor() as cur:
+        # Захист від паралельного запуску з кількох інстансів
+        cur.execute("SELECT GET_LOCK(%s, 60) AS ok", (LOCK_NAME,))
+        if not cur.fetchone()["ok"]:
+            raise RuntimeError("Could not acquire migration lock")
+        try:
+            ensure_versions_table(cur)
+            done = applied_versions(cur)
+            for version, name, fpath in discover(path):
+                if version in done:
+                    continue
+                with open(fpath, encoding="utf-8") as f:
+                    statements = split_statements(f.read())
+                logger.info("Applying %04d_%s (%d statements)", version, name, len(statements))
+                for st in statements:
+                    try:
+                        cur.execute(st)
+                    except pymysql.err.MySQLError as e:
+                        if e.args and e.args[0] in IGNORED_ERRORS:
+                            logger.info("  skipped (already applied): %s", e.args[1])
+                            continue
+                        raise
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (version, name),
+                )
+                applied_now.append(version)
+        finally:
+            cur.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+    return applied_now
+
+def main(argv: List[str]) -> int:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+    )
+    conn = connect()
+    try:
+        if "--status" in argv:
+            with conn.cursor() as cur:
+                ensure_versions_table(cur)
+                done = applied_versions(cur)
+            for version, name, _ in discover():
+                mark = "✅" if version in done else "⏳"
+                print(f"{mark} {version:04d}_{name}")
+            return 0
+        applied = apply_pending(conn)
+        if applied:
+            logger.info("✅ Applied migrations: %s", ", ".join(f"{v:04d}" for v in applied))
+        else:
+            logger.info("✅ Schema is up to date (version %04d)", current_version(conn))
+        return 0
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,3 +1,4 @@
+-- Базові таблиці бота
 CREATE TABLE IF NOT EXISTS subscribers (
   user_id BIGINT PRIMARY KEY,
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -10,3 +11,10 @@ CREATE TABLE IF NOT EXISTS operator_threads (
   admin_message_id BIGINT NULL,
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS error_logs (
+  id INT AUTO_INCREMENT PRIMARY KEY,
+  place VARCHAR(64) NOT NULL,
+  detail TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,25 @@
+-- Розсилки як задачі з чекпоінтами
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+  id INT AUTO_INCREMENT PRIMARY KEY,
+  status VARCHAR(16) NOT NULL DEFAULT 'running',
+  text TEXT NULL,
+  photo_id VARCHAR(255) NULL,
+  caption TEXT NULL,
+  created_by BIGINT NULL,
+  report_chat_id BIGINT NULL,
+  total INT NOT NULL DEFAULT 0,
+  ok INT NOT NULL DEFAULT 0,
+  blocked INT NOT NULL DEFAULT 0,
+  failed INT NOT NULL DEFAULT 0,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  finished_at TIMESTAMP NULL,
+  KEY idx_broadcast_jobs_status (status)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+  job_id INT NOT NULL,
+  user_id BIGINT NOT NULL,
+  status TINYINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (job_id, user_id),
+  KEY idx_broadcast_recipients_pending (job_id, status, user_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
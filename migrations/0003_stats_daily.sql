@@ -0,0 +1,22 @@
+-- Денні лічильники для /stats + одноразове заповнення з наявних даних
+CREATE TABLE IF NOT EXISTS stats_daily (
+  day DATE NOT NULL,
+  metric VARCHAR(32) NOT NULL,
+  cnt INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, metric)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+INSERT INTO stats_daily (day, metric, cnt)
+SELECT DATE(created_at), 'threads', COUNT(*) FROM operator_threads
+WHERE NOT EXISTS (SELECT 1 FROM stats_daily WHERE metric = 'threads')
+GROUP BY DATE(created_at);
+
+INSERT INTO stats_daily (day, metric, cnt)
+SELECT DATE(created_at), 'errors', COUNT(*) FROM error_logs
+WHERE NOT EXISTS (SELECT 1 FROM stats_daily WHERE metric = 'errors')
+GROUP BY DATE(created_at);
+
+INSERT INTO stats_daily (day, metric, cnt)
+SELECT DATE(created_at), 'subs_new', COUNT(*) FROM subscribers
+WHERE NOT EXISTS (SELECT 1 FROM stats_daily WHERE metric = 'subs_new')
+GROUP BY DATE(created_at);
@@ -0,0 +1,9 @@
+-- Маршрути reply для службових повідомлень адміну
+CREATE TABLE IF NOT EXISTS reply_routes (
+  admin_chat_id BIGINT NOT NULL,
+  admin_message_id BIGINT NOT NULL,
+  user_id BIGINT NOT NULL,
+  kind VARCHAR(16) NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (admin_chat_id, admin_message_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,9 @@
+-- Індекси під запити гарячого шляху:
+-- admin_reply_to_service шукає тред за admin_message_id;
+-- вибірки за періодом і експорт фільтрують за created_at;
+-- «активні» підписники — за (user_id, created_at) тредів.
+CREATE INDEX idx_operator_threads_admin_msg ON operator_threads (admin_message_id);
+CREATE INDEX idx_operator_threads_created ON operator_threads (created_at);
+CREATE INDEX idx_operator_threads_user_created ON operator_threads (user_id, created_at);
+CREATE INDEX idx_error_logs_created ON error_logs (created_at);
+CREATE INDEX idx_subscribers_created ON subscribers (created_at);
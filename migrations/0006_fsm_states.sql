@@ -0,0 +1,8 @@
+-- Стан FSM-діалогів (FSM_STORAGE=mysql)
+CREATE TABLE IF NOT EXISTS fsm_states (
+  storage_key VARCHAR(191) NOT NULL PRIMARY KEY,
+  state VARCHAR(128) NULL,
+  data MEDIUMTEXT NOT NULL,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  KEY idx_fsm_updated (updated_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
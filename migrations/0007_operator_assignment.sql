@@ -0,0 +1,7 @@
+-- Розподіл тредів між операторами: хто відповідає і чи вже відповів.
+-- Треди, що існували до міграції, вважаються закритими.
+ALTER TABLE operator_threads ADD COLUMN operator_id BIGINT NULL;
+ALTER TABLE operator_threads ADD COLUMN assigned_at TIMESTAMP NULL;
+ALTER TABLE operator_threads ADD COLUMN answered_at TIMESTAMP NULL;
+UPDATE operator_threads SET answered_at = created_at WHERE answered_at IS NULL AND operator_id IS NULL;
+CREATE INDEX idx_operator_threads_open ON operator_threads (answered_at, operator_id);
@@ -0,0 +1,9 @@
+-- Сегменти аудиторії: остання активність підписника (індексована) і
+-- сегмент, на який пішла розсилка. Початкове значення активності — час
+-- останнього звернення до оператора.
+ALTER TABLE subscribers ADD COLUMN last_active_at TIMESTAMP NULL;
+CREATE INDEX idx_subscribers_last_active ON subscribers (last_active_at);
+UPDATE subscribers SET last_active_at = (
+  SELECT MAX(t.created_at) FROM operator_threads t WHERE t.user_id = subscribers.user_id
+) WHERE last_active_at IS NULL;
+ALTER TABLE broadcast_jobs ADD COLUMN segment VARCHAR(255) NULL;
@@ -0,0 +1,9 @@
+-- Номер замовлення в треді (ТТН/рахунок) — для масових відповідей за
+-- номером замовлення. Старі треди заповнюються з тексту питання.
+ALTER TABLE operator_threads ADD COLUMN order_no VARCHAR(64) NULL;
+CREATE INDEX idx_operator_threads_order_no ON operator_threads (order_no);
+UPDATE operator_threads
+   SET order_no = TRIM(SUBSTRING_INDEX(SUBSTRING_INDEX(question, 'Замовлення: ', -1), '\n', 1))
+ WHERE order_no IS NULL
+   AND (question LIKE '[TTN]%' OR question LIKE '[BILL]%')
+   AND question LIKE '%Замовлення: %';
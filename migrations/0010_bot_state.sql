@@ -0,0 +1,7 @@
+-- Службовий стан процесу: зсув getUpdates, до якого оновлення вже оброблено,
+-- щоб після рестарту продовжити з нього, а не скидати чергу Telegram
+CREATE TABLE IF NOT EXISTS bot_state (
+  name VARCHAR(64) NOT NULL PRIMARY KEY,
+  value BIGINT NOT NULL,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
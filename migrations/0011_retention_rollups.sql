@@ -0,0 +1,32 @@
+-- Денні агрегати, які переживають видалення сирих рядків, і архів тредів.
+-- operator_id = 0 — тред без призначеного оператора.
+CREATE TABLE IF NOT EXISTS operator_threads_daily (
+  day DATE NOT NULL,
+  kind VARCHAR(16) NOT NULL,
+  operator_id BIGINT NOT NULL DEFAULT 0,
+  threads INT NOT NULL DEFAULT 0,
+  answered INT NOT NULL DEFAULT 0,
+  answer_seconds BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, kind, operator_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS error_logs_daily (
+  day DATE NOT NULL,
+  place VARCHAR(64) NOT NULL,
+  cnt INT NOT NULL DEFAULT 0,
+  sample VARCHAR(500) NULL,
+  PRIMARY KEY (day, place)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE TABLE IF NOT EXISTS operator_threads_archive (
+  id INT NOT NULL PRIMARY KEY,
+  user_id BIGINT NOT NULL,
+  question TEXT NOT NULL,
+  admin_message_id BIGINT NULL,
+  operator_id BIGINT NULL,
+  order_no VARCHAR(64) NULL,
+  created_at TIMESTAMP NULL,
+  assigned_at TIMESTAMP NULL,
+  answered_at TIMESTAMP NULL,
+  KEY idx_threads_archive_user (user_id, created_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,7 @@
+-- Оновлення, чиї обробники скасовано на дедлайні зупинки. Telegram їх уже
+-- підтверджено, тож після рестарту бот обробляє їх звідси й видаляє
+CREATE TABLE IF NOT EXISTS pending_updates (
+  update_id BIGINT NOT NULL PRIMARY KEY,
+  payload MEDIUMTEXT NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,3 @@
+-- Ретеншн reply_routes: обслуговування видаляє маршрути, старші за вікно тредів,
+-- пачками за created_at
+CREATE INDEX idx_reply_routes_created ON reply_routes (created_at);
@@ -0,0 +1,21 @@
+-- Необов'язково: помісячне RANGE-партиціювання сирих таблиць. migrate.py цей
+-- файл не застосовує (він поза нумерацією) — виконайте вручну у вікно
+-- обслуговування, потім задайте RETENTION_PARTITIONS=1. Далі бот сам додає
+-- партиції наперед і видаляє місяці, старші за ретеншн, через DROP PARTITION.
+-- Ключ партиціювання має входити в первинний ключ, тому PK стає (id, created_at).
+-- Усі наявні рядки спершу лягають у pmax; перший прохід обслуговування
+-- переносить їх в одну «історичну» партицію до початку поточного місяця.
+
+ALTER TABLE operator_threads
+  MODIFY created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (id, created_at);
+ALTER TABLE operator_threads
+  PARTITION BY RANGE (UNIX_TIMESTAMP(created_at)) (PARTITION pmax VALUES LESS THAN MAXVALUE);
+
+ALTER TABLE error_logs
+  MODIFY created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (id, created_at);
+ALTER TABLE error_logs
+  PARTITION BY RANGE (UNIX_TIMESTAMP(created_at)) (PARTITION pmax VALUES LESS THAN MAXVALUE);
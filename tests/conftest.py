@@ -0,0 +1,33 @@
+import os
+import sys
+import asyncio
+
+import pytest
+
+# Тести чистих частин бота: без Telegram і без MySQL. Оточення — як у bench.py,
+# БД — SQLite у пам'яті зі схемою з migrations/.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bench  # noqa: E402
+
+bench.configure_env("http://127.0.0.1:9")
+
+import bot  # noqa: E402
+
+def run(coro):
+    return asyncio.run(coro)
+
+@pytest.fixture
+def sqlite_db(monkeypatch):
+    db = bench.SQLiteDB()
+    db.apply_migrations()
+    monkeypatch.setattr(bot, "db", db)
+    return db
+
+@pytest.fixture
+def removed(monkeypatch):
+    # Відписки, які зробив би write-behind
+    gone = []
+    monkeypatch.setattr(bot.write_behind, "remove_subscriber", gone.append)
+    return gone
@@ -0,0 +1,78 @@
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+import bot
+from conftest import run
+
+def engine(**kwargs):
+    return bot.BroadcastEngine(None, rate=1e6, concurrency=4, **kwargs)
+
+def test_only_forbidden_and_missing_chat_unsubscribe(removed):
+    async def send(uid):
+        if uid % 10 == 0:
+            raise TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")
+        if uid % 10 == 1:
+            raise TelegramBadRequest(method=None, message="Bad Request: chat not found")
+        if uid % 10 == 2:
+            raise TelegramBadRequest(method=None, message=f"Bad Request: message text is empty ({uid})")
+
+    e = engine()
+    stats = run(e.run(list(range(100)), send))
+    assert (stats.ok, stats.blocked, stats.failed) == (70, 20, 10)
+    assert sorted(removed) == [u for u in range(100) if u % 10 in (0, 1)]
+    assert e.errors[2] == "Bad Request: message text is empty (2)"
+
+def test_repeated_bad_request_aborts_without_unsubscribing(removed):
+    async def send(uid):
+        raise TelegramBadRequest(method=None, message="Bad Request: wrong file identifier")
+
+    with pytest.raises(bot.BroadcastAborted):
+        run(engine(abort_after=20).run(list(range(1000)), send))
+    assert removed == []
+
+def test_successes_reset_the_abort_streak(removed):
+    async def send(uid):
+        if uid % 2:
+            raise TelegramBadRequest(method=None, message="Bad Request: can't parse entities")
+
+    stats = run(engine(abort_after=3).run(list(range(50)), send))
+    assert (stats.ok, stats.failed) == (25, 25)
+
+def test_bulk_engine_never_unsubscribes(removed):
+    async def send(uid):
+        raise TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")
+
+    stats = run(engine(unsubscribe=False).run([1, 2], send))
+    assert stats.blocked == 2
+    assert removed == []
+def test_job_is_running_only_after_full_fill(sqlite_db, monkeypatch):
+    monkeypatch.setattr(bot, "BROADCAST_FILL_PAGE", 10)
+    sqlite_db.conn.executemany("INSERT INTO subscribers (user_id) VALUES (?)", [(i,) for i in range(1, 36)])
+    job_id, total = run(bot.create_broadcast_job(text="hi"))
+    job = run(bot.get_broadcast_job(job_id))
+    assert (total, job["total"], job["status"]) == (35, 35, "running")
+
+def test_interrupted_fill_is_completed_on_resume(sqlite_db, monkeypatch):
+    monkeypatch.setattr(bot, "BROADCAST_FILL_PAGE", 10)
+    sqlite_db.conn.executemany("INSERT INTO subscribers (user_id) VALUES (?)", [(i,) for i in range(1, 36)])
+    # Процес упав після двох сторінок заповнення
+    sqlite_db.conn.execute("INSERT INTO broadcast_jobs (id, status, text, segment) VALUES (7, 'filling', 'x', NULL)")
+    sqlite_db.conn.executemany(
+        "INSERT INTO broadcast_recipients (job_id, user_id) VALUES (7, ?)", [(i,) for i in range(1, 21)]
+    )
+    started = []
+    monkeypatch.setattr(bot, "start_broadcast_job", started.append)
+    run(bot.resume_broadcast_jobs())
+    job = run(bot.get_broadcast_job(7))
+    assert (job["status"], job["total"]) == ("running", 35)
+    assert started == [7]
+
+def test_failed_fill_cancels_the_job(sqlite_db, monkeypatch):
+    async def broken_fill(job_id, segment):
+        raise RuntimeError("lost connection")
+
+    monkeypatch.setattr(bot, "fill_broadcast_recipients", broken_fill)
+    with pytest.raises(RuntimeError):
+        run(bot.create_broadcast_job(text="hi"))
+    row = sqlite_db.conn.execute("SELECT status FROM broadcast_jobs").fetchone()
+    assert row["status"] == "cancelled"
@@ -0,0 +1,97 @@
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import bot
+from conftest import run
+
+def parse(text):
+    return [(r.key, r.answer, r.status) for r in bot.parse_bulk_rows(text)]
+
+def test_delimiters():
+    text = "12345;20450000000000\n12346,Товар є\n12347\tчекаємо\n12348 буде завтра"
+    assert parse(text) == [
+        ("12345", "20450000000000", "pending"),
+        ("12346", "Товар є", "pending"),
+        ("12347", "чекаємо", "pending"),
+        ("12348", "буде завтра", "pending"),
+    ]
+
+def test_answer_keeps_commas_and_quotes():
+    assert parse('#812;"Так, є — ""червоний"""') == [("#812", 'Так, є — "червоний"', "pending")]
+    assert parse("555, так, є в наявності") == [("555", "так, є в наявності", "pending")]
+
+def test_header_row_is_skipped():
+    rows = bot.parse_bulk_rows("order;answer\n\n100;ok")
+    assert [(r.no, r.key) for r in rows] == [(2, "100")]
+
+def test_invalid_rows_are_reported():
+    assert parse("100\n#abc;x\n№ 200;ok") == [
+        ("100", "", "invalid"),
+        ("#abc", "x", "invalid"),
+        ("200", "ok", "pending"),
+    ]
+
+def test_decode_upload_falls_back_to_cp1251():
+    assert bot.decode_upload("\ufeff1;так".encode("utf-8")) == "1;так"
+    assert bot.decode_upload("1;так".encode("cp1251")) == "1;так"
+
+class FakeBot:
+    def __init__(self, fail=None):
+        self.sent = []
+        self.fail = fail or (lambda uid, text: None)
+
+    async def send_message(self, uid, text, reply_markup=None):
+        self.fail(uid, text)
+        self.sent.append((uid, text))
+
+def rows_for(*pairs):
+    rows = []
+    for no, (uid, answer) in enumerate(pairs, 1):
+        r = bot.BulkRow(no, str(no), answer)
+        r.user_id = uid
+        rows.append(r)
+    return rows
+
+def bulk_env(monkeypatch, fake):
+    monkeypatch.setattr(bot, "bot", fake)
+    monkeypatch.setattr(bot.TokenBucket, "penalize", lambda self, seconds: None)
+
+    async def answered_many(user_ids):
+        pass
+
+    monkeypatch.setattr(bot.operator_queue, "answered_many", answered_many)
+
+def test_retry_after_resumes_split_answer(monkeypatch, removed):
+    # ТТН — два повідомлення; RetryAfter на другому не має дублювати перше
+    flood = {"left": 1}
+
+    def fail(uid, text):
+        if text.startswith("Якщо") and flood["left"]:
+            flood["left"] -= 1
+            raise TelegramRetryAfter(method=None, message="flood", retry_after=0)
+
+    fake = FakeBot(fail)
+    bulk_env(monkeypatch, fake)
+    rows = rows_for((1, "20450000000000 вже в дорозі"))
+    run(bot.send_bulk_rows(rows))
+    assert [t.split("\n")[0] for _, t in fake.sent] == [
+        "Ваша ТТН Нової пошти: <code>20450000000000</code>",
+        "Якщо маєте ще питання — натисніть «Питання оператору».",
+    ]
+    assert rows[0].status == "sent"
+
+def test_bad_request_fails_row_without_unsubscribing(monkeypatch, removed):
+    def fail(uid, text):
+        if uid == 2:
+            raise TelegramBadRequest(method=None, message="Bad Request: can't parse entities")
+        if uid == 3:
+            raise TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")
+
+    bulk_env(monkeypatch, FakeBot(fail))
+    rows = rows_for((1, "ok"), (2, "<b>oops"), (3, "hi"))
+    run(bot.send_bulk_rows(rows))
+    assert [(r.status, r.detail) for r in rows] == [
+        ("sent", ""),
+        ("failed", "Bad Request: can't parse entities"),
+        ("blocked", "користувач заблокував бота"),
+    ]
+    assert removed == []
@@ -0,0 +1,71 @@
+import pytest
+
+import bot
+from conftest import run
+
+@pytest.fixture
+def catalog(sqlite_db, monkeypatch):
+    monkeypatch.setattr(bot, "PRODUCT_DB_TABLE", "products")
+    monkeypatch.setattr(bot, "PRODUCT_DB_UPDATED_COLUMN", "updated_at")
+    monkeypatch.setattr(bot, "CATALOG_PAGE", 300)
+    sqlite_db.conn.execute(
+        "CREATE TABLE products (sku TEXT PRIMARY KEY, title TEXT, price TEXT, url TEXT, image_url TEXT, updated_at INT)"
+    )
+    sqlite_db.conn.executemany(
+        "INSERT INTO products VALUES (?, ?, ?, NULL, NULL, 1)",
+        [(f"AB-{i:05d}", f"Крем для рук {i}" if i % 2 else f"Шампунь {i}", str(i)) for i in range(1000)],
+    )
+    index = bot.CatalogIndex()
+    run(index.refresh())
+    return index
+
+def skus(products):
+    return [p["sku"] for p in products]
+
+def test_normalize_sku():
+    assert bot.normalize_sku(" ab-00012 ") == "AB00012"
+    assert bot.normalize_sku("АВ 00012") == "AB00012"  # кирилиця
+    assert bot.normalize_sku("") == ""
+
+@pytest.mark.parametrize(
+    "a, b, d",
+    [("AB123", "AB123", 0), ("AB123", "AB124", 1), ("AB123", "AB213", 1), ("AB123", "AB12", 1), ("AB123", "XY999", 3)],
+)
+def test_edit_distance(a, b, d):
+    assert bot.edit_distance(a, b, 2) == min(d, 3)
+
+def test_loads_all_pages(catalog):
+    assert catalog.ready
+    assert len(catalog) == 1000
+
+def test_exact_lookup_is_normalized(catalog):
+    assert catalog.get("ab 00012")["sku"] == "AB-00012"
+    assert catalog.get("АВ-00013")["title"] == "Крем для рук 13"
+    assert catalog.get("AB-99999") is None
+
+def test_prefix(catalog):
+    assert skus(catalog.prefix("AB-0001", 3)) == ["AB-00010", "AB-00011", "AB-00012"]
+    assert catalog.prefix("ZZ") == []
+
+def test_single_typo_is_always_found(catalog):
+    # Префікс «AB0» покриває весь каталог — збіг мусить знайтися без вікна сканування
+    assert skus(catalog.fuzzy("AB-0O012"))[0] == "AB-00012"
+    assert "AB-00123" in skus(catalog.fuzzy("AB-00213"))  # перестановка
+
+def test_two_typos(catalog):
+    assert "AB-00777" in skus(catalog.fuzzy("AB-0X7Y7", limit=20))
+
+def test_suggest_prefers_completion(catalog):
+    assert skus(catalog.suggest("AB-0099")) == ["AB-00990", "AB-00991", "AB-00992", "AB-00993", "AB-00994"]
+
+def test_search_by_title_words(catalog):
+    found = catalog.search("шампунь 12", 5)
+    assert found and all("Шампунь" in p["title"] and "12" in p["title"] for p in found)
+
+def test_incremental_refresh(catalog, sqlite_db):
+    sqlite_db.conn.execute("INSERT INTO products VALUES ('ZZ-1', 'Новинка', '5', NULL, NULL, 2)")
+    sqlite_db.conn.execute("UPDATE products SET title='Оновлений', updated_at=3 WHERE sku='AB-00001'")
+    run(catalog.refresh())
+    assert len(catalog) == 1001
+    assert catalog.get("zz1")["title"] == "Новинка"
+    assert catalog.get("AB-00001")["title"] == "Оновлений"
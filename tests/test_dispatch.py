@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from conftest import run
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.edited = {}
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        await asyncio.sleep(0)
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None):
+        self.edited[message_id] = text
+
+class FakeMessage:
+    def __init__(self, user_id):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.answers = []
+
+    async def answer(self, text, reply_markup=None):
+        self.answers.append(text)
+
+@pytest.fixture
+def fake(sqlite_db, monkeypatch):
+    tg = FakeBot()
+    monkeypatch.setattr(bot, "bot", tg)
+    monkeypatch.setattr(bot, "operator_queue", bot.OperatorQueue([101, 102], strategy="least_open"))
+    return tg
+
+def dispatch(user_id, text="питання"):
+    note = f"Питання від користувача <code>{user_id}</code>\n\n{text}"
+    return bot.dispatch_thread(FakeMessage(user_id), "question", text, note, answer="ok", place="test")
+
+def test_note_gets_thread_id_for_bulk_reply(fake, sqlite_db):
+    thread_id = run(dispatch(7))
+    row = sqlite_db.conn.execute("SELECT id, admin_message_id FROM operator_threads").fetchone()
+    assert thread_id == row["id"]
+    assert fake.edited[row["admin_message_id"]] == (
+        f"Питання від користувача <code>7</code>\nThread #{thread_id}\n\nпитання"
+    )
+    assert bot.operator_queue.oldest()[0].note == fake.edited[row["admin_message_id"]]
+
+def test_concurrent_threads_spread_across_operators(fake, sqlite_db):
+    async def burst():
+        await asyncio.gather(*(dispatch(uid) for uid in range(1, 7)))
+
+    run(burst())
+    assert sorted(chat for chat, _ in fake.sent) == [101, 101, 101, 102, 102, 102]
+    assert bot.operator_queue.open_count(101) == bot.operator_queue.open_count(102) == 3
+
+def test_failed_send_releases_reserved_load(fake, monkeypatch):
+    async def down(chat_id, text, reply_markup=None):
+        raise RuntimeError("Telegram is down")
+
+    async def report_error(place, detail):
+        pass
+
+    monkeypatch.setattr(fake, "send_message", down)
+    monkeypatch.setattr(bot, "report_error", report_error)
+    assert run(dispatch(7)) is None
+    assert bot.operator_queue.open_count(101) == bot.operator_queue.open_count(102) == 0
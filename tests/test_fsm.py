@@ -0,0 +1,81 @@
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+import bot
+from conftest import run
+
+KEY = StorageKey(bot_id=1, chat_id=7, user_id=7)
+
+def storage_key():
+    return bot.fsm_key_builder.build(KEY)
+
+class FakeBackend(bot.FSMBackend):
+    # Як MySQLFSMBackend: при розімкненому запобіжнику — DatabaseUnavailable
+    def __init__(self):
+        super().__init__(ttl=3600)
+        self.rows = {}
+        self.down = False
+
+    def _check(self):
+        if self.down:
+            raise bot.DatabaseUnavailable("MySQL circuit breaker is open")
+
+    async def load(self, key):
+        self._check()
+        state, data = self.rows.get(key, (None, {}))
+        return state, dict(data), self.ttl
+
+    async def save_state(self, key, state):
+        self._check()
+        self.rows[key] = (state, self.rows.get(key, (None, {}))[1])
+
+    async def save_data(self, key, data):
+        self._check()
+        self.rows[key] = (self.rows.get(key, (None, {}))[0], dict(data))
+
+    def unavailable(self, e):
+        return bot.db_down(e)
+
+def test_dialogue_survives_outage_and_is_written_back():
+    backend = FakeBackend()
+    storage = bot.CachedFSMStorage(backend, cache_ttl=0)
+
+    async def scenario():
+        await storage.set_state(KEY, "StockRequest:waiting_code")
+        backend.down = True
+        assert await storage.get_state(KEY) == "StockRequest:waiting_code"
+        await storage.set_data(KEY, {"code": "AB-1"})
+        await storage.set_state(KEY, "StockRequest:confirm")
+        assert await storage.get_data(KEY) == {"code": "AB-1"}
+        assert backend.rows[storage_key()] == ("StockRequest:waiting_code", {})
+        backend.down = False
+        # Поки зміни не записано, локальна копія новіша за сховище
+        assert await storage.get_state(KEY) == "StockRequest:confirm"
+        await storage.set_data(KEY, {"code": "AB-2"})
+        assert backend.rows[storage_key()] == ("StockRequest:confirm", {"code": "AB-2"})
+
+    run(scenario())
+
+def test_new_dialogue_starts_during_outage():
+    backend = FakeBackend()
+    backend.down = True
+    storage = bot.CachedFSMStorage(backend, cache_ttl=0)
+
+    async def scenario():
+        assert await storage.get_state(KEY) is None
+        await storage.set_state(KEY, "OperatorQuestion:waiting_text")
+        assert await storage.get_state(KEY) == "OperatorQuestion:waiting_text"
+
+    run(scenario())
+
+def test_other_errors_still_raise():
+    backend = FakeBackend()
+    storage = bot.CachedFSMStorage(backend)
+
+    async def broken(key, state):
+        raise ValueError("bad state")
+
+    backend.save_state = broken
+    with pytest.raises(ValueError):
+        run(storage.set_state(KEY, "x"))
+    assert run(storage.get_state(KEY)) is None
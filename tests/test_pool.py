@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+import pymysql
+import pytest
+
+import bot
+from conftest import run
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self.lastrowid = 0
+
+    def execute(self, query, args=None):
+        if "slow" in query:
+            self.conn.release.wait(2)
+        if "syntax" in query:
+            raise pymysql.err.ProgrammingError(1064, "You have an error in your SQL syntax")
+        if "gone" in query:
+            raise pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+        return 1
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    opened = 0
+
+    def __init__(self):
+        FakeConnection.opened += 1
+        self.open = True
+        self.release = threading.Event()
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        self.open = False
+        self.release.set()
+
+@pytest.fixture
+def pool(monkeypatch):
+    FakeConnection.opened = 0
+    p = bot.MySQL(minsize=1, maxsize=2)
+    monkeypatch.setattr(p, "connect", FakeConnection)
+    return p
+
+async def query(pool, sql):
+    async with pool.cursor() as cur:
+        await cur.execute(sql)
+
+def test_connection_is_reused_after_query_errors(pool):
+    async def scenario():
+        await pool.start()
+        await query(pool, "SELECT 1")
+        with pytest.raises(pymysql.err.ProgrammingError):
+            await query(pool, "SELECT syntax")
+        assert (pool.size, pool.idle) == (1, 1)
+        await pool.close()
+
+    run(scenario())
+    assert FakeConnection.opened == 1
+
+def test_lost_connection_is_discarded(pool):
+    async def scenario():
+        await pool.start()
+        with pytest.raises(pymysql.err.OperationalError):
+            await query(pool, "SELECT gone")
+        assert (pool.size, pool.idle) == (0, 0)
+        await pool.close()
+
+    run(scenario())
+
+@pytest.mark.parametrize("interrupt", ["timeout", "cancel"])
+def test_interrupted_query_never_returns_to_pool(pool, interrupt):
+    # Потік пулу ще виконує запит — з'єднання не можна віддати іншій задачі
+    async def scenario():
+        await pool.start()
+        if interrupt == "timeout":
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(query(pool, "SELECT slow"), 0.05)
+        else:
+            task = asyncio.create_task(query(pool, "SELECT slow"))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        assert (pool.size, pool.idle) == (0, 0)
+        await query(pool, "SELECT 1")
+        await pool.close()
+
+    run(scenario())
+    assert FakeConnection.opened == 2
+
+def test_conn_reusable():
+    assert bot.conn_reusable(pymysql.err.IntegrityError(1062, "Duplicate entry"))
+    assert bot.conn_reusable(KeyError("x"))
+    assert not bot.conn_reusable(pymysql.err.InterfaceError(0, ""))
+    assert not bot.conn_reusable(asyncio.CancelledError())
+    assert not bot.conn_reusable(TimeoutError())
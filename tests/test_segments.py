@@ -0,0 +1,41 @@
+import pytest
+
+import bot
+
+def test_empty_segment_matches_everyone():
+    seg = bot.Segment()
+    assert seg.cond == ""
+    assert seg.args == []
+    assert seg.spec == ""
+
+def test_date_range_is_inclusive_of_last_day():
+    seg = bot.Segment(["from=2024-01-01", "to=2024-06-30"])
+    assert seg.where == ["s.created_at >= %s", "s.created_at < %s"]
+    assert seg.args == ["2024-01-01", "2024-07-01"]
+    assert seg.spec == "from=2024-01-01 to=2024-06-30"
+
+def test_activity_filters():
+    assert bot.Segment(["active"]).args == [30]
+    assert bot.Segment(["active=14"]).args == [14]
+    seg = bot.Segment(["inactive=90"])
+    assert "last_active_at IS NULL" in seg.cond
+    assert seg.args == [90]
+
+def test_open_filter_has_no_args():
+    seg = bot.Segment(["open"])
+    assert "operator_threads" in seg.cond
+    assert seg.args == []
+
+@pytest.mark.parametrize("tok", ["bogus", "open=1", "from=2024-13-01", "inactive"])
+def test_invalid_tokens_are_rejected(tok):
+    with pytest.raises(ValueError):
+        bot.Segment([tok])
+
+def test_export_args_keep_user_id_for_pagination():
+    cols, seg = bot.parse_export_args("/export active=7 cols=created_at")
+    assert cols == ["user_id", "created_at"]
+    assert seg.spec == "active=7"
+
+def test_export_args_reject_unknown_columns():
+    with pytest.raises(ValueError):
+        bot.parse_export_args("/export cols=user_id,password")
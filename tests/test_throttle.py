@@ -0,0 +1,53 @@
+import pytest
+
+import bot
+from conftest import run
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(bot.time, "monotonic", c)
+    return c
+
+def hits(backend, clock, times, key=1):
+    out = []
+    for t in times:
+        clock.now = 1000.0 + t
+        out.append(run(backend.hit(key)))
+    return out
+
+def test_min_gap_between_events(clock):
+    b = bot.MemoryThrottleBackend(0.7, 6, 10.0)
+    assert hits(b, clock, [0, 0.5, 0.7]) == [True, False, True]
+
+def test_burst_then_sustained_rate(clock):
+    # 6 подій за 10 с: сплеск із 6 проходить, далі — одна на 10/6 с
+    b = bot.MemoryThrottleBackend(0.0, 6, 10.0)
+    assert hits(b, clock, [0.01 * i for i in range(8)]) == [True] * 6 + [False] * 2
+    clock.now += 1.0
+    assert not run(b.hit(1))
+    clock.now += 1.0
+    assert run(b.hit(1))
+    assert not run(b.hit(1))
+
+def test_keys_are_independent(clock):
+    b = bot.MemoryThrottleBackend(0.7, 6, 10.0)
+    assert run(b.hit(1))
+    assert run(b.hit(2))
+    assert not run(b.hit(1))
+
+def test_idle_keys_are_evicted(clock):
+    b = bot.MemoryThrottleBackend(0.7, 6, 10.0)
+    for key in range(100):
+        run(b.hit(key))
+    assert len(b) == 100
+    clock.now += 60
+    run(b.hit(1000))
+    assert len(b) == 1
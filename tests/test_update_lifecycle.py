@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+from aiogram.types import Update
+
+import bench
+import bot
+from conftest import run
+
+def update(update_id: int) -> Update:
+    return Update.model_validate(bench.message_update(update_id, bench.USER_BASE + update_id, "/start"))
+
+@pytest.fixture
+def handled(monkeypatch):
+    # update_id -> скільки разів оброблено; обробник чекає, якщо для нього є gate
+    calls = {}
+    gates = {}
+
+    async def feed_update(_bot, upd):
+        calls[upd.update_id] = calls.get(upd.update_id, 0) + 1
+        if upd.update_id in gates:
+            await gates[upd.update_id].wait()
+
+    monkeypatch.setattr(bot.dp, "feed_update", feed_update)
+    return calls, gates
+
+def saved_offset(db):
+    row = db.conn.execute("SELECT value FROM bot_state WHERE name=?", (bot.OFFSET_KEY,)).fetchone()
+    return row and row["value"]
+
+def test_redelivered_updates_are_dropped(handled):
+    calls, gates = handled
+
+    async def scenario():
+        lc = bot.UpdateLifecycle(concurrency=8)
+        gates[5] = asyncio.Event()
+        for i in range(5, 9):
+            await lc.submit(update(i))
+        await asyncio.sleep(0.01)
+        assert lc.offset == 9
+        assert all(lc.known(i) for i in range(5, 9))
+        assert not lc.known(9)
+        assert await lc.submit(update(5)) is None  # ще обробляється
+        assert await lc.submit(update(6)) is None  # уже оброблено
+        gates[5].set()
+        await asyncio.sleep(0.01)
+        assert lc.in_flight == 0
+        assert await lc.submit(update(5)) is None
+
+    run(scenario())
+    assert calls == {5: 1, 6: 1, 7: 1, 8: 1}
+
+class FakeTelegram:
+    # getUpdates: віддає все, що не підтверджено зсувом, як справжній Telegram
+    def __init__(self, lifecycle, updates):
+        self.lifecycle = lifecycle
+        self.queue = updates
+        self.offsets = []
+
+    async def delete_webhook(self, drop_pending_updates=False):
+        pass
+
+    async def get_updates(self, offset=None, **kwargs):
+        await asyncio.sleep(0)
+        self.offsets.append(offset)
+        if offset is not None:
+            self.queue = [u for u in self.queue if u.update_id >= offset]
+        if not self.queue:
+            self.lifecycle.stopping = True
+        return list(self.queue)
+
+def test_long_handler_does_not_hold_polling(sqlite_db, handled, monkeypatch):
+    calls, gates = handled
+
+    async def scenario():
+        lc = bot.UpdateLifecycle(concurrency=8)
+        tg = FakeTelegram(lc, [update(i) for i in (1, 2, 3)])
+        monkeypatch.setattr(bot, "bot", tg)
+        gates[1] = asyncio.Event()  # /bulk_reply на кілька хвилин
+        await asyncio.wait_for(lc._poll(), 5)
+        assert lc.in_flight == 1
+        gates[1].set()
+        await asyncio.sleep(0.01)
+        return tg.offsets
+
+    # Отримане підтверджується одразу, не чекаючи на update 1
+    assert run(scenario()) == [None, 4]
+    assert calls == {1: 1, 2: 1, 3: 1}
+    assert saved_offset(sqlite_db) == 4
+
+def test_cancelled_update_is_replayed_after_restart(sqlite_db, handled):
+    calls, gates = handled
+
+    async def scenario():
+        lc = bot.UpdateLifecycle(concurrency=8)
+        gates[10] = asyncio.Event()  # так і не завершиться
+        for i in (10, 11, 12):
+            await lc.submit(update(i))
+        await asyncio.sleep(0.01)
+        await lc.drain(0.05)
+        await lc.save_abandoned()
+        await lc.save_offset()
+
+    run(scenario())
+    assert saved_offset(sqlite_db) == 13
+    assert [r["update_id"] for r in sqlite_db.conn.execute("SELECT update_id FROM pending_updates")] == [10]
+
+    async def restart():
+        del gates[10]
+        fresh = bot.UpdateLifecycle()
+        assert await fresh.load_offset() == 13
+        assert await fresh.replay_saved() == 1
+        await asyncio.sleep(0.01)
+        assert await fresh.replay_saved() == 0
+
+    run(restart())
+    assert calls == {10: 2, 11: 1, 12: 1}
+
+class FakeRequest:
+    def __init__(self, payload, secret):
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+        self._payload = payload
+
+    async def json(self):
+        return self._payload
+
+def test_webhook_acknowledges_before_handling(handled, monkeypatch):
+    calls, gates = handled
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "s3cret")
+
+    async def post(update_id, secret="s3cret"):
+        return (await bot.webhook_update(FakeRequest(bench.message_update(update_id, 1, "x"), secret))).status
+
+    async def scenario():
+        lc = bot.UpdateLifecycle()
+        monkeypatch.setattr(bot, "update_lifecycle", lc)
+        assert await post(1, "wrong") == 401
+        gates[2] = asyncio.Event()
+        assert await post(2) == 200
+        assert lc.in_flight == 1
+        # Telegram не дочекався відповіді й доставив ще раз — другого обробника немає
+        assert await post(2) == 200
+        gates[2].set()
+        await asyncio.sleep(0.01)
+        assert await post(2) == 200
+        lc.request_stop()
+        assert await post(3) == 503
+
+    run(scenario())
+    assert calls == {2: 1}